@@ -13,7 +13,7 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
-import pathlib
+from typing import List, Tuple
 import os
 
 VM_NAME: str = os.getenv("ALD_VM_NAME", "arch-linux")
@@ -21,5 +21,61 @@ VM_VRAM_SIZE: int = int(os.getenv("ALD_VM_VRAM_SIZE", 16))
 VM_MEM_SIZE: int = int(os.getenv("ALD_VM_MEM_SIZE", 1024))
 VM_IGNORE_DUPLICATES: bool = bool(int(os.getenv("ALD_VM_IGNORE_DUPLICATES", 0)))
 # shouldn't matter if the whitespace is escaped or not
-VBOX_VMS_LOCATION: str = os.getenv("ALD_VBOX_VMS_LOCATION", os.path.join(str(pathlib.Path.home()), "VirtualBox VMs"))
+VBOX_VMS_LOCATION: str = os.getenv("ALD_VBOX_VMS_LOCATION", os.path.join(os.path.expanduser("~"), "VirtualBox VMs"))
 VM_HDD_SIZE: int = int(os.getenv("ALD_VM_HDD_SIZE", 20480))
+VM_HDD_VARIANT: str = os.getenv("ALD_VM_HDD_VARIANT", "Standard")  # Standard (dynamically allocated) or Fixed
+VM_CPUS: int = int(os.getenv("ALD_VM_CPUS", 1))
+DOWNLOAD_WORKERS: int = int(os.getenv("ALD_DOWNLOAD_WORKERS", 8))
+DOWNLOAD_SEGMENT_SIZE: int = int(os.getenv("ALD_DOWNLOAD_SEGMENT_SIZE", 16 * 1024 * 1024))
+DOWNLOAD_CHUNK_SIZE: int = int(os.getenv("ALD_DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+DOWNLOAD_RETRIES: int = int(os.getenv("ALD_DOWNLOAD_RETRIES", 3))
+# seconds to connect, and to wait for the next bytes of a response, before an http request counts as failed (and is retried)
+HTTP_TIMEOUT: Tuple[float, float] = (float(os.getenv("ALD_HTTP_CONNECT_TIMEOUT", 10)), float(os.getenv("ALD_HTTP_READ_TIMEOUT", 30)))
+CACHE_DIR: str = os.getenv(
+    "ALD_CACHE_DIR",
+    os.path.join(os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "archlinux-deploy")
+)
+DOWNLOAD_HASH_BUFFER: int = int(os.getenv("ALD_DOWNLOAD_HASH_BUFFER", 256 * 1024 * 1024))
+MIRRORS: List[str] = [mirror.strip().rstrip("/") + "/" for mirror in os.getenv(
+    "ALD_MIRRORS",
+    "http://mirror.rackspace.com/archlinux/,"
+    "https://mirrors.kernel.org/archlinux/,"
+    "https://geo.mirror.pkgbuild.com/,"
+    "https://mirror.leaseweb.net/archlinux/"
+).split(",") if mirror.strip()]
+MIRROR_TTL: int = int(os.getenv("ALD_MIRROR_TTL", 24 * 60 * 60))
+MIRROR_PROBE_PATH: str = os.getenv("ALD_MIRROR_PROBE_PATH", "iso/latest/archlinux-x86_64.iso")
+MIRROR_PROBE_BYTES: int = int(os.getenv("ALD_MIRROR_PROBE_BYTES", 512 * 1024))
+MIRROR_PROBE_TIMEOUT: float = float(os.getenv("ALD_MIRROR_PROBE_TIMEOUT", 5))
+LOG_DIR: str = os.getenv("ALD_LOG_DIR", os.path.join(CACHE_DIR, "logs"))
+FLEET_FILE: str = os.getenv("ALD_FLEET_FILE", "")
+FLEET_TEMPLATE: str = os.getenv("ALD_FLEET_TEMPLATE", f"{VM_NAME}-{{index}}")
+FLEET_COUNT: int = int(os.getenv("ALD_FLEET_COUNT", 0))
+FLEET_WORKERS: int = int(os.getenv("ALD_FLEET_WORKERS", 4))
+GOLDEN: bool = bool(int(os.getenv("ALD_GOLDEN", 0)))
+GOLDEN_NAME: str = os.getenv("ALD_GOLDEN_NAME", f"{VM_NAME}-base")
+GOLDEN_SNAPSHOT: str = os.getenv("ALD_GOLDEN_SNAPSHOT", "golden")
+DRY_RUN: bool = bool(int(os.getenv("ALD_DRY_RUN", 0)))
+SCHEDULER_WORKERS: int = int(os.getenv("ALD_SCHEDULER_WORKERS", 8))
+REPROBE: bool = bool(int(os.getenv("ALD_REPROBE", 0)))
+COMMAND_TIMEOUT: float = float(os.getenv("ALD_COMMAND_TIMEOUT", 300))
+COMMAND_CONCURRENCY: int = int(os.getenv("ALD_COMMAND_CONCURRENCY", 4))
+REPORT_PATH: str = os.getenv("ALD_REPORT_PATH", "")
+PROMETHEUS_PATH: str = os.getenv("ALD_PROMETHEUS_PATH", "")
+DELTA_UPDATES: bool = bool(int(os.getenv("ALD_DELTA_UPDATES", 1)))
+DELTA_BLOCK_SIZE: int = int(os.getenv("ALD_DELTA_BLOCK_SIZE", 64 * 1024))
+VBOX_API: bool = bool(int(os.getenv("ALD_VBOX_API", 1)))
+# on the same filesystem as the VMs by default, otherwise the templates can't be reflinked into place
+DISK_TEMPLATE_DIR: str = os.getenv("ALD_DISK_TEMPLATE_DIR", os.path.join(VBOX_VMS_LOCATION, ".archlinux-deploy-templates"))
+DISK_SPACE_RESERVE: int = int(os.getenv("ALD_DISK_SPACE_RESERVE", 1024))  # MB left free on VBOX_VMS_LOCATION
+ADMISSION: str = os.getenv("ALD_ADMISSION", "refuse")  # what to do with a VM the host can't take: refuse, queue or off
+ADMISSION_MEMORY_RATIO: float = float(os.getenv("ALD_ADMISSION_MEMORY_RATIO", 0.8))  # of host RAM that VMs may be given
+ADMISSION_CPU_RATIO: float = float(os.getenv("ALD_ADMISSION_CPU_RATIO", 2.0))  # vCPUs per host CPU
+ADMISSION_POLL: float = float(os.getenv("ALD_ADMISSION_POLL", 30))  # seconds between checks while queued
+ADMISSION_TIMEOUT: float = float(os.getenv("ALD_ADMISSION_TIMEOUT", 60 * 60))
+# powered off VMs count too by default, they get their memory back as soon as they're started
+ADMISSION_COUNT_STOPPED: bool = bool(int(os.getenv("ALD_ADMISSION_COUNT_STOPPED", 1)))
+# 0 gives every VM VM_MEM_SIZE / VM_CPUS, otherwise it gets this fraction of what's left on the host
+VM_MEM_FRACTION: float = float(os.getenv("ALD_VM_MEM_FRACTION", 0))
+VM_CPU_FRACTION: float = float(os.getenv("ALD_VM_CPU_FRACTION", 0))
+VM_MEM_MIN: int = int(os.getenv("ALD_VM_MEM_MIN", 512))
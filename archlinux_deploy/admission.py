@@ -0,0 +1,232 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# decides whether the host can take another VM (or a whole fleet) before anything is created, and how big it gets.
+# the host is read from /proc and the VMs from `vboxmanage list vms` + `showvminfo`, decide() only works on those
+# readings so it can be fed fixtures
+from archlinux_deploy import (ADMISSION, ADMISSION_MEMORY_RATIO, ADMISSION_CPU_RATIO, ADMISSION_POLL, ADMISSION_TIMEOUT,
+                              ADMISSION_COUNT_STOPPED, VM_MEM_FRACTION, VM_CPU_FRACTION, VM_MEM_MIN, DISK_SPACE_RESERVE,
+                              VBOX_VMS_LOCATION, GOLDEN_NAME)
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy.state import parse_machinereadable, parse_vm_list
+from archlinux_deploy.spec import VMSpec
+from archlinux_deploy import disks, runner, utils
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import time
+import re
+import os
+
+MB: int = 1024 * 1024
+STOPPED_STATES: Tuple[str, ...] = ("poweroff", "saved", "aborted", "aborted-saved")
+
+
+class Host(NamedTuple):
+    memory: int  # MB
+    available_memory: int  # MB the host can hand out right now (MemAvailable)
+    cpus: int
+    free_disk: int  # MB on VBOX_VMS_LOCATION
+
+
+class Allocation(NamedTuple):
+    name: str
+    memory: int  # MB
+    cpus: int
+    state: str  # VirtualBox's VMState, e.g. poweroff or running
+
+
+class Policy(NamedTuple):
+    mode: str = ADMISSION  # refuse, queue, warn (report only, e.g. for dry runs) or off
+    memory_ratio: float = ADMISSION_MEMORY_RATIO
+    cpu_ratio: float = ADMISSION_CPU_RATIO
+    memory_fraction: float = VM_MEM_FRACTION
+    cpu_fraction: float = VM_CPU_FRACTION
+    min_memory: int = VM_MEM_MIN
+    count_stopped: bool = ADMISSION_COUNT_STOPPED
+
+
+class Decision(NamedTuple):
+    spec: VMSpec  # sized to the memory and vCPUs it gets
+    admitted: bool
+    report: List[str]
+
+
+def parse_meminfo(text: str) -> Dict[str, int]:
+    # /proc/meminfo, in kB
+    values: Dict[str, int] = {}
+    for line in text.splitlines():
+        key, separator, value = line.partition(":")
+        if separator and value.split():
+            values[key.strip()] = int(value.split()[0])
+    return values
+
+
+def parse_cpuinfo(text: str) -> int:
+    return len([line for line in text.splitlines() if line.split(":")[0].strip() == "processor"])
+
+
+def read_host(proc_root: str = "/proc", vms_location: str = VBOX_VMS_LOCATION) -> Optional[Host]:
+    # None where there's no /proc to read, i.e. on anything but Linux
+    meminfo_path: str = os.path.join(proc_root, "meminfo")
+    if not os.path.exists(meminfo_path):
+        return None
+    try:
+        with open(meminfo_path, "r") as meminfo_file:
+            meminfo: Dict[str, int] = parse_meminfo(meminfo_file.read())
+        try:
+            with open(os.path.join(proc_root, "cpuinfo"), "r") as cpuinfo_file:
+                cpus: int = parse_cpuinfo(cpuinfo_file.read()) or os.cpu_count() or 1
+        except FileNotFoundError:
+            cpus = os.cpu_count() or 1
+        memory: int = meminfo["MemTotal"]
+    except (OSError, KeyError) as error:
+        raise BaseStageException(
+            f"Couldn't read the host's memory and CPUs from {proc_root}: {error!r}\n"
+            f"Set ALD_ADMISSION=off to deploy without checking the host's capacity."
+        ) from None
+    # MemAvailable is missing before Linux 3.14
+    available: int = meminfo.get("MemAvailable", meminfo.get("MemFree", 0) + meminfo.get("Cached", 0))
+    return Host(memory // 1024, available // 1024, cpus, disks.free_space(vms_location) // MB)
+
+
+def parse_allocation(name: str, showvminfo: str) -> Allocation:
+    info: Dict[str, str] = parse_machinereadable(showvminfo)
+    return Allocation(name, int(info.get("memory", 0)), int(info.get("cpus", 1)), info.get("VMState", "unknown"))
+
+
+def read_allocations(vboxmanage: str) -> List[Allocation]:
+    _, stdout, _ = runner.sp_run([vboxmanage, "list", "vms"])
+    names: List[str] = parse_vm_list(stdout)
+    results: List[runner.CommandResult] = runner.run_many(
+        [[vboxmanage, "showvminfo", name, "--machinereadable"] for name in names], ignore_return_code=True
+    )
+    # a VM unregistered in between doesn't take anything any more
+    return [parse_allocation(name, result.stdout) for name, result in zip(names, results) if result.return_code == 0]
+
+
+def counted(allocations: List[Allocation], policy: Policy, name: str) -> List[Allocation]:
+    # golden base VMs are only ever cloned, never started, and the VM being reconciled doesn't compete with itself
+    return [
+        allocation for allocation in allocations
+        if allocation.name != name and not re.fullmatch(rf"{re.escape(GOLDEN_NAME)}-[0-9a-f]{{12}}(-[0-9]+)?", allocation.name)
+        and (policy.count_stopped or allocation.state not in STOPPED_STATES)
+    ]
+
+
+def reconciled(spec: VMSpec, info: Optional[Dict[str, str]], policy: Policy = Policy()) -> Optional[VMSpec]:
+    # an existing VM was admitted when it was created, so rerunning it only needs another check when it grows;
+    # a size from the fractions is worked out once, at creation. returns the spec to use, None when it needs a check
+    if info is None:
+        return None
+    memory: int = int(info.get("memory", 0))
+    cpus: int = int(info.get("cpus", 1))
+    if policy.memory_fraction:
+        spec = spec._replace(memory=memory)
+    if policy.cpu_fraction:
+        spec = spec._replace(cpus=cpus)
+    return spec if spec.memory <= memory and spec.cpus <= cpus else None
+
+
+def _template_cached(spec: VMSpec) -> bool:
+    return os.path.exists(disks.template_path(spec.hdd_size, spec.hdd_variant))
+
+
+def decide(spec: VMSpec, host: Host, allocations: List[Allocation], policy: Policy = Policy(),
+           disk_needed: Optional[int] = None) -> Decision:
+    # disk_needed is in MB, without the reserve; None works it out from the spec
+    others: List[Allocation] = counted(allocations, policy, spec.name)
+    allocated_memory: int = sum(allocation.memory for allocation in others)
+    allocated_cpus: int = sum(allocation.cpus for allocation in others)
+    memory_limit: int = int(host.memory * policy.memory_ratio)
+    cpu_limit: int = int(host.cpus * policy.cpu_ratio)
+
+    if policy.memory_fraction:
+        left: int = min(memory_limit - allocated_memory, host.available_memory)
+        spec = spec._replace(memory=max(int(left * policy.memory_fraction) // 64 * 64, policy.min_memory))
+    if policy.cpu_fraction:
+        spec = spec._replace(cpus=max(min(int((cpu_limit - allocated_cpus) * policy.cpu_fraction), host.cpus), 1))
+    if disk_needed is None:
+        disk_needed = disks.required_space(spec, _template_cached(spec)) // MB
+
+    problems: List[str] = []
+    if allocated_memory + spec.memory > memory_limit:
+        problems.append(f"{spec.memory} MB of memory is over the {max(memory_limit - allocated_memory, 0)} MB left for VMs "
+                        f"({policy.memory_ratio:.0%} of {host.memory} MB, {allocated_memory} MB already given to other VMs)")
+    if spec.memory > host.available_memory:
+        problems.append(f"{spec.memory} MB of memory is over the {host.available_memory} MB the host has available right now")
+    if allocated_cpus + spec.cpus > cpu_limit or spec.cpus > host.cpus:
+        problems.append(f"{spec.cpus} vCPU(s) is over the {max(min(cpu_limit - allocated_cpus, host.cpus), 0)} left for this VM "
+                        f"({policy.cpu_ratio:g} per host CPU, {allocated_cpus} already given to other VMs)")
+    if disk_needed + DISK_SPACE_RESERVE > host.free_disk:
+        problems.append(f"{disk_needed} MB of disk space and the {DISK_SPACE_RESERVE} MB reserve are over the "
+                        f"{host.free_disk} MB free on '{VBOX_VMS_LOCATION}'")
+
+    report: List[str] = [
+        f"{spec.name}: {spec.memory} MB memory, {spec.cpus} vCPU(s), {disk_needed} MB disk",
+        f"  host: {host.memory} MB memory ({host.available_memory} MB available), {host.cpus} CPU(s), {host.free_disk} MB free disk",
+        f"  other VMs: {allocated_memory} MB memory, {allocated_cpus} vCPU(s) in {len(others)} VM(s)",
+    ] + [
+        f"    {allocation.name}: {allocation.memory} MB, {allocation.cpus} vCPU(s), {allocation.state}" for allocation in others
+    ] + [f"  over capacity: {problem}" for problem in problems]
+    return Decision(spec, not problems, report)
+
+
+def admit_all(vboxmanage: str, specs: List[VMSpec], policy: Policy = Policy(), linked: bool = False,
+              proc_root: str = "/proc") -> Tuple[List[VMSpec], List[Decision]]:
+    # every admitted VM counts against the next one, as if they were all running side by side.
+    # linked clones start out without a disk of their own. returns the admitted (and sized) specs and the refused decisions
+    if policy.mode == "off":
+        return specs, []
+    host: Optional[Host] = read_host(proc_root)
+    if host is None:
+        utils.colored_output(
+            f"Can't read the host's memory and CPUs without {proc_root}, going ahead without checking the host's capacity "
+            f"and with the fixed memory and vCPU settings.", "warn"
+        )
+        return specs, []
+    deadline: float = time.monotonic() + ADMISSION_TIMEOUT
+    while True:
+        allocations: List[Allocation] = read_allocations(vboxmanage)
+        left: Host = host
+        admitted: List[Decision] = []
+        refused: List[Decision] = []
+        for spec in specs:
+            disk_needed: int = 0 if linked else disks.required_space(spec, _template_cached(spec)) // MB
+            decision: Decision = decide(spec, left, allocations, policy, disk_needed)
+            if not decision.admitted:
+                refused.append(decision)
+                continue
+            admitted.append(decision)
+            allocations = allocations + [Allocation(decision.spec.name, decision.spec.memory, decision.spec.cpus, "planned")]
+            left = left._replace(available_memory=left.available_memory - decision.spec.memory,
+                                 free_disk=left.free_disk - disk_needed)
+        if not refused or policy.mode != "queue" or time.monotonic() >= deadline:
+            for decision in admitted:
+                utils.colored_output("\n".join(decision.report), "info")
+            for decision in refused:
+                utils.colored_output("\n".join(decision.report), "warn" if policy.mode == "warn" else "error")
+            return [decision.spec for decision in admitted], refused
+        utils.colored_output(f"{len(refused)} VM(s) don't fit on the host yet, checking again in {ADMISSION_POLL:g} seconds...", "warn")
+        time.sleep(ADMISSION_POLL)
+        host = read_host(proc_root) or host
+
+
+def admit(vboxmanage: str, spec: VMSpec, policy: Policy = Policy(), linked: bool = False) -> VMSpec:
+    admitted, refused = admit_all(vboxmanage, [spec], policy, linked)
+    if refused and policy.mode != "warn":
+        raise BaseStageException(
+            f"The host can't take {spec.name} without overcommitting, see the report above.\n"
+            f"Free up resources or shrink the VM, or set ALD_ADMISSION=queue to wait for room or ALD_ADMISSION=off to skip the check."
+        )
+    return admitted[0] if admitted else refused[0].spec
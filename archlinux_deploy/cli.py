@@ -13,4 +13,180 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# only the standard library is imported up here, each command imports the stage it runs so that
+# `--help`, `status` and no-op reruns don't load requests, rich or the virtualbox bindings
+from archlinux_deploy import VM_NAME, VM_MEM_SIZE, VM_VRAM_SIZE, VM_HDD_SIZE, VM_HDD_VARIANT, VM_CPUS, DRY_RUN, REPORT_PATH, PROMETHEUS_PATH
+from typing import Callable, Dict, List, Optional, Tuple
+import argparse
+import sys
+import re
 
+
+def _spec(arguments: argparse.Namespace):
+    from archlinux_deploy.spec import VMSpec
+    return VMSpec(arguments.name, arguments.memory, arguments.vram, arguments.hdd_size, arguments.hdd_variant, arguments.cpus)
+
+
+def prepare_command(arguments: argparse.Namespace) -> bool:
+    from archlinux_deploy.stages import prepare
+    return prepare.run()
+
+
+def adapt_command(arguments: argparse.Namespace) -> bool:
+    from archlinux_deploy.stages import vm_adapt
+    return vm_adapt.run(_spec(arguments), dry_run=arguments.dry_run)
+
+
+def deploy_command(arguments: argparse.Namespace) -> bool:
+    from archlinux_deploy import deploy
+    return deploy.run(_spec(arguments), dry_run=arguments.dry_run, use_golden=arguments.golden)
+
+
+def fleet_command(arguments: argparse.Namespace) -> bool:
+    from archlinux_deploy import fleet
+    return fleet.run(workers=arguments.workers, use_golden=arguments.golden)
+
+
+def golden_command(arguments: argparse.Namespace) -> bool:
+    from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+    from archlinux_deploy import golden, utils
+    try:
+        if arguments.action == "rebuild":
+            golden.rebuild(_spec(arguments), force=arguments.force)
+        else:
+            stale: List[str] = golden.stale_clones(_spec(arguments))
+            for name in stale:
+                utils.colored_output(f"{name} is based on a stale base VM.", "warn")
+            if not stale:
+                utils.colored_output("Every linked clone is based on the current base VM.", "success")
+    except BaseStageException as error:
+        utils.colored_output(error.args[0], "error")
+        return False
+    return True
+
+
+def status_command(arguments: argparse.Namespace) -> bool:
+    # reads the caches only and prints without rich, this has to stay fast
+    from archlinux_deploy import iso_cache, probe, golden
+    environment = probe.cached()
+    iso = iso_cache.current()
+    bases = golden.current_bases(iso.sha256) if iso else {}
+    rows: List[Tuple[str, str]] = [
+        ("vboxmanage", (environment.vboxmanage or "not found") if environment else "not probed yet"),
+        ("virtualbox", (environment.virtualbox or "not found") if environment else "not probed yet"),
+        ("vboxapi", (environment.vboxapi or "not found") if environment else "not probed yet"),
+        ("xpcom", (environment.xpcom or "not found") if environment else "not probed yet"),
+        ("iso", f"{iso.version} at {iso.path}" if iso else "not downloaded yet"),
+        ("base vms", ", ".join(sorted(base.name for base in bases.values())) or "not built yet"),
+    ]
+    for label, value in rows:
+        print(f"{label:>12}: {value}")
+    return True
+
+
+def blockmap_command(arguments: argparse.Namespace) -> bool:
+    # for whoever runs the mirror of a build site, see archlinux_deploy/delta.py
+    from archlinux_deploy import delta
+    try:
+        blockmap = delta.build_blockmap(arguments.iso, arguments.block_size)
+    except (OSError, ValueError) as error:
+        print(f"Couldn't build the block map of '{arguments.iso}': {error}", file=sys.stderr)
+        return False
+    path: str = arguments.iso + delta.BLOCKMAP_SUFFIX
+    delta.write_blockmap(blockmap, path)
+    print(f"Block map of {len(blockmap.strong)} block(s) written to {path}.")
+    return True
+
+
+def import_profile(argv: List[str], top: int = 15) -> int:
+    # re-runs the same command under -X importtime and sums up where startup went
+    import subprocess
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "archlinux_deploy"] + [argument for argument in argv if argument != "--import-profile"],
+        stderr=subprocess.PIPE, universal_newlines=True
+    )
+    timings: List[Tuple[int, int, str]] = []
+    for line in completed.stderr.splitlines():
+        match = re.match(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)", line)
+        if match is None:
+            if not line.startswith("import time:"):
+                print(line, file=sys.stderr)
+            continue
+        timings.append((int(match.group(2)), int(match.group(1)), " " * (len(match.group(3)) - 1) + match.group(4)))
+    total: int = sum(self_time for _, self_time, _ in timings)
+    print(f"\nImports took {total / 1000:.1f} ms in total. Slowest by cumulative time:", file=sys.stderr)
+    for cumulative, self_time, name in sorted(timings, reverse=True)[:top]:
+        print(f"{cumulative / 1000:9.1f} ms cumulative {self_time / 1000:9.1f} ms self  {name.strip()}", file=sys.stderr)
+    return completed.returncode
+
+
+def parser() -> argparse.ArgumentParser:
+    main_parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        prog="archlinux-deploy", description="Deploys a VirtualBox Arch Linux VM automatically."
+    )
+    main_parser.add_argument("--reprobe", action="store_true", help="ignore the cached environment probe")
+    main_parser.add_argument("--import-profile", action="store_true", help="report where startup time goes")
+    main_parser.add_argument("--report", metavar="PATH", default=REPORT_PATH, help="where to write the JSON run report")
+    main_parser.add_argument("--prometheus", metavar="PATH", default=PROMETHEUS_PATH,
+                             help="also write the metrics in the Prometheus text format, e.g. for node_exporter's textfile collector")
+    subparsers = main_parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+
+    def vm_options(subparser: argparse.ArgumentParser):
+        subparser.add_argument("--name", default=VM_NAME)
+        subparser.add_argument("--memory", type=int, default=VM_MEM_SIZE, help="memory size in MB")
+        subparser.add_argument("--vram", type=int, default=VM_VRAM_SIZE, help="video memory size in MB")
+        subparser.add_argument("--hdd-size", type=int, default=VM_HDD_SIZE, help="disk size in MB")
+        subparser.add_argument("--hdd-variant", choices=["Standard", "Fixed"], default=VM_HDD_VARIANT,
+                               help="Standard disks grow as needed, Fixed ones are allocated up front for steadier I/O")
+        subparser.add_argument("--cpus", type=int, default=VM_CPUS, help="virtual CPUs")
+
+    commands: Dict[str, Tuple[Callable[[argparse.Namespace], bool], str]] = {
+        "prepare": (prepare_command, "stage 1: check the environment and download the ISO"),
+        "adapt": (adapt_command, "stage 2: create and configure the VM"),
+        "deploy": (deploy_command, "both stages, scheduled concurrently"),
+        "status": (status_command, "show what's cached, without touching the network or VirtualBox"),
+        "fleet": (fleet_command, "provision every VM of the fleet"),
+        "golden": (golden_command, "manage the golden base VM"),
+        "blockmap": (blockmap_command, "write the block map a mirror publishes next to an ISO for delta updates"),
+    }
+    for name, (function, help_text) in commands.items():
+        subparser: argparse.ArgumentParser = subparsers.add_parser(name, help=help_text)
+        subparser.set_defaults(function=function)
+        if name in ("adapt", "deploy", "golden"):
+            vm_options(subparser)
+        if name in ("adapt", "deploy"):
+            subparser.add_argument("--dry-run", action="store_true", default=DRY_RUN, help="print the vboxmanage commands instead of running them")
+        if name in ("deploy", "fleet"):
+            from archlinux_deploy import GOLDEN
+            subparser.add_argument("--golden", action="store_true", default=GOLDEN, help="create linked clones of the golden base VM")
+        if name == "fleet":
+            from archlinux_deploy import FLEET_WORKERS
+            subparser.add_argument("--workers", type=int, default=FLEET_WORKERS)
+        if name == "golden":
+            subparser.add_argument("action", choices=["rebuild", "stale"])
+            subparser.add_argument("--force", action="store_true", help="rebuild even if the base is up to date")
+        if name == "blockmap":
+            from archlinux_deploy import DELTA_BLOCK_SIZE
+            subparser.add_argument("iso")
+            subparser.add_argument("--block-size", type=int, default=DELTA_BLOCK_SIZE, help="in bytes, a multiple of 2048")
+    return main_parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else argv
+    arguments: argparse.Namespace = parser().parse_args(argv)
+    if arguments.import_profile:
+        return import_profile(argv)
+    if arguments.reprobe:
+        from archlinux_deploy import probe
+        probe.environment(reprobe=True)
+    succeeded: bool = arguments.function(arguments)
+    if arguments.command not in ("status", "blockmap"):
+        from archlinux_deploy import metrics
+        metrics.write_reports(arguments.command, succeeded, arguments.report, arguments.prometheus)
+    return 0 if succeeded else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# zsync-style updates: the blocks of a new release that are already somewhere in the previous ISO are copied from it
+# and only the rest is fetched with range requests. Arch mirrors don't publish zsync files (and zsync's md4 is gone
+# from most OpenSSL builds), so this uses its own block map, published next to the ISO as <iso>.blockmap.json
+# (see build_blockmap and `archlinux-deploy blockmap`); without one the ISO is downloaded in full.
+#
+# Blocks are matched at every ISO9660 sector (2048 bytes) of the old file, not at every byte: files on an ISO start on
+# sector boundaries, so that's where content moves between releases, and it lets the weak checksum roll over one
+# adler32 per sector instead of one python step per byte.
+from archlinux_deploy import DELTA_BLOCK_SIZE, DOWNLOAD_WORKERS, DOWNLOAD_SEGMENT_SIZE, HTTP_TIMEOUT
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy.download import Segment
+from archlinux_deploy.utils import print
+from archlinux_deploy import download, metrics, utils
+from typing import Dict, List, NamedTuple, Optional
+from array import array
+import requests
+import hashlib
+import zlib
+import time
+import os
+
+BLOCKMAP_SUFFIX: str = ".blockmap.json"
+SECTOR_SIZE: int = 2048
+_READ_SIZE: int = 512 * SECTOR_SIZE
+_MODULUS: int = (1 << 61) - 1
+_BASE: int = 1000003
+
+
+class BlockMap(NamedTuple):
+    length: int
+    sha256: str
+    block_size: int
+    weak: List[int]
+    strong: List[str]
+
+    @property
+    def full_blocks(self) -> int:
+        return self.length // self.block_size
+
+
+def _sector_checksums(path: str) -> array:
+    checksums: array = array("L")
+    with open(path, "rb") as file:
+        while True:
+            data: bytes = file.read(_READ_SIZE)
+            if not data:
+                return checksums
+            for start in range(0, len(data), SECTOR_SIZE):
+                checksums.append(zlib.adler32(data[start:start + SECTOR_SIZE]))
+
+
+def _weak(sectors: array) -> int:
+    value: int = 0
+    for checksum in sectors:
+        value = (value * _BASE + checksum) % _MODULUS
+    return value
+
+
+def _strong(block: bytes) -> str:
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def build_blockmap(path: str, block_size: int = DELTA_BLOCK_SIZE) -> BlockMap:
+    if block_size % SECTOR_SIZE:
+        raise ValueError(f"The block size has to be a multiple of {SECTOR_SIZE} bytes.")
+    sectors_per_block: int = block_size // SECTOR_SIZE
+    sectors: array = _sector_checksums(path)
+    weak: List[int] = []
+    strong: List[str] = []
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for index in range(0, len(sectors), sectors_per_block):
+            block: bytes = file.read(block_size)
+            sha256.update(block)
+            weak.append(_weak(sectors[index:index + sectors_per_block]))
+            strong.append(_strong(block))
+    return BlockMap(os.path.getsize(path), sha256.hexdigest(), block_size, weak, strong)
+
+
+def write_blockmap(blockmap: BlockMap, path: str):
+    utils.write_json(path, dict(blockmap._asdict(), version=1))
+
+
+def parse_blockmap(data: dict) -> BlockMap:
+    blockmap: BlockMap = BlockMap(data["length"], data["sha256"], data["block_size"], data["weak"], data["strong"])
+    if blockmap.block_size % SECTOR_SIZE or len(blockmap.weak) != len(blockmap.strong) or \
+            len(blockmap.strong) != -(-blockmap.length // blockmap.block_size):
+        raise ValueError("inconsistent block map")
+    return blockmap
+
+
+def match_blocks(old_path: str, blockmap: BlockMap) -> Dict[int, int]:
+    # new block index -> offset of the same bytes in the old file
+    sectors_per_block: int = blockmap.block_size // SECTOR_SIZE
+    wanted: Dict[int, List[int]] = {}
+    for index in range(blockmap.full_blocks):  # the short last block, if any, is always fetched
+        wanted.setdefault(blockmap.weak[index], []).append(index)
+
+    sectors: array = _sector_checksums(old_path)
+    found: Dict[int, int] = {}
+    if len(sectors) < sectors_per_block:
+        return found
+    leaving_factor: int = pow(_BASE, sectors_per_block - 1, _MODULUS)
+    weak: int = _weak(sectors[:sectors_per_block])
+    with open(old_path, "rb") as old:
+        for start in range(len(sectors) - sectors_per_block + 1):
+            if start:
+                weak = ((weak - sectors[start - 1] * leaving_factor) * _BASE + sectors[start + sectors_per_block - 1]) % _MODULUS
+            candidates: Optional[List[int]] = wanted.get(weak)
+            if not candidates:
+                continue
+            old.seek(start * SECTOR_SIZE)
+            block: bytes = old.read(blockmap.block_size)
+            if len(block) != blockmap.block_size:
+                continue
+            strong: str = _strong(block)
+            matched: List[int] = [index for index in candidates if blockmap.strong[index] == strong]
+            for index in matched:
+                found[index] = start * SECTOR_SIZE
+            if matched:
+                wanted[weak] = [index for index in candidates if index not in found]
+                if not wanted[weak]:
+                    del wanted[weak]
+                if not wanted:
+                    break
+    return found
+
+
+def _missing_segments(blockmap: BlockMap, found: Dict[int, int], segment_size: int) -> List[Segment]:
+    segments: List[Segment] = []
+    start: Optional[int] = None
+    for index in range(len(blockmap.strong) + 1):
+        if index < len(blockmap.strong) and index not in found:
+            start = index * blockmap.block_size if start is None else start
+            continue
+        if start is not None:
+            end: int = min(index * blockmap.block_size, blockmap.length)
+            # long runs are split, so they are fetched over several connections
+            segments.extend(Segment(offset, min(offset + segment_size, end) - 1) for offset in range(start, end, segment_size))
+            start = None
+    return segments
+
+
+def fetch_blockmap(session: requests.Session, iso_url: str) -> Optional[BlockMap]:
+    try:
+        response: requests.Response = session.get(iso_url + BLOCKMAP_SUFFIX, timeout=HTTP_TIMEOUT)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return parse_blockmap(response.json())
+    except (requests.RequestException, ValueError, KeyError, TypeError) as error:
+        print(f"[yellow]Ignoring the block map of '{iso_url}': {error}")
+        return None
+
+
+def update(old_path: str, iso_url: str, destination: str, sha256: str,
+           workers: int = DOWNLOAD_WORKERS, segment_size: int = DOWNLOAD_SEGMENT_SIZE) -> bool:
+    # False when the mirror has no usable block map, the caller downloads the whole ISO then
+    session: requests.Session = download.create_session(workers)
+    blockmap: Optional[BlockMap] = fetch_blockmap(session, iso_url)
+    if blockmap is None:
+        return False
+    if blockmap.sha256 != sha256:
+        print("[yellow]The block map doesn't describe the ISO listed in sha256sums.txt, ignoring it.")
+        return False
+
+    print(f"[blue]Looking for blocks of the new ISO in '{old_path}'...")
+    found: Dict[int, int] = match_blocks(old_path, blockmap)
+    segments: List[Segment] = _missing_segments(blockmap, found, segment_size)
+    missing: int = sum(segment.size for segment in segments)
+    print(f"[blue]{blockmap.length - missing} of {blockmap.length} bytes are reused, fetching the other {missing} "
+          f"in {len(segments)} range(s).")
+
+    # the same partial file as a full download, with a journal of its own so an interrupted update resumes too
+    partial_path: str = f"{destination}.part"
+    journal: download.Journal = download.Journal(
+        f"{partial_path}.json", iso_url.rsplit("/", 1)[-1], blockmap.length, segment_size, source=old_path
+    ).load()
+    if not journal.completed or not os.path.exists(partial_path):
+        download.preallocate(partial_path, blockmap.length)
+        with open(old_path, "rb") as old, open(partial_path, "r+b") as partial:
+            for index, offset in found.items():
+                old.seek(offset)
+                partial.seek(index * blockmap.block_size)
+                partial.write(old.read(blockmap.block_size))
+    counter: download.ByteCounter = download.ByteCounter(None)
+    started: float = time.perf_counter()
+    try:
+        download.fetch_ranges(session, iso_url, partial_path, journal, segments, workers, counter)
+    finally:
+        metrics.record_download(iso_url, counter.count, time.perf_counter() - started)
+
+    # the block map is only as trustworthy as the mirror, the assembled file has to match sha256sums.txt
+    actual: str = download.StreamingHasher("sha256", buffer_limit=0).finish(partial_path)
+    if actual != sha256:
+        os.remove(partial_path)
+        journal.remove()
+        raise BaseStageException(
+            f"The ISO assembled from the previous release doesn't match the mirror's sha256sums.txt.\n"
+            f"Expected: {sha256}\n"
+            f"Got: {actual}"
+        )
+    os.replace(partial_path, destination)
+    journal.remove()
+    return True
@@ -0,0 +1,46 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import DRY_RUN, GOLDEN
+from archlinux_deploy.stages import prepare, vm_adapt
+from archlinux_deploy.plan import Plan
+from archlinux_deploy.state import VMState
+from archlinux_deploy.spec import VMSpec
+from archlinux_deploy import scheduler, utils
+from typing import Optional
+
+
+def run(spec: Optional[VMSpec] = None, dry_run: bool = DRY_RUN, use_golden: bool = GOLDEN) -> bool:
+    if use_golden:
+        return _run_golden(spec or VMSpec(), dry_run)
+    # admitted before anything is downloaded, then both stages in one graph so the VM is created and configured
+    # while the ISO downloads
+    state: VMState = VMState()
+    spec = vm_adapt.admitted(spec or VMSpec(), dry_run, state)
+    if spec is None:
+        return False
+    return scheduler.run(prepare.substages() + vm_adapt.substages(spec, Plan(dry_run), state), vm=spec.name)
+
+
+def _run_golden(spec: VMSpec, dry_run: bool) -> bool:
+    # the base VM is built from the ISO, so stage 1 has to finish first; the clone itself only takes seconds
+    from archlinux_deploy import golden
+    if dry_run:
+        utils.colored_output("Linked clones can't be dry run, leave out --golden to see the plan.", "error")
+        return False
+    admitted: Optional[VMSpec] = vm_adapt.admitted(spec, dry_run, linked=True)
+    if admitted is None:
+        return False
+    return prepare.run() and golden.run(admitted, admit=False)
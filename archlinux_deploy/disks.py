@@ -0,0 +1,168 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# blank disks are created once per size and variant with vboxmanage, kept unregistered in DISK_TEMPLATE_DIR and copied
+# into place for every VM: a reflink is instant, copy_file_range lets the kernel (or the NFS server) do the copy, and a
+# plain copy is the fallback. every copy gets a UUID of its own, VirtualBox refuses to register two disks sharing one.
+from archlinux_deploy import DISK_TEMPLATE_DIR, DISK_SPACE_RESERVE, VBOX_VMS_LOCATION
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy.spec import VMSpec
+from archlinux_deploy.utils import print
+from archlinux_deploy.runner import sp_call
+from archlinux_deploy import metrics
+from contextlib import contextmanager
+from typing import Iterator
+import shutil
+import os
+
+VARIANTS = ("Standard", "Fixed")
+FICLONE: int = 0x40049409  # from linux/fs.h
+MB: int = 1024 * 1024
+
+
+def variant(name: str) -> str:
+    for known in VARIANTS:
+        if known.lower() == name.lower():
+            return known
+    raise BaseStageException(f"Unknown disk variant '{name}', use one of: {', '.join(VARIANTS)}.")
+
+
+def template_path(size: int, disk_variant: str) -> str:
+    return os.path.join(DISK_TEMPLATE_DIR, f"blank-{size}M-{variant(disk_variant).lower()}.vdi")
+
+
+def _existing_parent(path: str) -> str:
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def free_space(path: str = VBOX_VMS_LOCATION) -> int:
+    return shutil.disk_usage(_existing_parent(path)).free
+
+
+def required_space(spec: VMSpec, template_cached: bool) -> int:
+    # a fixed disk takes its whole size up front, and so does its template the first time; a dynamic one starts
+    # out at a few megabytes and grows, which is checked separately because it only fails later
+    if variant(spec.hdd_variant) == "Fixed":
+        return spec.hdd_size * MB * (1 if template_cached else 2)
+    return 16 * MB
+
+
+def check_space(spec: VMSpec):
+    free: int = free_space()
+    needed: int = required_space(spec, os.path.exists(template_path(spec.hdd_size, spec.hdd_variant))) + DISK_SPACE_RESERVE * MB
+    if free < needed:
+        raise BaseStageException(
+            f"There isn't enough free space on '{VBOX_VMS_LOCATION}' for the disk of {spec.name}.\n"
+            f"Needed: {needed // MB} MB ({spec.hdd_size} MB {variant(spec.hdd_variant)} disk, {DISK_SPACE_RESERVE} MB kept free)\n"
+            f"Free: {free // MB} MB\n"
+            f"Free up some space, choose a smaller ALD_VM_HDD_SIZE or a Standard (dynamically allocated) disk."
+        )
+    if variant(spec.hdd_variant) == "Standard" and free < spec.hdd_size * MB:
+        print(f"[yellow]Only {free // MB} MB are free on '{VBOX_VMS_LOCATION}', the {spec.hdd_size} MB disk can't grow to its full size.")
+
+
+@contextmanager
+def _locked(path: str) -> Iterator[None]:
+    # fleet workers provisioning VMs of the same size mustn't create the same template twice
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def template(vboxmanage: str, size: int, disk_variant: str) -> str:
+    path: str = template_path(size, disk_variant)
+    os.makedirs(DISK_TEMPLATE_DIR, exist_ok=True)
+    with _locked(path):
+        if os.path.exists(path):
+            metrics.cache_hit("disk_template")
+            return path
+        metrics.cache_miss("disk_template")
+        print(f"[blue]Creating the blank {size} MB {variant(disk_variant)} disk template, this happens once per size and variant.")
+        partial_path: str = f"{path}.part.vdi"  # createmedium picks the format from the extension
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        sp_call([vboxmanage, "createmedium", "disk", "--filename", partial_path, "--size", str(size), "--format", "VDI",
+                 "--variant", variant(disk_variant)])
+        # createmedium registers the disk, a template has to stay out of VirtualBox's media registry
+        sp_call([vboxmanage, "closemedium", "disk", partial_path])
+        os.replace(partial_path, path)
+    return path
+
+
+def _reflink(source: int, destination: int) -> bool:
+    try:
+        import fcntl
+        fcntl.ioctl(destination, FICLONE, source)
+        return True
+    except (ImportError, OSError):
+        return False
+
+
+def _copy_file_range(source: int, destination: int, length: int) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    offset: int = 0
+    try:
+        while offset < length:
+            copied: int = os.copy_file_range(source, destination, length - offset, offset, offset)
+            if copied == 0:
+                break
+            offset += copied
+    except OSError:
+        if offset == 0:
+            return False  # e.g. across filesystems on older kernels, nothing written yet so a plain copy can take over
+        raise
+    return offset == length
+
+
+def clone_file(source_path: str, destination_path: str) -> str:
+    # returns how the copy was made
+    length: int = os.path.getsize(source_path)
+    with open(source_path, "rb") as source, open(destination_path, "wb") as destination:
+        if _reflink(source.fileno(), destination.fileno()):
+            return "reflink"
+        if _copy_file_range(source.fileno(), destination.fileno(), length):
+            return "copy_file_range"
+        destination.seek(0)
+        destination.truncate()
+        shutil.copyfileobj(source, destination, 16 * MB)
+        return "copy"
+
+
+def provision(vboxmanage: str, spec: VMSpec) -> str:
+    check_space(spec)
+    source: str = template(vboxmanage, spec.hdd_size, spec.hdd_variant)
+    os.makedirs(os.path.dirname(spec.disk_path), exist_ok=True)
+    partial_path: str = f"{os.path.splitext(spec.disk_path)[0]}.part.vdi"
+    try:
+        try:
+            method: str = clone_file(source, partial_path)
+        except OSError as error:
+            raise BaseStageException(f"Couldn't copy the disk template '{source}' to '{partial_path}':\n{error}") from None
+        sp_call([vboxmanage, "internalcommands", "sethduuid", partial_path])
+    except BaseException:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        raise
+    os.replace(partial_path, spec.disk_path)
+    return method
@@ -0,0 +1,300 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import DOWNLOAD_WORKERS, DOWNLOAD_SEGMENT_SIZE, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_RETRIES, DOWNLOAD_HASH_BUFFER, HTTP_TIMEOUT
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy.utils import print
+from archlinux_deploy import metrics, utils
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+from requests.adapters import HTTPAdapter
+import threading
+import requests
+import hashlib
+import json
+import time
+import os
+
+
+class Segment(NamedTuple):
+    start: int
+    end: int  # inclusive, like the http range header
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start + 1
+
+
+def create_session(workers: int = DOWNLOAD_WORKERS) -> requests.Session:
+    session: requests.Session = requests.Session()
+    adapter: HTTPAdapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def split_segments(length: int, segment_size: int = DOWNLOAD_SEGMENT_SIZE) -> List[Segment]:
+    return [Segment(start, min(start + segment_size, length) - 1) for start in range(0, length, segment_size)]
+
+
+def probe(session: requests.Session, url: str) -> Tuple[Optional[int], bool]:
+    response: requests.Response = session.head(url, allow_redirects=True, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    length: Optional[int] = int(response.headers["Content-Length"]) if "Content-Length" in response.headers else None
+    accepts_ranges: bool = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return length, accepts_ranges and bool(length)
+
+
+class Journal:
+    # keyed on the file's name rather than its url, so a download started on one mirror resumes on another.
+    # source is where the bytes outside the fetched ranges come from (e.g. the previous ISO of a delta update),
+    # empty when every range is fetched
+    def __init__(self, path: str, name: str, length: int, segment_size: int, source: str = ""):
+        self.path = path
+        self.name = name
+        self.length = length
+        self.segment_size = segment_size
+        self.source = source
+        self.completed: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def load(self) -> "Journal":
+        try:
+            with open(self.path, "r") as journal:
+                data = json.load(journal)
+        except (OSError, ValueError):
+            return self
+        # a journal for another file (or another segmentation) is useless, start over
+        if (data.get("name"), data.get("length"), data.get("segment_size"), data.get("source", "")) == \
+                (self.name, self.length, self.segment_size, self.source):
+            self.completed = set(data.get("completed", []))
+        return self
+
+    def mark(self, segment: Segment):
+        with self._lock:
+            self.completed.add(segment.start)
+            utils.write_json(self.path, {
+                "name": self.name,
+                "length": self.length,
+                "segment_size": self.segment_size,
+                "source": self.source,
+                "completed": sorted(self.completed)
+            })
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class StreamingHasher:
+    # hashes bytes in file order while segments arrive out of order; anything that doesn't fit in the buffer is
+    # read back from disk by finish(), which is also how segments from an earlier, resumed run get hashed
+    def __init__(self, algorithm: str = "sha256", buffer_limit: int = DOWNLOAD_HASH_BUFFER):
+        self._hash = hashlib.new(algorithm)
+        self._buffer_limit = buffer_limit
+        self._pending: Dict[int, bytes] = {}
+        self._buffered: int = 0
+        self._lock = threading.Lock()
+        self.position: int = 0
+
+    def feed(self, offset: int, data: bytes):
+        with self._lock:
+            if offset == self.position:
+                self._update(data)
+                self._drain()
+            elif offset > self.position and self._buffered + len(data) <= self._buffer_limit:
+                # a retried segment can feed the same offset twice
+                self._buffered += len(data) - len(self._pending.get(offset, b""))
+                self._pending[offset] = data
+
+    def _update(self, data: bytes):
+        self._hash.update(data)
+        self.position += len(data)
+
+    def _drain(self):
+        while self.position in self._pending:
+            data: bytes = self._pending.pop(self.position)
+            self._buffered -= len(data)
+            self._update(data)
+
+    def finish(self, path: str) -> str:
+        with self._lock, open(path, "rb") as file:
+            file.seek(self.position)
+            while True:
+                self._drain()
+                upcoming: List[int] = [offset for offset in self._pending if offset > self.position]
+                to_read: int = min([DOWNLOAD_CHUNK_SIZE] + [offset - self.position for offset in upcoming])
+                file.seek(self.position)
+                data: bytes = file.read(to_read)
+                if not data:
+                    break
+                self._update(data)
+            self._pending.clear()
+            self._buffered = 0
+            return self._hash.hexdigest()
+
+
+def preallocate(path: str, length: int):
+    with open(path, "ab") as file:
+        if os.fstat(file.fileno()).st_size == length:
+            return
+        if hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(file.fileno(), 0, length)
+            except OSError:  # not every filesystem supports fallocate
+                file.truncate(length)
+        else:
+            file.truncate(length)
+
+
+class _PositionalWriter:
+    def __init__(self, path: str):
+        self._file = open(path, "r+b")
+        self._lock = threading.Lock()
+
+    def write(self, offset: int, data: bytes):
+        if hasattr(os, "pwrite"):
+            os.pwrite(self._file.fileno(), data, offset)
+            return
+        with self._lock:
+            self._file.seek(offset)
+            self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+
+def _fetch_segment(session: requests.Session, url: str, segment: Segment, writer: _PositionalWriter,
+                   on_data: Optional[Callable[[int, bytes], None]]):
+    last_error: Optional[Exception] = None
+    for _ in range(DOWNLOAD_RETRIES):
+        try:
+            response: requests.Response = session.get(url, headers={"Range": f"bytes={segment.start}-{segment.end}"}, stream=True,
+                                                     timeout=HTTP_TIMEOUT)
+            if response.status_code != 206:
+                raise BaseStageException(f"Expected a partial response (206) for range {segment.start}-{segment.end}, got {response.status_code}.")
+            offset: int = segment.start
+            for data in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                writer.write(offset, data)
+                if on_data is not None:
+                    on_data(offset, data)
+                offset += len(data)
+            if offset != segment.end + 1:
+                raise BaseStageException(f"Range {segment.start}-{segment.end} ended early at byte {offset}.")
+            return
+        except (requests.RequestException, BaseStageException) as error:
+            last_error = error
+    raise BaseStageException(
+        f"Couldn't download range {segment.start}-{segment.end} of '{url}' after {DOWNLOAD_RETRIES} attempts.\n"
+        f"Last error: {last_error}"
+    )
+
+
+def _journal_if_successful(journal: Journal, future: Future, segment: Segment):
+    if not future.cancelled() and future.exception() is None:
+        journal.mark(segment)
+
+
+def _download_single_stream(session: requests.Session, url: str, partial_path: str,
+                            on_data: Optional[Callable[[int, bytes], None]]):
+    response: requests.Response = session.get(url, stream=True, timeout=HTTP_TIMEOUT)
+    response.raise_for_status()
+    offset: int = 0
+    with open(partial_path, "wb") as file:
+        for data in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            file.write(data)
+            if on_data is not None:
+                on_data(offset, data)
+            offset += len(data)
+
+
+class ByteCounter:
+    # counts what actually came over the network, retried chunks included
+    def __init__(self, on_data: Optional[Callable[[int, bytes], None]]):
+        self.count: int = 0
+        self._on_data: Optional[Callable[[int, bytes], None]] = on_data
+        self._lock = threading.Lock()
+
+    def __call__(self, offset: int, data: bytes):
+        with self._lock:
+            self.count += len(data)
+        if self._on_data is not None:
+            self._on_data(offset, data)
+
+
+def download(url: str, destination: str, workers: int = DOWNLOAD_WORKERS, segment_size: int = DOWNLOAD_SEGMENT_SIZE,
+             on_data: Optional[Callable[[int, bytes], None]] = None):
+    counter: ByteCounter = ByteCounter(on_data)
+    started: float = time.perf_counter()
+    try:
+        _download(url, destination, workers, segment_size, counter)
+    finally:
+        metrics.record_download(url, counter.count, time.perf_counter() - started)
+
+
+def _download(url: str, destination: str, workers: int, segment_size: int, on_data: Callable[[int, bytes], None]):
+    # the file only appears under its real name once every byte is on disk, so a destination that exists is complete
+    partial_path: str = f"{destination}.part"
+    session: requests.Session = create_session(workers)
+    try:
+        length, accepts_ranges = probe(session, url)
+    except requests.RequestException as error:
+        raise BaseStageException(f"Couldn't reach '{url}':\n{error}") from None
+
+    if not accepts_ranges:
+        print("[yellow]Server doesn't support range requests, downloading over a single connection.")
+        try:
+            _download_single_stream(session, url, partial_path, on_data)
+        except requests.RequestException as error:
+            raise BaseStageException(f"Couldn't download '{url}':\n{error}") from None
+        os.replace(partial_path, destination)
+        return
+
+    assert length is not None
+    journal: Journal = Journal(f"{partial_path}.json", url.rsplit("/", 1)[-1], length, segment_size).load()
+    fetch_ranges(session, url, partial_path, journal, split_segments(length, segment_size), workers, on_data)
+    os.replace(partial_path, destination)
+    journal.remove()
+
+
+def fetch_ranges(session: requests.Session, url: str, partial_path: str, journal: Journal, segments: List[Segment],
+                 workers: int = DOWNLOAD_WORKERS, on_data: Optional[Callable[[int, bytes], None]] = None):
+    # fetches the segments the journal doesn't have yet into the (preallocated) partial file, in parallel
+    if not os.path.exists(partial_path):
+        journal.completed.clear()
+    segments = [segment for segment in segments if segment.start not in journal.completed]
+    if journal.completed:
+        print(f"[blue]Resuming download, {len(segments)} segment(s) left.")
+    print(f"[blue]Downloading {len(segments)} segment(s) over {workers} connection(s).")
+
+    preallocate(partial_path, journal.length)
+    writer: _PositionalWriter = _PositionalWriter(partial_path)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for segment in segments:
+                future = executor.submit(_fetch_segment, session, url, segment, writer, on_data)
+                # journal from the callback so segments that finish while another one fails still count on resume
+                future.add_done_callback(lambda done, segment=segment: _journal_if_successful(journal, done, segment))
+                futures.append(future)
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except BaseStageException:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+    finally:
+        writer.close()
@@ -0,0 +1,176 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import FLEET_FILE, FLEET_TEMPLATE, FLEET_COUNT, FLEET_WORKERS, LOG_DIR, GOLDEN, VM_IGNORE_DUPLICATES
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy.spec import VMSpec
+from archlinux_deploy import metrics, utils
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING, Dict, List, NamedTuple, Optional, Set, Tuple
+import multiprocessing
+import json
+import os
+
+if TYPE_CHECKING:
+    from archlinux_deploy.golden import Base
+
+
+class FleetResult(NamedTuple):
+    name: str
+    succeeded: bool
+    log_path: str
+    error: str = ""
+    metrics: Optional[dict] = None  # what the worker process recorded, merged into the run report
+
+
+def specs_from_template(template: str, count: int, **overrides) -> List[VMSpec]:
+    return [VMSpec(name=template.format(index=index), **overrides) for index in range(1, count + 1)]
+
+
+def load_specs(fleet_file: str = FLEET_FILE, template: str = FLEET_TEMPLATE, count: int = FLEET_COUNT) -> List[VMSpec]:
+    # the fleet file is either a list of {"name", "memory", "vram", "hdd_size", "hdd_variant", "cpus"} objects, or a
+    # {"template": "ci-{index}", "count": N, ...} object whose other keys apply to every VM
+    if not fleet_file:
+        return specs_from_template(template, count)
+    try:
+        with open(fleet_file, "r") as fleet:
+            data = json.load(fleet)
+        if isinstance(data, dict):
+            overrides = {key: value for key, value in data.items() if key not in ("template", "count")}
+            specs: List[VMSpec] = specs_from_template(data.get("template", template), data.get("count", count), **overrides)
+        else:
+            specs = [VMSpec(**entry) for entry in data]
+    except (OSError, ValueError, TypeError) as error:
+        raise BaseStageException(f"Couldn't read the fleet file '{fleet_file}':\n{error}") from None
+
+    names: List[str] = [spec.name for spec in specs]
+    duplicates: List[str] = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise BaseStageException(f"The fleet has more than one VM named {', '.join(duplicates)}.")
+    return specs
+
+
+def _log_path(spec: VMSpec) -> str:
+    return os.path.join(LOG_DIR, f"{spec.name}.log")
+
+
+def provision(spec: VMSpec, base: Optional["Base"] = None, reconcile: bool = False) -> FleetResult:
+    # runs in a worker process, so a crash or a failed substage only takes down this VM. reconcile is for a retry
+    # after a worker died, the VM may be half made: it's taken over (or, as a clone, made again) instead of refused
+    from archlinux_deploy.stages import vm_adapt
+    from archlinux_deploy import golden
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_path: str = _log_path(spec)
+    metrics.reset()
+    with utils.output_context(spec.name, log_path):
+        try:
+            if base is not None:
+                golden.clone(spec, base, replace=reconcile)
+                succeeded: bool = True
+            else:
+                # the whole fleet was admitted up front
+                succeeded = vm_adapt.run(spec, admit=False, ignore_duplicates=reconcile or VM_IGNORE_DUPLICATES)
+        except BaseStageException as error:
+            utils.colored_output(f"Provisioning {spec.name} FAILED:\n{error.args[0]}", "error")
+            return FleetResult(spec.name, False, log_path, error.args[0].splitlines()[0], metrics.snapshot())
+        except Exception as error:  # the virtualbox module raises plain exceptions
+            utils.colored_output(f"Provisioning {spec.name} crashed: {error!r}", "error")
+            return FleetResult(spec.name, False, log_path, repr(error), metrics.snapshot())
+    return FleetResult(spec.name, succeeded, log_path, "" if succeeded else "a stage 2 substage failed", metrics.snapshot())
+
+
+def provision_all(specs: List[VMSpec], bases: List[Optional["Base"]], workers: int) -> List[FleetResult]:
+    # a worker that dies (e.g. in the VirtualBox bindings) breaks the whole pool and takes the VMs of the other workers
+    # down with it, so whatever didn't finish is retried one VM per process; the one that dies again only fails itself.
+    # the retries reconcile what the killed workers left behind, but never a VM that was there before the fleet.
+    # workers are spawned, not forked: the parent may hold an XPCOM connection from building the golden bases
+    from archlinux_deploy import golden
+    existing: Set[str] = set(golden.registered_vms())
+    context = multiprocessing.get_context("spawn")
+    results: Dict[str, FleetResult] = {}
+    with ProcessPoolExecutor(max_workers=min(workers, len(specs)), mp_context=context) as executor:
+        futures: Dict[str, Future] = {spec.name: executor.submit(provision, spec, base) for spec, base in zip(specs, bases)}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except BrokenProcessPool:
+                pass
+    interrupted: List[Tuple[VMSpec, Optional["Base"]]] = [(spec, base) for spec, base in zip(specs, bases) if spec.name not in results]
+    if interrupted:
+        utils.colored_output(f"A worker process died, retrying {len(interrupted)} VM(s) one at a time.", "warn")
+    for spec, base in interrupted:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            try:
+                results[spec.name] = executor.submit(provision, spec, base, spec.name not in existing).result()
+            except BrokenProcessPool:
+                results[spec.name] = FleetResult(spec.name, False, _log_path(spec), "its worker process died")
+    return [results[spec.name] for spec in specs]
+
+
+def run(specs: Optional[List[VMSpec]] = None, workers: int = FLEET_WORKERS, use_golden: bool = GOLDEN) -> bool:
+    try:
+        specs = specs if specs is not None else load_specs()
+    except BaseStageException as error:
+        utils.colored_output(error.args[0], "error")
+        return False
+    if not specs:
+        utils.colored_output("The fleet is empty. Set ALD_FLEET_COUNT or ALD_FLEET_FILE.", "error")
+        return False
+
+    from archlinux_deploy.stages import vm_adapt
+    from archlinux_deploy import admission
+    try:
+        # all at once, so every VM counts against the next one instead of each worker seeing the same free host
+        specs, refused = admission.admit_all(vm_adapt.vbox_manage_command(), specs, linked=use_golden)
+    except BaseStageException as error:
+        utils.colored_output(error.args[0], "error")
+        return False
+    refused_results: List[FleetResult] = [
+        FleetResult(decision.spec.name, False, "", "the host can't take it without overcommitting") for decision in refused
+    ]
+    if not specs:
+        utils.colored_output("The host can't take any VM of the fleet, see the report above.", "error")
+        return False
+
+    bases: List[Optional["Base"]] = [None] * len(specs)
+    if use_golden:
+        from archlinux_deploy import golden
+        try:
+            # the bases are shared by the fleet, so they're built up front instead of racing in the workers;
+            # VMs with different disks can't share one, each disk layout gets its own
+            bases = list(golden.rebuild_all(specs))
+        except BaseStageException as error:
+            utils.colored_output(f"Building the base VM FAILED:\n{error.args[0]}", "error")
+            return False
+
+    utils.colored_output(f"Provisioning {len(specs)} VM(s) with {min(workers, len(specs))} worker(s).", "info")
+    results: List[FleetResult] = provision_all(specs, bases, workers) + refused_results
+
+    for result in results:
+        if result.metrics is not None:
+            metrics.merge(result.metrics, vm=result.name)
+        if result.succeeded:
+            utils.colored_output(f"{result.name}: provisioned (log: {result.log_path})", "success")
+        elif not result.log_path:
+            utils.colored_output(f"{result.name}: not provisioned, {result.error}", "error")
+        else:
+            utils.colored_output(f"{result.name}: FAILED, {result.error} (log: {result.log_path})", "error")
+    failed: int = len([result for result in results if not result.succeeded])
+    utils.colored_output(
+        f"Fleet completed, {len(results) - failed} of {len(results)} VM(s) provisioned.",
+        "success" if not failed else "warn"
+    )
+    return not failed
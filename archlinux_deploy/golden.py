@@ -0,0 +1,218 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import CACHE_DIR, GOLDEN_NAME, GOLDEN_SNAPSHOT
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy.spec import VMSpec
+from archlinux_deploy.state import parse_vm_list
+from archlinux_deploy.utils import print
+from archlinux_deploy import utils, iso_cache
+from typing import Dict, List, NamedTuple, Optional
+import hashlib
+import json
+import re
+import os
+
+GOLDEN_STATE_FILE: str = os.path.join(CACHE_DIR, "golden.json")
+BASE_EXTRADATA_KEY: str = "archlinux-deploy/base"
+FINGERPRINT_EXTRADATA_KEY: str = "archlinux-deploy/base-fingerprint"
+LAYOUT_EXTRADATA_KEY: str = "archlinux-deploy/layout"
+
+
+class Base(NamedTuple):
+    name: str
+    fingerprint: str
+    iso: str = ""  # the sha256 of the ISO it was built from
+
+
+def _layout(spec: VMSpec) -> Dict[str, object]:
+    # only what a clone can't change on its own; memory, vram and cpus are set per clone
+    layout: Dict[str, object] = {"hdd_size": spec.hdd_size}
+    if spec.hdd_variant.lower() != "standard":
+        layout["hdd_variant"] = spec.hdd_variant.lower()  # left out for Standard disks, so existing bases stay current
+    return layout
+
+
+def fingerprint(spec: VMSpec, iso: iso_cache.CachedIso) -> str:
+    identity: Dict[str, object] = dict(_layout(spec), iso=iso.sha256)
+    return hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _vboxmanage(*arguments: str) -> str:
+    # stage 2 (and with it asyncio, the scheduler and the VirtualBox bindings) is only loaded once something has to
+    # be run, `status` just reads golden.json
+    from archlinux_deploy.stages.vm_adapt import vbox_manage_command
+    from archlinux_deploy.runner import sp_run
+    return sp_run([vbox_manage_command(), *arguments])[1]
+
+
+def registered_vms() -> List[str]:
+    return parse_vm_list(_vboxmanage("list", "vms"))
+
+
+def get_extradata(vm_name: str, key: str) -> Optional[str]:
+    match = re.match(r"Value: (.*)", _vboxmanage("getextradata", vm_name, key).strip())
+    return match.group(1) if match else None
+
+
+def set_extradata(vm_name: str, key: str, value: str):
+    _vboxmanage("setextradata", vm_name, key, value)
+
+
+def current_bases(iso: Optional[str] = None) -> Dict[str, Base]:
+    # by fingerprint, one per disk layout; only those built from the ISO with the given sha256 when there's one
+    try:
+        with open(GOLDEN_STATE_FILE, "r") as state:
+            data = json.load(state)
+        bases: List[Base] = [Base(**base) for base in data["bases"]] if "bases" in data else [Base(**data)]
+    except (OSError, ValueError, TypeError, KeyError):
+        return {}
+    return {base.fingerprint: base for base in bases if iso is None or base.iso == iso}
+
+
+def _save_base(base: Base):
+    # the bases of an older ISO are forgotten, their clones are stale either way
+    bases: Dict[str, Base] = current_bases(base.iso)
+    bases[base.fingerprint] = base
+    utils.write_json(GOLDEN_STATE_FILE, {"bases": [base._asdict() for base in bases.values()]})
+
+
+def _current_iso() -> iso_cache.CachedIso:
+    iso: Optional[iso_cache.CachedIso] = iso_cache.current()
+    if iso is None:
+        raise BaseStageException("There's no verified Arch Linux ISO in the cache. Run stage 1 first.")
+    return iso
+
+
+def _has_clones(base_name: str) -> bool:
+    return any(base.name == base_name for base in clones().values())
+
+
+def rebuild(spec: Optional[VMSpec] = None, force: bool = False) -> Base:
+    from archlinux_deploy.stages import vm_adapt
+    spec = spec or VMSpec()
+    iso: iso_cache.CachedIso = _current_iso()
+    wanted: str = fingerprint(spec, iso)
+    registered: List[str] = registered_vms()
+    base: Optional[Base] = current_bases(iso.sha256).get(wanted)
+    if not force and base is not None and base.name in registered:
+        print(f"[blue]Base VM {base.name} is up to date.")
+        return base
+
+    # every base gets its own name, older bases stay around for as long as their linked clones need them; a forced
+    # rebuild of a layout whose base still has clones gets the next generation instead of deleting it under them
+    base = Base(f"{GOLDEN_NAME}-{wanted[:12]}", wanted, iso.sha256)
+    generation: int = 1
+    while base.name in registered:
+        # the fingerprint is only set once the snapshot is taken, so a base that has it is complete
+        if not force and get_extradata(base.name, FINGERPRINT_EXTRADATA_KEY) == wanted:
+            print(f"[blue]Base VM {base.name} is up to date.")
+            _save_base(base)
+            return base
+        if not _has_clones(base.name):
+            _vboxmanage("unregistervm", base.name, "--delete")
+            break
+        generation += 1
+        base = base._replace(name=f"{GOLDEN_NAME}-{wanted[:12]}-{generation}")
+    print(f"[blue]Building base VM {base.name}.")
+    # the base is only cloned, never started, so it isn't admitted against the host like the VMs themselves
+    if not vm_adapt.run(spec._replace(name=base.name), dry_run=False, admit=False):
+        raise BaseStageException(f"Couldn't build base VM {base.name}, see the stage 2 output above.")
+    _vboxmanage("snapshot", base.name, "take", GOLDEN_SNAPSHOT)
+    set_extradata(base.name, FINGERPRINT_EXTRADATA_KEY, base.fingerprint)
+    _save_base(base)
+    print(f"[green]Base VM {base.name} is ready.")
+    return base
+
+
+def rebuild_all(specs: List[VMSpec], force: bool = False) -> List[Base]:
+    # one base per disk layout (see fingerprint), each built once; returns the base every spec is cloned from
+    iso: iso_cache.CachedIso = _current_iso()
+    bases: Dict[str, Base] = {}
+    for spec in specs:
+        wanted: str = fingerprint(spec, iso)
+        if wanted not in bases:
+            bases[wanted] = rebuild(spec, force)
+    return [bases[fingerprint(spec, iso)] for spec in specs]
+
+
+def clone(spec: VMSpec, base: Optional[Base] = None, replace: bool = False):
+    # replace is for a clone left half-made by a crashed run, it's deleted and made again
+    if base is None:
+        iso: iso_cache.CachedIso = _current_iso()
+        base = current_bases(iso.sha256).get(fingerprint(spec, iso))
+    if base is None:
+        raise BaseStageException(f"There's no base VM for a {spec.hdd_size} MB {spec.hdd_variant} disk yet. Build one first.")
+    if spec.name in registered_vms():
+        if not replace:
+            raise BaseStageException(f"There's already a VM named {spec.name}, refusing to clone over it.")
+        print(f"[yellow]Deleting the unfinished clone {spec.name} to make it again.")
+        _vboxmanage("unregistervm", spec.name, "--delete")
+    print(f"[blue]Creating linked clone {spec.name} of {base.name}.")
+    _vboxmanage("clonevm", base.name, "--snapshot", GOLDEN_SNAPSHOT, "--options", "link", "--name", spec.name, "--register")
+    _vboxmanage("modifyvm", spec.name, "--memory", str(spec.memory), "--vram", str(spec.vram),
+             "--cpus", str(spec.cpus))
+    set_extradata(spec.name, LAYOUT_EXTRADATA_KEY, json.dumps({"hdd_size": spec.hdd_size, "hdd_variant": spec.hdd_variant}))
+    set_extradata(spec.name, BASE_EXTRADATA_KEY, base.name)
+    set_extradata(spec.name, FINGERPRINT_EXTRADATA_KEY, base.fingerprint)
+    print("[green]Operation successful.")
+
+
+def clones() -> Dict[str, Base]:
+    found: Dict[str, Base] = {}
+    for vm_name in registered_vms():
+        base_name: Optional[str] = get_extradata(vm_name, BASE_EXTRADATA_KEY)
+        if base_name is not None:
+            found[vm_name] = Base(base_name, get_extradata(vm_name, FINGERPRINT_EXTRADATA_KEY) or "")
+    return found
+
+
+def _clone_spec(vm_name: str, default: VMSpec) -> VMSpec:
+    # clones made before the layout was recorded are taken to have the default one
+    try:
+        layout: dict = json.loads(get_extradata(vm_name, LAYOUT_EXTRADATA_KEY) or "{}")
+    except ValueError:
+        layout = {}
+    return default._replace(**{key: layout[key] for key in ("hdd_size", "hdd_variant") if key in layout})
+
+
+def stale_clones(spec: Optional[VMSpec] = None) -> List[str]:
+    # a clone is stale once its base isn't the current one for its own disk layout, either because the ISO changed
+    # or because the base was rebuilt since
+    iso: iso_cache.CachedIso = _current_iso()
+    bases: Dict[str, Base] = current_bases(iso.sha256)
+    stale: List[str] = []
+    for name, base in clones().items():
+        wanted: str = fingerprint(_clone_spec(name, spec or VMSpec()), iso)
+        if base.fingerprint != wanted or (wanted in bases and base.name != bases[wanted].name):
+            stale.append(name)
+    return sorted(stale)
+
+
+def run(spec: Optional[VMSpec] = None, admit: bool = True) -> bool:
+    # a single VM as a linked clone; the ISO has to be in the cache already
+    from archlinux_deploy.stages import vm_adapt
+    spec = spec or VMSpec()
+    if admit:
+        spec = vm_adapt.admitted(spec, dry_run=False, linked=True)
+        if spec is None:
+            return False
+    try:
+        clone(spec, rebuild(spec))
+    except BaseStageException as error:
+        utils.colored_output(f"Linked clone {spec.name} FAILED:\n{error.args[0]}", "error")
+        return False
+    utils.colored_output(f"Linked clone {spec.name} completed!", "success")
+    return True
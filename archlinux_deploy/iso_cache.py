@@ -0,0 +1,138 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import CACHE_DIR, DELTA_UPDATES, HTTP_TIMEOUT
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy.utils import print
+from archlinux_deploy import metrics, utils
+from typing import Dict, NamedTuple, Optional
+import json
+import re
+import os
+
+ISO_CACHE_DIR: str = os.path.join(CACHE_DIR, "isos")
+CURRENT_ISO_FILE: str = os.path.join(ISO_CACHE_DIR, "current.json")
+
+
+class CachedIso(NamedTuple):
+    version: str
+    sha256: str
+    path: str
+
+
+def release_version(iso_name: str) -> str:
+    match = re.match(r"archlinux-(\d{4}\.\d{2}\.\d{2})", iso_name)
+    if match is None:
+        raise BaseStageException(f"Couldn't tell the release version of '{iso_name}'.")
+    return match.group(1)
+
+
+def fetch_checksums(sha256sums_url: str) -> Dict[str, str]:
+    import requests  # stage 2 only needs current(), so the http stack is loaded when something is fetched
+    try:
+        response: requests.Response = requests.get(sha256sums_url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as error:
+        raise BaseStageException(f"Couldn't download the checksums from '{sha256sums_url}':\n{error}") from None
+    checksums: Dict[str, str] = {}
+    for line in response.text.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            checksum, file_name = parts
+            checksums[file_name.lstrip("*")] = checksum.lower()
+    return checksums
+
+
+def cache_path(version: str, sha256: str, iso_name: str) -> str:
+    return os.path.join(ISO_CACHE_DIR, version, sha256, iso_name)
+
+
+def _digest_path(path: str) -> str:
+    return f"{path}.sha256"
+
+
+def is_verified(path: str, sha256: str) -> bool:
+    # trusts the digest recorded when the file was verified instead of re-reading the whole image;
+    # the size check catches a file that was truncated or replaced behind our back
+    try:
+        with open(_digest_path(path), "r") as digest_file:
+            recorded = json.load(digest_file)
+    except (OSError, ValueError):
+        return False
+    return recorded.get("sha256") == sha256 and os.path.isfile(path) and os.path.getsize(path) == recorded.get("size")
+
+
+def _record_digest(path: str, sha256: str):
+    utils.write_json(_digest_path(path), {"sha256": sha256, "size": os.path.getsize(path)})
+
+
+def set_current(iso: CachedIso):
+    utils.write_json(CURRENT_ISO_FILE, iso._asdict())
+
+
+def current() -> Optional[CachedIso]:
+    try:
+        with open(CURRENT_ISO_FILE, "r") as current_file:
+            iso: CachedIso = CachedIso(**json.load(current_file))
+    except (OSError, ValueError, TypeError):
+        return None
+    return iso if is_verified(iso.path, iso.sha256) else None
+
+
+def _update_from_previous(iso_url: str, iso: CachedIso) -> bool:
+    previous: Optional[CachedIso] = current()
+    if not DELTA_UPDATES or previous is None or previous.sha256 == iso.sha256:
+        return False
+    from archlinux_deploy import delta
+    try:
+        return delta.update(previous.path, iso_url, iso.path, iso.sha256)
+    except (BaseStageException, OSError) as error:  # e.g. the previous ISO went missing or can't be read
+        reason: str = error.args[0] if isinstance(error, BaseStageException) else str(error)
+        print(f"[yellow]Updating from {previous.version} didn't work, downloading the whole ISO instead:\n{reason}")
+        return False
+
+
+def fetch(iso_url: str, sha256: str) -> CachedIso:
+    from archlinux_deploy import download
+    iso_name: str = iso_url.rsplit("/", 1)[-1]
+    iso: CachedIso = CachedIso(release_version(iso_name), sha256, cache_path(release_version(iso_name), sha256, iso_name))
+    if is_verified(iso.path, iso.sha256):
+        metrics.cache_hit("iso")
+        print(f"[blue]ISO {iso_name} is already cached and verified, continuing...")
+        set_current(iso)
+        return iso
+
+    metrics.cache_miss("iso")
+    os.makedirs(os.path.dirname(iso.path), exist_ok=True)
+    if _update_from_previous(iso_url, iso):
+        _record_digest(iso.path, sha256)
+        print("[green]ISO checksum verified.")
+        set_current(iso)
+        return iso
+    hasher: download.StreamingHasher = download.StreamingHasher("sha256")
+    download.download(iso_url, iso.path, on_data=hasher.feed)
+    actual: str = hasher.finish(iso.path)
+    if actual != sha256:
+        os.remove(iso.path)
+        raise BaseStageException(
+            f"Checksum of the downloaded ISO doesn't match the mirror's sha256sums.txt.\n"
+            f"Expected: {sha256}\n"
+            f"Got: {actual}\n"
+            f"The corrupt download has been removed, run the stage again to retry."
+        )
+    _record_digest(iso.path, sha256)
+    print("[green]ISO checksum verified.")
+    set_current(iso)
+    return iso
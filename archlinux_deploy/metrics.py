@@ -0,0 +1,167 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import CACHE_DIR, REPORT_PATH, PROMETHEUS_PATH
+from archlinux_deploy import utils
+from typing import Dict, List, Optional
+import threading
+import socket
+import json
+import time
+import os
+
+LAST_REPORT_FILE: str = os.path.join(CACHE_DIR, "last-run.json")
+
+_lock = threading.Lock()
+_started_at: float = time.time()
+_started: float = time.perf_counter()
+_substages: List[dict] = []
+_commands: List[dict] = []
+_downloads: List[dict] = []
+_caches: Dict[str, Dict[str, int]] = {}
+
+
+def record_substage(name: str, stage: int, seconds: float, succeeded: bool, vm: str = ""):
+    entry: dict = {"name": name, "stage": stage, "seconds": seconds, "succeeded": succeeded}
+    if vm:
+        entry["vm"] = vm
+    with _lock:
+        _substages.append(entry)
+
+
+def record_command(command: List[str], spawn_seconds: float, run_seconds: float, return_code: Optional[int]):
+    # the subcommand (e.g. "modifyvm") is what tells slow calls apart, the executable's path doesn't
+    name: str = " ".join([os.path.basename(command[0])] + command[1:2]) if command else ""
+    with _lock:
+        _commands.append({"command": name, "spawn_seconds": spawn_seconds, "run_seconds": run_seconds, "return_code": return_code})
+
+
+def record_download(url: str, downloaded: int, seconds: float):
+    with _lock:
+        _downloads.append({"url": url, "bytes": downloaded, "seconds": seconds,
+                           "throughput": downloaded / seconds if seconds > 0 else 0.0})
+
+
+def _count_cache(cache: str, outcome: str):
+    with _lock:
+        counts: Dict[str, int] = _caches.setdefault(cache, {"hits": 0, "misses": 0})
+        counts[outcome] += 1
+
+
+def cache_hit(cache: str):
+    _count_cache(cache, "hits")
+
+
+def cache_miss(cache: str):
+    _count_cache(cache, "misses")
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "substages": list(_substages),
+            "commands": list(_commands),
+            "downloads": list(_downloads),
+            "caches": {cache: dict(counts) for cache, counts in _caches.items()},
+        }
+
+
+def merge(other: dict, **labels: str):
+    # folds in what a fleet worker process recorded, labelled with the vm it belongs to
+    with _lock:
+        _substages.extend(dict(entry, **labels) for entry in other.get("substages", []))
+        _commands.extend(dict(entry, **labels) for entry in other.get("commands", []))
+        _downloads.extend(dict(entry, **labels) for entry in other.get("downloads", []))
+        for cache, counts in other.get("caches", {}).items():
+            totals: Dict[str, int] = _caches.setdefault(cache, {"hits": 0, "misses": 0})
+            for outcome, count in counts.items():
+                totals[outcome] += count
+
+
+def reset():
+    # a fleet worker process handles several VMs, each of them reports only its own
+    with _lock:
+        _substages.clear()
+        _commands.clear()
+        _downloads.clear()
+        _caches.clear()
+
+
+def report(command: str = "", succeeded: bool = True) -> dict:
+    return dict(
+        snapshot(),
+        command=command,
+        succeeded=succeeded,
+        host=socket.gethostname(),
+        started_at=_started_at,
+        seconds=time.perf_counter() - _started,
+    )
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _sample(name: str, value: float, **labels: object) -> str:
+    rendered: str = ",".join(f'{key}="{_escape(label)}"' for key, label in sorted(labels.items()))
+    return f"{name}{{{rendered}}} {value}" if rendered else f"{name} {value}"
+
+
+def prometheus(run: dict) -> str:
+    metrics: Dict[str, List[str]] = {}
+
+    def add(name: str, kind: str, help_text: str, value: float, **labels: object):
+        if name not in metrics:
+            metrics[name] = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        metrics[name].append(_sample(name, value, **labels))
+
+    add("archlinux_deploy_run_seconds", "gauge", "Wall time of the whole run.", run["seconds"], command=run["command"])
+    add("archlinux_deploy_run_succeeded", "gauge", "1 if the run succeeded.", int(run["succeeded"]), command=run["command"])
+    # a series may appear only once in the file, so a substage that ran again (e.g. for a retried VM) is summed up
+    substage_seconds: Dict[tuple, float] = {}
+    for substage in run["substages"]:
+        labels = tuple(sorted(dict(
+            {key: substage[key] for key in substage if key not in ("seconds", "succeeded", "name")}, substage=substage["name"]
+        ).items()))
+        substage_seconds[labels] = substage_seconds.get(labels, 0.0) + substage["seconds"]
+    for labels, seconds in substage_seconds.items():
+        add("archlinux_deploy_substage_seconds", "gauge", "Wall time of each substage.", seconds, **dict(labels))
+    totals: Dict[str, List[float]] = {}
+    for command in run["commands"]:
+        total: List[float] = totals.setdefault(command["command"], [0, 0.0, 0.0])
+        total[0] += 1
+        total[1] += command["spawn_seconds"]
+        total[2] += command["run_seconds"]
+    for name, (count, spawn_seconds, run_seconds) in totals.items():
+        add("archlinux_deploy_commands_total", "counter", "Commands run.", count, command=name)
+        add("archlinux_deploy_command_spawn_seconds_total", "counter", "Time spent starting commands.", spawn_seconds, command=name)
+        add("archlinux_deploy_command_run_seconds_total", "counter", "Time spent waiting for commands.", run_seconds, command=name)
+    downloaded: int = sum(download["bytes"] for download in run["downloads"])
+    download_seconds: float = sum(download["seconds"] for download in run["downloads"])
+    add("archlinux_deploy_download_bytes_total", "counter", "Bytes downloaded.", downloaded)
+    add("archlinux_deploy_download_seconds_total", "counter", "Time spent downloading.", download_seconds)
+    for cache, counts in run["caches"].items():
+        add("archlinux_deploy_cache_hits_total", "counter", "Cache hits.", counts["hits"], cache=cache)
+        add("archlinux_deploy_cache_misses_total", "counter", "Cache misses.", counts["misses"], cache=cache)
+    return "\n".join(line for lines in metrics.values() for line in lines) + "\n"
+
+
+def write_reports(command: str, succeeded: bool, report_path: str = REPORT_PATH, prometheus_path: str = PROMETHEUS_PATH) -> str:
+    run: dict = report(command, succeeded)
+    report_path = report_path or LAST_REPORT_FILE
+    utils.write_atomically(report_path, json.dumps(run, indent=2))
+    if prometheus_path:
+        utils.write_atomically(prometheus_path, prometheus(run))  # the prometheus textfile collector must never see half a file
+    return report_path
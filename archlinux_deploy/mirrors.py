@@ -0,0 +1,149 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import CACHE_DIR, MIRRORS, MIRROR_TTL, MIRROR_PROBE_PATH, MIRROR_PROBE_BYTES, MIRROR_PROBE_TIMEOUT
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy.utils import print
+from archlinux_deploy import metrics, utils
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional, TypeVar
+import requests
+import json
+import time
+import os
+
+MIRROR_CACHE_FILE: str = os.path.join(CACHE_DIR, "mirrors.json")
+
+T = TypeVar("T")
+
+_ranked: Optional[List[str]] = None  # the healthy mirrors of this run, best first
+
+
+class ProbeResult(NamedTuple):
+    mirror: str
+    healthy: bool
+    time_to_first_byte: float  # seconds
+    throughput: float  # bytes per second
+    error: str = ""
+
+
+def probe(mirror: str, sample_size: int = MIRROR_PROBE_BYTES, timeout: float = MIRROR_PROBE_TIMEOUT) -> ProbeResult:
+    url: str = mirror + MIRROR_PROBE_PATH
+    started: float = time.perf_counter()
+    try:
+        with requests.get(url, headers={"Range": f"bytes=0-{sample_size - 1}"}, stream=True, timeout=timeout) as response:
+            if response.status_code not in (200, 206):
+                return ProbeResult(mirror, False, 0.0, 0.0, f"HTTP {response.status_code}")
+            received: int = 0
+            first_byte: Optional[float] = None
+            # a mirror that ignores the range header sends the whole file, so stop once the sample is in
+            for data in response.iter_content(chunk_size=16 * 1024):
+                if first_byte is None:
+                    first_byte = time.perf_counter()
+                received += len(data)
+                if received >= sample_size:
+                    break
+            finished: float = time.perf_counter()
+    except requests.RequestException as error:
+        return ProbeResult(mirror, False, 0.0, 0.0, str(error))
+    if first_byte is None:
+        return ProbeResult(mirror, False, 0.0, 0.0, "empty response")
+    return ProbeResult(mirror, True, first_byte - started, received / max(finished - first_byte, 1e-6))
+
+
+def rank(results: List[ProbeResult]) -> List[ProbeResult]:
+    # the ISO is hundreds of megabytes, so throughput decides and latency only breaks ties
+    return sorted(results, key=lambda result: (not result.healthy, -result.throughput, result.time_to_first_byte))
+
+
+def probe_all(mirrors: List[str] = MIRRORS) -> List[ProbeResult]:
+    with ThreadPoolExecutor(max_workers=max(len(mirrors), 1)) as executor:
+        return rank(list(executor.map(probe, mirrors)))
+
+
+def _load_ranking(mirrors: List[str]) -> Optional[List[ProbeResult]]:
+    try:
+        with open(MIRROR_CACHE_FILE, "r") as cache:
+            data = json.load(cache)
+    except (OSError, ValueError):
+        return None
+    if sorted(data.get("mirrors", [])) != sorted(mirrors) or time.time() - data.get("probed_at", 0) > MIRROR_TTL:
+        return None
+    return [ProbeResult(*result) for result in data.get("ranking", [])]
+
+
+def _save_ranking(mirrors: List[str], ranking: List[ProbeResult]):
+    utils.write_json(MIRROR_CACHE_FILE, {"mirrors": mirrors, "probed_at": time.time(), "ranking": [list(result) for result in ranking]})
+
+
+def ranked(mirrors: List[str] = MIRRORS, reprobe: bool = False) -> List[str]:
+    # the healthy mirrors, best first; probed once per TTL and once per run at most
+    global _ranked
+    if _ranked and not reprobe:
+        return _ranked
+
+    ranking: Optional[List[ProbeResult]] = None if reprobe else _load_ranking(mirrors)
+    if ranking is not None:
+        metrics.cache_hit("mirrors")
+        print("[blue]Using the cached mirror ranking.")
+    else:
+        metrics.cache_miss("mirrors")
+        print(f"[blue]Probing {len(mirrors)} mirror(s)...")
+        ranking = probe_all(mirrors)
+        for result in ranking:
+            if result.healthy:
+                print(f"[blue]{result.mirror}: {result.time_to_first_byte * 1000:.0f} ms to first byte, "
+                      f"{result.throughput / 1024 / 1024:.2f} MiB/s")
+            else:
+                print(f"[yellow]{result.mirror}: unhealthy ({result.error})")
+        if ranking and ranking[0].healthy:
+            _save_ranking(mirrors, ranking)
+
+    if not ranking or not ranking[0].healthy:
+        raise BaseStageException(
+            "None of the configured mirrors responded.\n"
+            "Check your network connection or set ALD_MIRRORS to a comma separated list of reachable Arch Linux mirrors."
+        )
+    _ranked = [result.mirror for result in ranking if result.healthy]
+    return _ranked
+
+
+def select(mirrors: List[str] = MIRRORS, reprobe: bool = False) -> str:
+    return ranked(mirrors, reprobe)[0]
+
+
+def failed(mirror: str, error: str, mirrors: List[str] = MIRRORS):
+    # the ranking can be up to a TTL old, a mirror that went down since is ranked last until the next probe
+    global _ranked
+    print(f"[yellow]{mirror} failed ({error}).")
+    _ranked = [ranked_mirror for ranked_mirror in (_ranked or []) if ranked_mirror != mirror]
+    ranking: Optional[List[ProbeResult]] = _load_ranking(mirrors)
+    if ranking is not None:
+        _save_ranking(mirrors, rank([
+            ProbeResult(result.mirror, False, 0.0, 0.0, error) if result.mirror == mirror else result for result in ranking
+        ]))
+
+
+def use(function: Callable[[str], T], mirrors: List[str] = MIRRORS) -> T:
+    # runs function with the best mirror, and with the next one of the ranking for as long as it fails
+    while True:
+        candidates: List[str] = ranked(mirrors)
+        try:
+            return function(candidates[0])
+        except BaseStageException as error:
+            if len(candidates) == 1:
+                raise
+            failed(candidates[0], error.args[0].splitlines()[0], mirrors)
+            print(f"[blue]Trying {ranked(mirrors)[0]} instead.")
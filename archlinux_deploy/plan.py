@@ -0,0 +1,88 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, List, NamedTuple, Tuple
+
+# subcommand -> which of its flags, besides the target, decide whether two operations can share one process
+MERGEABLE: Dict[str, Tuple[str, ...]] = {
+    "modifyvm": (),
+    "storagectl": ("--name",),
+    "storageattach": ("--storagectl", "--port", "--device"),
+}
+
+
+class Operation(NamedTuple):
+    subcommand: str
+    target: str  # positional argument after the subcommand (a vm name, "disk", ...), "" for none
+    flags: Tuple[Tuple[str, str], ...]  # (flag, value) pairs, a value of "" means the flag takes no value
+    description: str
+    accepted_return_codes: Tuple[int, ...] = (0,)
+
+    def flag(self, name: str) -> str:
+        return dict(self.flags).get(name, "")
+
+
+class Command(NamedTuple):
+    arguments: List[str]  # without the vboxmanage executable
+    covers: List[Operation]
+    accepted_return_codes: Tuple[int, ...]
+
+
+class Plan:
+    def __init__(self, dry_run: bool = False):
+        self.operations: List[Operation] = []
+        self.dry_run = dry_run  # print the merged commands instead of running them
+        self.applied: int = 0  # operations before this index were already applied
+
+    def add(self, subcommand: str, target: str, description: str, *flags: Tuple[str, str],
+            accepted_return_codes: Tuple[int, ...] = (0,)):
+        self.operations.append(Operation(subcommand, target, tuple(flags), description, accepted_return_codes))
+
+    def __len__(self) -> int:
+        return len(self.operations) - self.applied
+
+    def pending(self) -> List[Operation]:
+        return self.operations[self.applied:]
+
+    def mark_applied(self):
+        self.applied = len(self.operations)
+
+    def merged(self) -> List[Command]:
+        # operations that can share a process are folded into the first one of their group, so the
+        # order of everything else (e.g. a controller being added before something is attached to it) is kept
+        groups: Dict[tuple, List[Operation]] = {}
+        order: List[tuple] = []
+        for index, operation in enumerate(self.pending()):
+            if operation.subcommand in MERGEABLE:
+                key: tuple = (operation.subcommand, operation.target) + tuple(operation.flag(flag) for flag in MERGEABLE[operation.subcommand])
+            else:
+                key = (index,)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(operation)
+        return [_merge(groups[key]) for key in order]
+
+
+def _merge(operations: List[Operation]) -> Command:
+    first: Operation = operations[0]
+    flags: Dict[str, str] = {}
+    for operation in operations:
+        flags.update(operation.flags)  # a later operation setting the same flag wins
+    arguments: List[str] = [first.subcommand, first.target] if first.target else [first.subcommand]
+    for flag, value in flags.items():
+        arguments.extend([flag, value] if value else [flag])
+    accepted: Tuple[int, ...] = tuple(sorted(set.intersection(*[set(operation.accepted_return_codes) for operation in operations])))
+    return Command(arguments, operations, accepted)
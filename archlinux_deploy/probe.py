@@ -0,0 +1,118 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import CACHE_DIR, REPROBE
+from archlinux_deploy import metrics, utils
+from typing import Dict, List, NamedTuple, Optional
+import importlib.util
+import threading
+import json
+import sys
+import os
+
+PROBE_CACHE_FILE: str = os.path.join(CACHE_DIR, "probe.json")
+VBOXMANAGE_NAMES: List[str] = ["vboxmanage", "VBoxManage", "VboxManage"]
+
+_environment: Optional["Environment"] = None
+_lock = threading.Lock()  # the stage 1 checks run concurrently and shouldn't all probe at once
+
+
+class Environment(NamedTuple):
+    virtualbox: Optional[str]  # resolved paths, None when not found
+    vboxmanage: Optional[str]
+    vboxapi: Optional[str]
+    xpcom: Optional[str]
+
+
+def _executable(name: str) -> str:
+    return name if utils.is_posix() else f"{name}.exe"
+
+
+def _module_origin(name: str) -> Optional[str]:
+    # find_spec locates the module without importing it, xpcom in particular is slow to import
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None:
+        return None
+    return spec.origin or (list(spec.submodule_search_locations)[0] if spec.submodule_search_locations else name)
+
+
+def probe() -> Environment:
+    vboxmanage: Optional[str] = None
+    for name in VBOXMANAGE_NAMES:
+        vboxmanage = utils.which(_executable(name))
+        if vboxmanage is not None:
+            break
+    return Environment(utils.which(_executable("virtualbox")), vboxmanage, _module_origin("vboxapi"), _module_origin("xpcom"))
+
+
+def _mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def fingerprint(environment: Environment) -> Dict[str, object]:
+    # directory mtimes change when something is installed into (or removed from) them,
+    # which catches a tool that was missing at probe time showing up later
+    # sys.path[0] is wherever the program was started from, which says nothing about the environment
+    directories: List[str] = utils.path_entries() + [path for path in sys.path[1:] if path]
+    watched: List[str] = directories + [path for path in environment if path is not None and os.path.isabs(path)]
+    return {
+        "PATH": os.environ.get("PATH", ""),
+        "PYTHONPATH": os.environ.get("PYTHONPATH", ""),
+        "python": sys.executable,
+        "mtimes": {path: _mtime(path) for path in watched},
+    }
+
+
+def _load() -> Optional[Environment]:
+    try:
+        with open(PROBE_CACHE_FILE, "r") as cache:
+            data = json.load(cache)
+        environment: Environment = Environment(**data["environment"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return environment if data.get("fingerprint") == fingerprint(environment) else None
+
+
+def cached() -> Optional[Environment]:
+    return _environment or _load()
+
+
+def _save(environment: Environment):
+    utils.write_json(PROBE_CACHE_FILE, {"environment": environment._asdict(), "fingerprint": fingerprint(environment)})
+
+
+def environment(reprobe: bool = False) -> Environment:
+    # ALD_REPROBE only skips the cache for the first lookup of the process, like --reprobe; after that the fresh
+    # probe is what's cached
+    global _environment
+    with _lock:
+        reprobe = reprobe or (REPROBE and _environment is None)
+        if _environment is not None and not reprobe:
+            return _environment
+        loaded: Optional[Environment] = None if reprobe else _load()
+        if loaded is None:
+            metrics.cache_miss("probe")
+            loaded = probe()
+            _save(loaded)
+        else:
+            metrics.cache_hit("probe")
+        _environment = loaded
+        return _environment
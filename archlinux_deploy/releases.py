@@ -0,0 +1,105 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import CACHE_DIR, HTTP_TIMEOUT
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy.utils import print
+from archlinux_deploy import iso_cache, metrics, utils
+from typing import Dict, Iterable, List, NamedTuple, Optional
+import requests
+import json
+import re
+import os
+
+RELEASE_CACHE_FILE: str = os.path.join(CACHE_DIR, "releases.json")
+ISO_HREF_PATTERN = re.compile(rb'href="([^"/]*archlinux-(\d{4}\.\d{2}\.\d{2})-x86_64\.iso)"')
+# longest href we care about, kept between chunks so a match split across two chunks isn't lost
+_CARRY_SIZE: int = 256
+
+
+class Release(NamedTuple):
+    version: str
+    iso_name: str
+    iso_url: str
+    sha256: str
+    etag: str = ""
+    last_modified: str = ""
+
+
+def scan_iso_names(chunks: Iterable[bytes]) -> List[str]:
+    names: Dict[str, str] = {}
+    carry: bytes = b""
+    for chunk in chunks:
+        data: bytes = carry + chunk
+        for match in ISO_HREF_PATTERN.finditer(data):
+            names[match.group(1).decode("utf-8")] = match.group(2).decode("utf-8")
+        carry = data[-_CARRY_SIZE:]
+    return sorted(names, key=lambda name: names[name], reverse=True)
+
+
+def _load_cache() -> Dict[str, dict]:
+    try:
+        with open(RELEASE_CACHE_FILE, "r") as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(index_url: str, release: Release):
+    cache: Dict[str, dict] = _load_cache()
+    cache[index_url] = release._asdict()
+    utils.write_json(RELEASE_CACHE_FILE, cache)
+
+
+def cached(index_url: str) -> Optional[Release]:
+    try:
+        return Release(**_load_cache()[index_url])
+    except (KeyError, TypeError):
+        return None
+
+
+def latest(index_url: str) -> Release:
+    previous: Optional[Release] = cached(index_url)
+    headers: Dict[str, str] = {}
+    if previous is not None:
+        if previous.etag:
+            headers["If-None-Match"] = previous.etag
+        if previous.last_modified:
+            headers["If-Modified-Since"] = previous.last_modified
+
+    try:
+        with requests.get(index_url, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as response:
+            if response.status_code == 304 and previous is not None:
+                metrics.cache_hit("releases")
+                print(f"[blue]Mirror index unchanged, latest release is still {previous.version}.")
+                return previous
+            response.raise_for_status()
+            iso_names: List[str] = scan_iso_names(response.iter_content(chunk_size=16 * 1024))
+            etag: str = response.headers.get("ETag", "")
+            last_modified: str = response.headers.get("Last-Modified", "")
+    except requests.RequestException as error:
+        raise BaseStageException(f"Couldn't read the mirror index at '{index_url}':\n{error}") from None
+
+    metrics.cache_miss("releases")
+    if not iso_names:
+        raise BaseStageException(f"Couldn't find any Arch Linux ISO in the mirror index at '{index_url}'.")
+    iso_name: str = iso_names[0]
+    checksums: Dict[str, str] = iso_cache.fetch_checksums(index_url + "sha256sums.txt")
+    if iso_name not in checksums:
+        raise BaseStageException(f"The mirror's sha256sums.txt doesn't list {iso_name}, refusing to use an unverifiable ISO.")
+    release: Release = Release(iso_cache.release_version(iso_name), iso_name, index_url + iso_name, checksums[iso_name], etag, last_modified)
+    _save_cache(index_url, release)
+    print(f"[blue]Latest release is {release.version}.")
+    return release
@@ -0,0 +1,160 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import COMMAND_TIMEOUT, COMMAND_CONCURRENCY
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy import metrics, utils
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple, Union
+import threading
+import asyncio
+import signal
+import time
+import os
+
+# shared by every thread and event loop of the process, so concurrent substages can't fork an unbounded number of vboxmanages
+_slots = threading.BoundedSemaphore(COMMAND_CONCURRENCY)
+# error reports keep the end of the output, that's where vboxmanage puts the actual error
+REPORT_LIMIT: int = 64 * 1024
+
+Command = Union[str, List[str]]
+
+
+class CommandResult(NamedTuple):
+    command: str
+    return_code: int
+    stdout: str
+    stderr: str
+
+
+def _arguments(command: Command) -> List[str]:
+    # pass a list when an argument (like a path) may contain whitespace
+    return command.split() if isinstance(command, str) else list(command)
+
+
+def _tail(output: str) -> str:
+    if len(output) <= REPORT_LIMIT:
+        return output
+    return f"(first {len(output) - REPORT_LIMIT} characters cut)\n{output[-REPORT_LIMIT:]}"
+
+
+def _report(headline: str, command: str, stdout: str, stderr: str) -> str:
+    return (
+        f"{headline}\n"
+        f"Command passed: '{command}'\n"
+        f"Standard Output (stdout):\n"
+        f"{_tail(stdout) or '(empty)'}\n"
+        f"Standard Error (stderr):\n"
+        f"{_tail(stderr) or '(empty)'}"
+    )
+
+
+def _kill(process: asyncio.subprocess.Process):
+    try:
+        if utils.is_posix():
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+
+async def _drain(stream: asyncio.StreamReader, chunks: List[bytes], on_output: Optional[Callable[[bytes], None]]):
+    while True:
+        data: bytes = await stream.read(64 * 1024)
+        if not data:
+            return
+        chunks.append(data)
+        if on_output is not None:
+            on_output(data)
+
+
+async def run_async(command: Command, accepted_return_codes: Sequence[int] = (0,), ignore_return_code: bool = False,
+                    timeout: Optional[float] = COMMAND_TIMEOUT, on_output: Optional[Callable[[bytes], None]] = None) -> CommandResult:
+    arguments: List[str] = _arguments(command)
+    command_line: str = " ".join(arguments)
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, _slots.acquire)
+    try:
+        spawning: float = time.perf_counter()
+        try:
+            # its own process group, so a timeout also kills whatever it spawned and the pipes get closed
+            process = await asyncio.create_subprocess_exec(*arguments, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                           start_new_session=utils.is_posix())
+        except OSError as error:
+            raise BaseStageException(f"Couldn't start '{command_line}':\n{error}") from None
+        spawned: float = time.perf_counter()
+        stdout: List[bytes] = []
+        stderr: List[bytes] = []
+        # both pipes are drained while the command runs, a full pipe buffer can't stall it
+        waiting = asyncio.gather(_drain(process.stdout, stdout, on_output), _drain(process.stderr, stderr, on_output), process.wait())
+        try:
+            await asyncio.wait_for(waiting, timeout)
+        except asyncio.CancelledError:
+            # e.g. the caller gave up on it, a cancelled command mustn't keep running without anyone reading its pipes
+            _kill(process)
+            await process.wait()
+            raise
+        except asyncio.TimeoutError:
+            _kill(process)
+            await process.wait()
+            metrics.record_command(arguments, spawned - spawning, time.perf_counter() - spawned, None)
+            raise BaseStageException(_report(
+                f"Command timed out after {timeout} seconds and was killed.",
+                command_line, utils.bytes_to_string(b"".join(stdout)), utils.bytes_to_string(b"".join(stderr))
+            )) from None
+    finally:
+        _slots.release()
+    metrics.record_command(arguments, spawned - spawning, time.perf_counter() - spawned, process.returncode)
+
+    result: CommandResult = CommandResult(
+        command_line, process.returncode, utils.bytes_to_string(b"".join(stdout)), utils.bytes_to_string(b"".join(stderr))
+    )
+    if result.return_code not in accepted_return_codes and not ignore_return_code:
+        raise BaseStageException(_report(
+            f"Return code of command is {result.return_code} (not successful).", command_line, result.stdout, result.stderr
+        ))
+    return result
+
+
+def run_coroutine(coroutine):
+    # every calling thread (scheduler workers included) gets its own short-lived event loop
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def run_many(commands: List[Command], **options) -> List[CommandResult]:
+    # every command finishes (and gives its slot back) before the first failure is raised, the event loop is closed
+    # right after, so nothing can be left running on it
+    async def gather() -> list:
+        return list(await asyncio.gather(*[run_async(command, **options) for command in commands], return_exceptions=True))
+    results: list = run_coroutine(gather())
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+def sp_run(command: Command, accepted_return_codes: Optional[List[int]] = None, ignore_return_code: bool = False,
+           timeout: Optional[float] = COMMAND_TIMEOUT) -> Tuple[int, str, str]:
+    result: CommandResult = run_coroutine(run_async(command, tuple(accepted_return_codes or [0]), ignore_return_code, timeout))
+    return result.return_code, result.stdout, result.stderr
+
+
+def sp_call(command: Command, accepted_return_codes: Optional[List[int]] = None, ignore_return_code: bool = False,
+            timeout: Optional[float] = COMMAND_TIMEOUT) -> int:
+    return sp_run(command, accepted_return_codes, ignore_return_code, timeout)[0]
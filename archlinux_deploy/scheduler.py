@@ -0,0 +1,134 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import SCHEDULER_WORKERS
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy import metrics, utils
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+import contextvars
+import time
+
+
+class Substage(NamedTuple):
+    name: str
+    function: Callable[[], None]
+    dependencies: Tuple[str, ...] = ()
+    stage: int = 1
+
+
+class Timing(NamedTuple):
+    started: float
+    finished: float
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+def _check_graph(substages: List[Substage]):
+    names: Set[str] = {substage.name for substage in substages}
+    if len(names) != len(substages):
+        raise ValueError("Substage names must be unique.")
+    # a dependency on a substage that isn't scheduled (e.g. stage 1 when only stage 2 runs) counts as satisfied
+    remaining: Dict[str, Set[str]] = {substage.name: set(substage.dependencies) & names for substage in substages}
+    while remaining:
+        ready: List[str] = [name for name, dependencies in remaining.items() if not dependencies]
+        if not ready:
+            raise ValueError(f"Substages {', '.join(sorted(remaining))} depend on each other.")
+        for name in ready:
+            del remaining[name]
+        for dependencies in remaining.values():
+            dependencies.difference_update(ready)
+
+
+def critical_path(substages: List[Substage], timings: Dict[str, Timing]) -> List[str]:
+    # walk back from whatever finished last, always through the dependency that held it up the longest
+    by_name: Dict[str, Substage] = {substage.name: substage for substage in substages}
+    current: Optional[str] = max(timings, key=lambda name: timings[name].finished) if timings else None
+    path: List[str] = []
+    while current is not None:
+        path.append(current)
+        blockers: List[str] = [name for name in by_name[current].dependencies if name in timings]
+        current = max(blockers, key=lambda name: timings[name].finished) if blockers else None
+    return list(reversed(path))
+
+
+def _run_substage(substage: Substage, vm: str) -> Timing:
+    utils.colored_output(f"Stage {substage.stage} Substage {substage.name} started!", "info")
+    started: float = time.perf_counter()
+    try:
+        substage.function()
+    except BaseException:
+        metrics.record_substage(substage.name, substage.stage, time.perf_counter() - started, False, vm)
+        raise
+    finished: float = time.perf_counter()
+    metrics.record_substage(substage.name, substage.stage, finished - started, True, vm)
+    utils.colored_output(f"Stage {substage.stage} Substage {substage.name} completed!", "success")
+    return Timing(started, finished)
+
+
+def run(substages: List[Substage], workers: int = SCHEDULER_WORKERS, vm: str = "") -> bool:
+    # vm labels the recorded timings, one process can run the substages of several VMs (e.g. golden bases)
+    _check_graph(substages)
+    names: Set[str] = {substage.name for substage in substages}
+    pending: Dict[str, Substage] = {substage.name: substage for substage in substages}
+    done: Set[str] = set()
+    timings: Dict[str, Timing] = {}
+    running: Dict[Future, Substage] = {}
+    failed: bool = False
+    started: float = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            if not failed:
+                for name, substage in list(pending.items()):
+                    if set(substage.dependencies) & names <= done:
+                        # in a copy of the caller's context, so e.g. a fleet VM's output prefix and log file follow it
+                        running[executor.submit(contextvars.copy_context().run, _run_substage, substage, vm)] = pending.pop(name)
+            if not running:
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                substage = running.pop(future)
+                try:
+                    timings[substage.name] = future.result()
+                except BaseStageException as error:
+                    # fail fast: nothing new is started, substages already running are left to finish
+                    failed = True
+                    message: str = error.args[0]
+                    utils.colored_output(
+                        f"Stage {substage.stage} Substage {substage.name} FAILED:\n"
+                        f"{message}",
+                        "error"
+                    )
+                    continue
+                done.add(substage.name)
+            if failed:
+                pending.clear()
+
+    wall_clock: float = time.perf_counter() - started
+    path: List[str] = critical_path(substages, timings)
+    if path:
+        utils.colored_output(
+            "Critical path: " + " -> ".join(f"{name} ({timings[name].duration:.2f}s)" for name in path) +
+            f", {sum(timings[name].duration for name in path):.2f}s of {wall_clock:.2f}s wall clock",
+            "info"
+        )
+    if failed:
+        return False
+    for stage in sorted({substage.stage for substage in substages}):
+        utils.colored_output(f"Stage {stage} completed!", "success")
+    return True
@@ -0,0 +1,31 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import VM_NAME, VM_MEM_SIZE, VM_VRAM_SIZE, VM_HDD_SIZE, VM_HDD_VARIANT, VM_CPUS, VBOX_VMS_LOCATION
+from typing import NamedTuple
+import os
+
+
+class VMSpec(NamedTuple):
+    name: str = VM_NAME
+    memory: int = VM_MEM_SIZE  # MB
+    vram: int = VM_VRAM_SIZE  # MB
+    hdd_size: int = VM_HDD_SIZE  # MB
+    hdd_variant: str = VM_HDD_VARIANT  # Standard or Fixed
+    cpus: int = VM_CPUS
+
+    @property
+    def disk_path(self) -> str:
+        return os.path.join(VBOX_VMS_LOCATION, self.name, f"{self.name}.vdi")
@@ -14,17 +14,14 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
-from archlinux_deploy import utils
-from typing import List, Callable
-from bs4 import BeautifulSoup  # type: ignore
-from rich import print
-import subprocess
-import requests
-import os
+from archlinux_deploy.utils import print
+from archlinux_deploy.scheduler import Substage
+from archlinux_deploy import iso_cache, mirrors, probe, releases, scheduler
+from typing import List
 
 def check_for_virtualbox():
     print("[blue]Checking if virtualbox is installed...")
-    if not utils.in_path_env("virtualbox"):
+    if probe.environment().virtualbox is None:
         raise BaseStageException(
             "It seems like virtualbox isn't installed.\n"
             "Either install it from the website if you're using Windows, install it from the app store if you're running Mac,\n"
@@ -33,11 +30,8 @@ def check_for_virtualbox():
     print("[blue]It is.")
 
 def check_for_vboxapi():
-    try:
-        print("[blue]Checking if module 'vboxapi' is installed...")
-        import vboxapi  # type: ignore
-        print("[blue]It is.")
-    except ModuleNotFoundError:
+    print("[blue]Checking if module 'vboxapi' is installed...")
+    if probe.environment().vboxapi is None:
         raise BaseStageException("It seems like vboxapi isn't installed as a python module.\n"
                                  "Here is the following fix:\n\n"
                                  "1. Go to this link: https://www.virtualbox.org/wiki/Downloads\n"
@@ -50,14 +44,12 @@ def check_for_vboxapi():
                                  "8.1. If on a POSIX-based distribution (e.g. Linux, Darwin, FreeBSD) type this:\n"
                                  "'$ sudo python vboxapisetup.py install'\n"
                                  "8.2. If on a Windows system, type this:\n"
-                                 "'python vboxapisetup.py install'", "error") from None
+                                 "'python vboxapisetup.py install'", "error")
+    print("[blue]It is.")
 
 def check_for_xpcom():
-    try:
-        print("[blue]Checking if module 'xpcom' is installed...")
-        import xpcom  # type: ignore
-        print("[blue]It is.")
-    except ModuleNotFoundError:
+    print("[blue]Checking if module 'xpcom' is installed...")
+    if probe.environment().xpcom is None:
         raise BaseStageException(
             "It seems like xpcom isn't in the PYTHONPATH.\n"
             "Assuming that vboxapi is installed, this means that you need to add <SDK_INSTALL_LOCATION>/bindings/xpcom/python to PYTHONPATH.\n"
@@ -69,60 +61,29 @@ def check_for_xpcom():
             "export PYTHONPATH=<SDK_INSTALL_LOCATION>/bindings/xpcom/python\n"
             "'''\n"
         )
+    print("[blue]It is.")
 
-def download_latest_iso():
-    arch_linux_website: str = "http://mirror.rackspace.com/archlinux/iso/latest/"
-    page: str = requests.get(arch_linux_website).text
-    soup: BeautifulSoup = BeautifulSoup(page, "html.parser")
-    all_isos: List[str] = [arch_linux_website + "/" + node.get("href") for node in soup.find_all("a") if node.get("href").endswith("iso")]
-    if os.path.exists("./arch-linux.iso"):
-        print("[blue]ISO seems to be already downloaded, continuing...")
-        return
-    with open("./arch-linux.iso", "wb") as iso:
-        response: requests.Response = requests.get(all_isos[0], stream=True)
-        print("[blue]Writing Arch Linux ISO to disk...")
-        for data in response.iter_content(chunk_size=1024):
-            iso.write(data)
+def select_mirror():
+    print(f"[blue]Using mirror {mirrors.select()}.")
 
-def vbox_manage_command() -> str:
-    if utils.in_path_env("vboxmanage" if utils.is_posix() else "vboxmanage.exe"):
-        return "vboxmanage" if utils.is_posix() else "vboxmanage.exe"
-    elif utils.in_path_env("VboxManage" if utils.is_posix() else "VboxManage.exe"):
-        return "VboxManage" if utils.is_posix() else "VboxManage.exe"
-    else:
-        raise BaseStageException(
-            "It seems like the vboxmanage command isn't in PATH. Either check in /usr/lib/virtualbox or C:\\Program Files\\Virtualbox"
-        )
+def _download_from(mirror: str) -> iso_cache.CachedIso:
+    release: releases.Release = releases.latest(mirror + "iso/latest/")
+    print("[blue]Writing Arch Linux ISO to the cache...")
+    return iso_cache.fetch(release.iso_url, release.sha256)
 
-def sp_call(command: str, accepted_return_codes: List[int] = None, ignore_return_code: bool = False):
-    if accepted_return_codes is None:
-        accepted_return_codes = [0]
-    called = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    called.wait()  # needed so that the we'll get the return code
-    stdout, stderr = called.communicate()
-    return_code: int = called.returncode
-    if return_code not in accepted_return_codes and not ignore_return_code:
-        raise BaseStageException(
-            f"Return code of command is {return_code} (not successful).\n"
-            f"Command passed: '{command}'\n"
-            f"Standard Output (stdout):\n"
-            f"{utils.bytes_to_string(stdout) or '(empty)'}\n"
-            f"Standard Error (stderr):\n"
-            f"{utils.bytes_to_string(stderr) or '(empty)'}"
-        )
-    return return_code
+def download_latest_iso():
+    # from the next mirror of the ranking when the selected one fails, it may have gone down since it was probed
+    iso: iso_cache.CachedIso = mirrors.use(_download_from)
+    print(f"[blue]Arch Linux {iso.version} is at '{iso.path}'.")
+
+def substages() -> List[Substage]:
+    return [
+        Substage("check_for_virtualbox", check_for_virtualbox),
+        Substage("check_for_vboxapi", check_for_vboxapi),
+        Substage("check_for_xpcom", check_for_xpcom),
+        Substage("select_mirror", select_mirror),
+        Substage("download_latest_iso", download_latest_iso, ("select_mirror",)),
+    ]
 
-def run():
-    stages: List[Callable] = [check_for_virtualbox, check_for_vboxapi, check_for_xpcom, download_latest_iso]
-    for stage in stages:
-        stage_name: str = stage.__name__
-        utils.colored_output(f"Stage 1 Substage {stage_name} started!", "info")
-        try:
-            stage()
-        except BaseStageException as error:
-            message = error.args[0]
-            utils.colored_output(f"Stage 1 Substage {stage_name} FAILED:", "error")
-            utils.colored_output(message, "error")
-            return
-        utils.colored_output(f"Stage 1 Substage {stage_name} completed!", "success")
-    utils.colored_output(f"Stage 1 completed!", "success")
+def run() -> bool:
+    return scheduler.run(substages())
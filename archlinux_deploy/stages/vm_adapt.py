@@ -13,144 +13,191 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from archlinux_deploy import VM_NAME, VM_MEM_SIZE, VM_VRAM_SIZE, VM_IGNORE_DUPLICATES, VBOX_VMS_LOCATION, VM_HDD_SIZE
+from archlinux_deploy import VM_IGNORE_DUPLICATES, VBOX_VMS_LOCATION, DRY_RUN
 from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
-from archlinux_deploy import utils
-from typing import List, Callable
-import virtualbox  # type: ignore
-from rich import print
-import subprocess
+from archlinux_deploy.plan import Plan, Command
+from archlinux_deploy.state import VMState, parse_machinereadable, same_path
+from archlinux_deploy.spec import VMSpec
+from archlinux_deploy.utils import print
+from archlinux_deploy.scheduler import Substage
+from archlinux_deploy.runner import sp_run
+from archlinux_deploy import utils, admission, disks, iso_cache, probe, runner, scheduler, vbox
+from typing import List, Optional
+import functools
+import shlex
 import os
 
-previous_dir: str = os.getcwd()
-
-def sp_call(command: str, accepted_return_codes: List[int] = None, ignore_return_code: bool = False):
-    if accepted_return_codes is None:
-        accepted_return_codes = [0]
-    called = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    called.wait()  # needed so that the we'll get the return code
-    stdout, stderr = called.communicate()
-    return_code: int = called.returncode
-    if return_code not in accepted_return_codes and not ignore_return_code:
+def vbox_manage_command() -> str:
+    # resolved by the cached environment probe, so this doesn't scan PATH for every subprocess
+    vboxmanage: Optional[str] = probe.environment().vboxmanage
+    if vboxmanage is None:
         raise BaseStageException(
-            f"Return code of command is {return_code} (not successful).\n"
-            f"Command passed: '{command}'\n"
-            f"Standard Output (stdout):\n"
-            f"{utils.bytes_to_string(stdout) or '(empty)'}\n"
-            f"Standard Error (stderr):\n"
-            f"{utils.bytes_to_string(stderr) or '(empty)'}"
+            "It seems like the vboxmanage command isn't in PATH. Either check in /usr/lib/virtualbox or C:\\Program Files\\Virtualbox"
         )
-    return return_code
+    return vboxmanage
 
-def vbox_manage_command() -> str:
-    if utils.in_path_env("vboxmanage" if utils.is_posix() else "vboxmanage.exe"):
-        return "vboxmanage" if utils.is_posix() else "vboxmanage.exe"
-    elif utils.in_path_env("VboxManage" if utils.is_posix() else "VboxManage.exe"):
-        return "VboxManage" if utils.is_posix() else "VboxManage.exe"
+def read_vm_state(spec: VMSpec, plan: Plan, state: VMState):
+    # one query for everything the other substages need to know, instead of guessing from return codes
+    if state.read:
+        return
+    return_code, stdout, stderr = sp_run([vbox_manage_command(), "showvminfo", spec.name, "--machinereadable"], ignore_return_code=True)
+    if return_code == 0:
+        state.info = parse_machinereadable(stdout)
+    elif "VBOX_E_OBJECT_NOT_FOUND" in stderr or "Could not find a registered machine" in stderr:
+        state.info = None
     else:
         raise BaseStageException(
-            "It seems like the vboxmanage command isn't in PATH. Either check in /usr/lib/virtualbox or C:\\Program Files\\Virtualbox"
+            f"Couldn't read the state of VM {spec.name} (return code {return_code}).\n"
+            f"Standard Error (stderr):\n"
+            f"{stderr or '(empty)'}"
         )
+    state.read = True
 
-def create_vm():
-    vbox: virtualbox.VirtualBox = virtualbox.VirtualBox()
-    vm_names: List[str] = [machine.name for machine in vbox.machines]
-    if VM_NAME in vm_names:
-        if VM_IGNORE_DUPLICATES is False:
+def create_vm(spec: VMSpec, plan: Plan, state: VMState, ignore_duplicates: bool = VM_IGNORE_DUPLICATES):
+    if state.exists:
+        if ignore_duplicates is False:
             raise BaseStageException(
-                F"It seems like there's a vm that has the same name that was going to be created ({VM_NAME}).\n"
+                F"It seems like there's a vm that has the same name that was going to be created ({spec.name}).\n"
                 F"Either rename the VM, set the vm_name in config.ini to something else or set ignore_duplicates to 1 in the environment variables."
             )
-        print(f"[yellow]There's a VM with the same name ({VM_NAME}). Continuing anyway...")
+        print(f"[yellow]There's a VM with the same name ({spec.name}). Reconciling it with the wanted configuration...")
+        return
+    print("[blue]Planning to create and register Arch Linux VM.")
+    plan.add("createvm", "", f"create VM {spec.name}",
+             ("--name", spec.name), ("--ostype", "ArchLinux_64"), ("--basefolder", VBOX_VMS_LOCATION), ("--register", ""))
 
-    try:
-        vm: virtualbox.library.IMachine = vbox.create_machine(
-            name=VM_NAME,
-            os_type_id="ArchLinux_64",
-            groups=["/"],
-            flags="",
-            settings_file=""
-        )
-        vbox.register_machine(vm)
-    except virtualbox.library_ext.library.VBoxErrorFileError:
-        pass
-    print("[blue]Created and registered Arch Linux VM." if "arch-linux" not in vm_names else "[blue]Got Arch Linux VM.")
+def set_vm_config(spec: VMSpec, plan: Plan, state: VMState):
+    wanted = [
+        ("vram", str(spec.vram), f"VRAM size {spec.vram} MB"),
+        ("memory", str(spec.memory), f"memory size {spec.memory} MB"),
+        ("graphicscontroller", "vmsvga", "graphics controller vmsvga"),
+        ("cpus", str(spec.cpus), f"{spec.cpus} vCPU(s)"),
+    ]
+    for setting, value, description in wanted:
+        if state.get(setting) == value:
+            continue
+        print(f"[blue]Planning {description}.")
+        plan.add("modifyvm", spec.name, description, (f"--{setting}", value))
 
-def set_vm_config():
-    vbox: virtualbox.VirtualBox = virtualbox.VirtualBox()
-    vm: virtualbox.library.IMachine = vbox.find_machine(VM_NAME)
-    print(f"[blue]Changing VRAM size to {VM_VRAM_SIZE} MB.")
-    try:
-        vm.vram_size = VM_VRAM_SIZE
-    except AttributeError:
-        print("[yellow]Couldn't change vram size using 'virtualbox' module, using subprocess instead")
-        sp_call(f"{vbox_manage_command()} modifyvm {VM_NAME} --vram {VM_VRAM_SIZE}")
-    print("[green]Operation successful.")
-    print(f"[blue]Changing memory size to {VM_MEM_SIZE} MB.")
-    try:
-        vm.memory_size = VM_MEM_SIZE
-    except Exception:  # virtualbox module raises a Exception exception
-        print("[yellow]Couldn't change memory size using 'virtualbox' module, using subprocess instead")
-        sp_call(f"{vbox_manage_command()} modifyvm {VM_NAME} --memory {VM_MEM_SIZE}")
-    print("[green]Operation successful.")
-    print("[blue]Changing graphics controller to vmsvga.")
+def provision_disk(spec: VMSpec, plan: Plan):
+    # a copy of a cached blank disk instead of a planned createmedium, so it doesn't wait for (or hold up) the VM itself
+    if os.path.exists(spec.disk_path):
+        return
+    if plan.dry_run:
+        disks.check_space(spec)
+        print(f"[yellow]Would copy the blank {spec.hdd_size} MB {spec.hdd_variant} disk template to '{spec.disk_path}'.")
+        return
+    print(f"[blue]Creating VDI file with the size of {spec.hdd_size} MB ({spec.hdd_variant}).")
+    method: str = disks.provision(vbox_manage_command(), spec)
+    print(f"[green]Copied the disk template with {method}.")
+
+def create_vm_controllers(spec: VMSpec, plan: Plan, state: VMState):
+    if not state.has_controller("HDD"):
+        print("[blue]Planning SATA storage controller.")
+        plan.add("storagectl", spec.name, "SATA storage controller",
+                 ("--name", "HDD"), ("--add", "sata"), ("--controller", "IntelAHCI"), ("--bootable", "on"))
+    if not state.has_controller("Disk_Image"):
+        print("[blue]Planning IDE storage controller, to mount the disk image.")
+        plan.add("storagectl", spec.name, "IDE storage controller",
+                 ("--name", "Disk_Image"), ("--add", "ide"), ("--bootable", "on"))
+
+def attach_vm_controllers(spec: VMSpec, plan: Plan, state: VMState):
+    iso: Optional[iso_cache.CachedIso] = iso_cache.current()
+    if iso is None:
+        raise BaseStageException("There's no verified Arch Linux ISO in the cache. Run stage 1 first.")
+    attached_disk: Optional[str] = state.attachment("HDD", 0, 0)
+    if attached_disk is None or not same_path(attached_disk, spec.disk_path):
+        print("[blue]Planning to attach the HDD to the SATA storage controller.")
+        plan.add("storageattach", spec.name, "HDD on the SATA controller",
+                 ("--storagectl", "HDD"), ("--device", "0"), ("--port", "0"), ("--type", "hdd"), ("--medium", spec.disk_path))
+    attached_iso: Optional[str] = state.attachment("Disk_Image", 0, 0)
+    if attached_iso is None or not same_path(attached_iso, iso.path):
+        print("[blue]Planning to attach the Arch Linux ISO to the IDE controller.")
+        plan.add("storageattach", spec.name, "Arch Linux ISO on the IDE controller",
+                 ("--storagectl", "Disk_Image"), ("--device", "0"), ("--port", "0"), ("--type", "dvddrive"), ("--medium", iso.path))
+
+async def _apply_command(command: Command):
+    covered: str = ", ".join(operation.description for operation in command.covers)
+    print(f"[blue]Running {command.arguments[0]} for: {covered}")
     try:
-        vm.graphics_controller_type = virtualbox.library.GraphicsControllerType.VMSVGA
-    except AttributeError:
-        print("[yellow]Couldn't change graphics controller type using 'virtualbox' module, using subprocess instead")
-        sp_call(f"{vbox_manage_command()} modifyvm {VM_NAME} --graphicscontroller vmsvga")
+        await runner.run_async([vbox_manage_command()] + command.arguments, command.accepted_return_codes)
+    except BaseStageException as error:
+        raise BaseStageException(f"Failed while applying: {covered}\n{error.args[0]}") from None
     print("[green]Operation successful.")
 
-def create_vm_controllers():
-    # have no idea to use virtualbox module beyond this, using subprocess instead
-    print(f"[blue]Creating VDI file with the size of {VM_HDD_SIZE} MB.")
-    os.chdir(VBOX_VMS_LOCATION)
-    create_disk_rc: int = sp_call(
-        f"{vbox_manage_command()} createmedium disk --filename {os.path.join(VM_NAME, f'{VM_NAME}.vdi')} --size 20480 --format VDI --variant Standard",
-        accepted_return_codes=[0, 1]
-    )
-    if create_disk_rc == 1:
-        print("[yellow]VDI file already exists, continuing.")
-    print("[green]Operation successful.")
-    print("[blue]Adding SATA storage controller.")
-    add_storage_controller_rc: int = sp_call(f"{vbox_manage_command()} storagectl {VM_NAME} --name HDD --add sata --controller IntelAHCI --bootable on",
-                                             accepted_return_codes=[0, 1])
-    if add_storage_controller_rc == 1:
-        print("[yellow]SATA storage controller already exists, continuing.")
-    print("[green]Operation successful.")
-    print("[blue]Adding IDE storage controller, to mount the disk image.")
-    add_disk_controller_rc: int = sp_call(
-        f"{vbox_manage_command()} storagectl {VM_NAME} --name Disk_Image --add ide --bootable on",
-        accepted_return_codes=[0, 1]
-    )
-    if add_disk_controller_rc == 1:
-        print("[yellow]IDE storage controller already exists, continuing.")
+async def _apply_commands(commands: List[Command]):
+    # one after another, they all take the VM's session lock
+    for command in commands:
+        await _apply_command(command)
 
-def attach_vm_controllers():
-    print("[blue]Attaching HDD to SATA storage controller.")
-    sp_call(
-        f"{vbox_manage_command()} storageattach {VM_NAME} --storagectl HDD --device 0 --port 0 --type hdd --medium {os.path.join(VM_NAME, f'{VM_NAME}.vdi')}"
-    )
-    print("[blue]Attaching Arch Linux ISO to IDE controller.")
-    os.chdir(previous_dir)
-    sp_call(
-        f"{vbox_manage_command()} storageattach {VM_NAME} --storagectl Disk_Image --device 0 --port 0 --type dvddrive --medium arch-linux.iso"
-    )
+def apply_plan(spec: VMSpec, plan: Plan, state: VMState):
+    if not len(plan):
+        print(f"[blue]{spec.name} is already in the wanted state, nothing to do.")
+        return
+    api: Optional[vbox.Connection] = vbox.connection() if not plan.dry_run else None
+    if api is not None and vbox.supports(api, plan.pending()):
+        vbox.apply(api, plan.pending())
+        plan.mark_applied()
+        return
+    commands: List[Command] = plan.merged()
+    print(f"[blue]{len(plan)} planned operation(s) merged into {len(commands)} vboxmanage call(s).")
+    if plan.dry_run:
+        for command in commands:
+            arguments: List[str] = [vbox_manage_command()] + command.arguments
+            print(f"[yellow]Would run: {' '.join(shlex.quote(argument) for argument in arguments)}")
+            print(f"[yellow]  covers: {', '.join(operation.description for operation in command.covers)}")
+        plan.mark_applied()  # as if they ran, so the attachments aren't printed together with them again
+        return
+    runner.run_coroutine(_apply_commands(commands))
+    plan.mark_applied()
 
-def run():
-    stages: List[Callable] = [create_vm, set_vm_config, create_vm_controllers, attach_vm_controllers]
-    for stage in stages:
-        stage_name = stage.__name__
-        utils.colored_output(f"Stage 2 Substage {stage_name} started!", "info")
-        try:
-            stage()
-        except BaseStageException as error:
-            message: str = error.args[0]
-            utils.colored_output(
-                f"Stage 2 Substage {stage_name} FAILED:\n"
-                f"{message}",
-                "error"
-            )
-            return
-        utils.colored_output(f"Stage 2 Substage {stage_name} completed!", "success")
-    utils.colored_output("Stage 2 completed!", "success")
+def substages(spec: VMSpec, plan: Plan, state: Optional[VMState] = None, iso_ready: bool = False,
+              ignore_duplicates: bool = VM_IGNORE_DUPLICATES) -> List[Substage]:
+    # only attaching needs the ISO, everything before that can run while stage 1 is still downloading.
+    # when the ISO is already there (iso_ready, stage 1 isn't running), the attachments are planned up front instead,
+    # so the controllers and what's attached to them are applied together, in one session through the API
+    state = state or VMState()
+    planning: List[Substage] = [
+        Substage("read_vm_state", functools.partial(read_vm_state, spec, plan, state), ("check_for_virtualbox",), 2),
+        Substage("create_vm", functools.partial(create_vm, spec, plan, state, ignore_duplicates), ("read_vm_state",), 2),
+        Substage("set_vm_config", functools.partial(set_vm_config, spec, plan, state), ("create_vm",), 2),
+        Substage("provision_disk", functools.partial(provision_disk, spec, plan), ("check_for_virtualbox",), 2),
+        Substage("create_vm_controllers", functools.partial(create_vm_controllers, spec, plan, state), ("create_vm",), 2),
+    ]
+    if iso_ready:
+        return planning + [
+            Substage("attach_vm_controllers", functools.partial(attach_vm_controllers, spec, plan, state), ("set_vm_config", "create_vm_controllers", "provision_disk"), 2),
+            Substage("apply_plan", functools.partial(apply_plan, spec, plan, state), ("attach_vm_controllers",), 2),
+        ]
+    return planning + [
+        Substage("apply_plan", functools.partial(apply_plan, spec, plan, state), ("set_vm_config", "create_vm_controllers"), 2),
+        Substage("attach_vm_controllers", functools.partial(attach_vm_controllers, spec, plan, state), ("apply_plan", "provision_disk", "download_latest_iso"), 2),
+        Substage("apply_attachments", functools.partial(apply_plan, spec, plan, state), ("attach_vm_controllers",), 2),
+    ]
+
+def admitted(spec: VMSpec, dry_run: bool = DRY_RUN, state: Optional[VMState] = None, linked: bool = False) -> Optional[VMSpec]:
+    # the spec sized to what the host can take, None when it can't take it; a dry run only reports.
+    # with a state, the VM is read first (once, for the substages too) and an existing one that isn't growing
+    # skips the host check, so a no-op rerun stays a single query
+    policy: admission.Policy = admission.Policy()
+    if policy.mode == "off":
+        return spec
+    try:
+        if state is not None:
+            read_vm_state(spec, Plan(dry_run), state)
+            unchanged: Optional[VMSpec] = admission.reconciled(spec, state.info, policy)
+            if unchanged is not None:
+                return unchanged
+        return admission.admit(vbox_manage_command(), spec, policy._replace(mode="warn") if dry_run else policy, linked)
+    except BaseStageException as error:
+        utils.colored_output(error.args[0], "error")
+        return None
+
+def run(spec: Optional[VMSpec] = None, dry_run: bool = DRY_RUN, admit: bool = True, ignore_duplicates: bool = VM_IGNORE_DUPLICATES) -> bool:
+    spec = spec or VMSpec()
+    state: VMState = VMState()
+    if admit:
+        spec = admitted(spec, dry_run, state)
+        if spec is None:
+            return False
+    return scheduler.run(substages(spec, Plan(dry_run), state, iso_ready=iso_cache.current() is not None, ignore_duplicates=ignore_duplicates), vm=spec.name)
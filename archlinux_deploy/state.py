@@ -0,0 +1,59 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, List, Optional
+import re
+import os
+
+
+def parse_machinereadable(output: str) -> Dict[str, str]:
+    info: Dict[str, str] = {}
+    for line in output.splitlines():
+        key, separator, value = line.partition("=")
+        if separator:
+            info[key.strip('"')] = value.strip('"')
+    return info
+
+
+def parse_vm_list(output: str) -> List[str]:
+    # `vboxmanage list vms`
+    return re.findall(r'^"(.*)" \{[0-9a-fA-F-]+\}$', output, re.MULTILINE)
+
+
+def same_path(first: str, second: str) -> bool:
+    return os.path.normcase(os.path.abspath(first)) == os.path.normcase(os.path.abspath(second))
+
+
+class VMState:
+    # what `vboxmanage showvminfo --machinereadable` said about a VM, read once and shared by every substage
+    def __init__(self, info: Optional[Dict[str, str]] = None):
+        self.info = info
+        self.read: bool = False  # set once showvminfo was asked, so whoever reads it first saves the others the query
+
+    @property
+    def exists(self) -> bool:
+        return self.info is not None
+
+    def get(self, key: str) -> Optional[str]:
+        return self.info.get(key) if self.info is not None else None
+
+    def has_controller(self, name: str) -> bool:
+        return self.info is not None and any(
+            key.startswith("storagecontrollername") and value == name for key, value in self.info.items()
+        )
+
+    def attachment(self, controller: str, port: int, device: int) -> Optional[str]:
+        medium: Optional[str] = self.get(f"{controller}-{port}-{device}")
+        return medium if medium not in (None, "none", "emptydrive") else None
@@ -13,11 +13,38 @@
 #
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Any, Dict, List
-from rich import print
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple
+from contextlib import contextmanager
+import contextvars
+import threading
 import platform
+import json
+import re
 import os
 
+# a context variable instead of a thread local, so the scheduler can carry it into the threads that run substages
+_output: "contextvars.ContextVar[Tuple[Optional[str], Optional[TextIO]]]" = contextvars.ContextVar("output", default=(None, None))
+
+@contextmanager
+def output_context(prefix: str, log_path: Optional[str] = None) -> Iterator[None]:
+    # tags every line printed in this context (e.g. one VM of a fleet) and copies it into its own log file
+    log_file: Optional[TextIO] = open(log_path, "a") if log_path is not None else None
+    token = _output.set((prefix, log_file))
+    try:
+        yield
+    finally:
+        _output.reset(token)
+        if log_file is not None:
+            log_file.close()
+
+def print(message: Any = ""):
+    import rich  # imported on first use, so `--help` and `status` don't pay for it
+    prefix, log_file = _output.get()
+    if log_file is not None:
+        log_file.write(re.sub(r"\[/?[a-z ]+\]", "", str(message)) + "\n")
+        log_file.flush()
+    rich.print(f"[bold]{prefix} |[/bold] {message}" if prefix is not None else message)
+
 def colored_output(message: Any, level: str):
     levels: Dict[str, str] = {
         "info": "[bold blue]🛈 ",
@@ -31,16 +58,37 @@ def colored_output(message: Any, level: str):
     for line in to_print:
         print(f"{levels[level]}{line}")
 
-def in_path_env(file: str) -> bool:
-    PATH: List[str] = os.environ["PATH"].split(";" if platform.system() == "Windows" else ":")
+def write_atomically(path: str, content: str):
+    # readers only ever see a whole file, never half of one; the temporary file is unique to the writing thread, so
+    # concurrent writers (e.g. a fleet's worker processes) can't interleave in it either
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temporary_path: str = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temporary_path, "w") as file:
+            file.write(content)
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
 
-    for path in PATH:
+def write_json(path: str, data: Any):
+    write_atomically(path, json.dumps(data))
+
+def path_entries() -> List[str]:
+    return os.environ["PATH"].split(";" if platform.system() == "Windows" else ":")
+
+def which(file: str) -> Optional[str]:
+    for path in path_entries():
         file_path: str = os.path.join(os.path.sep, path, file)
         if os.path.exists(file_path) and os.path.isfile(file_path) and os.access(file_path, os.X_OK):
-            return True
+            return file_path
         continue
     else:
-        return False
+        return None
+
+def in_path_env(file: str) -> bool:
+    return which(file) is not None
 
 def bytes_to_string(byte_object: bytes) -> str:
     return byte_object.decode("utf-8")
@@ -0,0 +1,187 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# one VirtualBox API client per process, instead of a vboxmanage process per change. every change to a machine is made
+# in one write-locked session and committed with a single save_settings, so VirtualBox writes the settings file once.
+# plans with anything this doesn't know how to do, and hosts without working bindings, still go through vboxmanage.
+from archlinux_deploy import VBOX_API
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy.plan import Operation
+from archlinux_deploy.state import same_path
+from archlinux_deploy.utils import print
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+import threading
+import os
+
+SESSION_SUBCOMMANDS = ("modifyvm", "storagectl", "storageattach")
+MODIFYVM_FLAGS = ("--vram", "--memory", "--graphicscontroller", "--cpus")
+BUSES: Dict[str, str] = {"sata": "sata", "ide": "ide"}
+CONTROLLER_TYPES: Dict[str, str] = {"intelahci": "intel_ahci", "piix3": "piix3", "piix4": "piix4", "ich6": "ich6"}
+GRAPHICS_CONTROLLERS: Dict[str, str] = {"vboxvga": "v_box_vga", "vmsvga": "vmsvga", "vboxsvga": "v_box_svga"}
+DEVICE_TYPES: Dict[str, str] = {"hdd": "hard_disk", "dvddrive": "dvd"}
+
+_connection: Optional["Connection"] = None
+_connected_pid: Optional[int] = None
+_unavailable: bool = False
+# the bindings aren't documented to be thread safe, and there's only one session to lock machines with
+_lock = threading.RLock()
+
+
+class Connection:
+    def __init__(self, module: Any):
+        self.module = module
+        self.library = module.library
+        self.vbox = module.VirtualBox()
+        self._session: Optional[Any] = None
+
+    @property
+    def session(self) -> Any:
+        if self._session is None:
+            self._session = self.module.Session()
+        return self._session
+
+    @contextmanager
+    def locked(self, machine_name: str) -> Iterator[Any]:
+        # yields the mutable machine, commits everything done to it at once and throws it all away on an error
+        machine = self.vbox.find_machine(machine_name)
+        machine.lock_machine(self.session, self.library.LockType.write)
+        try:
+            mutable = self.session.machine
+            try:
+                yield mutable
+                mutable.save_settings()
+            except BaseException:
+                mutable.discard_settings()
+                raise
+        finally:
+            self.session.unlock_machine()
+
+    def medium(self, location: str, device_type: str) -> Any:
+        registered = self.vbox.hard_disks if device_type == "hard_disk" else self.vbox.dvd_images
+        for medium in registered:
+            if same_path(medium.location, location):
+                return medium
+        access_mode = self.library.AccessMode.read_write if device_type == "hard_disk" else self.library.AccessMode.read_only
+        return self.vbox.open_medium(location, getattr(self.library.DeviceType, device_type), access_mode, False)
+
+
+def connection() -> Optional[Connection]:
+    global _connection, _connected_pid, _unavailable
+    with _lock:
+        if _connected_pid != os.getpid():
+            # a fleet worker forked from a process that was already connected needs a client of its own
+            _connection, _connected_pid, _unavailable = None, os.getpid(), False
+        if _connection is None and not _unavailable and VBOX_API:
+            try:
+                import virtualbox  # type: ignore
+                _connection = Connection(virtualbox)
+            except Exception as error:  # no bindings, no VBoxSVC, pyvbox built for another VirtualBox version...
+                _unavailable = True
+                print(f"[yellow]Not using the VirtualBox API ({error or type(error).__name__}), using vboxmanage instead.")
+        return _connection
+
+
+def _vram_setter(api: Connection) -> Optional[Callable[[Any, int], None]]:
+    # VirtualBox 6.1 moved the VRAM size from the machine to its graphics adapter
+    if hasattr(api.library.IMachine, "graphics_adapter"):
+        return lambda machine, size: setattr(machine.graphics_adapter, "vram_size", size)
+    if hasattr(api.library.IMachine, "vram_size"):
+        return lambda machine, size: setattr(machine, "vram_size", size)
+    return None
+
+
+def supports(api: Connection, operations: List[Operation]) -> bool:
+    for operation in operations:
+        flags: Dict[str, str] = dict(operation.flags)
+        if operation.subcommand == "createvm":
+            supported: bool = set(flags) <= {"--name", "--ostype", "--basefolder", "--register"}
+        elif operation.subcommand == "modifyvm":
+            supported = set(flags) <= set(MODIFYVM_FLAGS) and flags.get("--graphicscontroller", "vmsvga") in GRAPHICS_CONTROLLERS and \
+                ("--vram" not in flags or _vram_setter(api) is not None)
+        elif operation.subcommand == "storagectl":
+            supported = flags.get("--add", "") in BUSES and flags.get("--controller", "intelahci").lower() in CONTROLLER_TYPES and \
+                set(flags) <= {"--name", "--add", "--controller", "--bootable"}
+        elif operation.subcommand == "storageattach":
+            supported = flags.get("--type", "") in DEVICE_TYPES and \
+                set(flags) <= {"--storagectl", "--port", "--device", "--type", "--medium"}
+        else:
+            supported = False
+        if not supported:
+            return False
+    return True
+
+
+def _create_vm(api: Connection, operation: Operation):
+    name: str = operation.flag("--name")
+    settings_file: str = api.vbox.compose_machine_filename(name, "/", "", operation.flag("--basefolder"))
+    machine = api.vbox.create_machine(settings_file, name, ["/"], operation.flag("--ostype") or "Other", "")
+    machine.save_settings()
+    if "--register" in dict(operation.flags):
+        api.vbox.register_machine(machine)
+
+
+def _configure(api: Connection, machine: Any, operation: Operation):
+    library = api.library
+    flags: Dict[str, str] = dict(operation.flags)
+    if operation.subcommand == "modifyvm":
+        if "--vram" in flags:
+            _vram_setter(api)(machine, int(flags["--vram"]))
+        if "--memory" in flags:
+            machine.memory_size = int(flags["--memory"])
+        if "--graphicscontroller" in flags:
+            machine.graphics_controller_type = getattr(library.GraphicsControllerType, GRAPHICS_CONTROLLERS[flags["--graphicscontroller"]])
+        if "--cpus" in flags:
+            machine.cpu_count = int(flags["--cpus"])
+    elif operation.subcommand == "storagectl":
+        controller = machine.add_storage_controller(flags["--name"], getattr(library.StorageBus, BUSES[flags["--add"]]))
+        if "--controller" in flags:
+            controller.controller_type = getattr(library.StorageControllerType, CONTROLLER_TYPES[flags["--controller"].lower()])
+        if "--bootable" in flags:
+            controller.bootable = flags["--bootable"] == "on"
+    elif operation.subcommand == "storageattach":
+        device_type: str = DEVICE_TYPES[flags["--type"]]
+        port, device = int(flags["--port"]), int(flags["--device"])
+        try:
+            machine.detach_device(flags["--storagectl"], port, device)  # the slot may hold the wrong medium
+        except Exception:
+            pass
+        machine.attach_device(flags["--storagectl"], port, device, getattr(library.DeviceType, device_type),
+                              api.medium(flags["--medium"], device_type))
+
+
+def apply(api: Connection, operations: List[Operation]):
+    # machines first, then one transaction per machine, in the order the plan asked for them
+    sessions: Dict[str, List[Operation]] = {}
+    with _lock:
+        for operation in operations:
+            if operation.subcommand in SESSION_SUBCOMMANDS:
+                sessions.setdefault(operation.target, []).append(operation)
+                continue
+            print(f"[blue]Applying through the VirtualBox API: {operation.description}")
+            try:
+                _create_vm(api, operation)
+            except Exception as error:
+                raise BaseStageException(f"Failed while applying: {operation.description}\n{error}") from None
+        for machine_name, changes in sessions.items():
+            covered: str = ", ".join(operation.description for operation in changes)
+            print(f"[blue]Applying through the VirtualBox API in one session: {covered}")
+            try:
+                with api.locked(machine_name) as machine:
+                    for operation in changes:
+                        _configure(api, machine, operation)
+            except Exception as error:
+                raise BaseStageException(f"Failed while applying: {covered}\nNone of these changes were saved.\n{error}") from None
+    print("[green]Operation successful.")
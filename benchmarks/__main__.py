@@ -0,0 +1,82 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from benchmarks import suite
+from typing import Dict, List, Optional
+import argparse
+import json
+import time
+import sys
+import os
+
+RESULTS_DIR: str = os.path.join(suite.ROOT, "benchmarks", "results")
+BASELINE_FILE: str = os.path.join(RESULTS_DIR, "baseline.json")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="Offline benchmarks against a local mirror and a fake vboxmanage."
+    )
+    # checked by hand, before 3.12 argparse rejects an empty list for a positional with choices
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="which benchmarks to run (download, stage2, deploy, delta, fleet), all of them by default")
+    parser.add_argument("--iso-size", type=int, default=64, help="size of the synthetic ISO in MiB")
+    parser.add_argument("--bandwidth", type=float, default=0, help="mirror bandwidth in MiB/s, 0 is unlimited")
+    parser.add_argument("--latency", type=float, default=0, help="mirror latency per request in ms")
+    parser.add_argument("--vbox-delay", type=float, default=20, help="fake vboxmanage delay per call in ms")
+    parser.add_argument("--api-delay", type=float, default=2, help="stub VirtualBox API delay per call in ms")
+    parser.add_argument("--quick", action="store_true", help="one download configuration and fleets of up to 2 VMs")
+    parser.add_argument("--output", default=os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%dT%H%M%S')}.json"))
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="compare against these results")
+    parser.add_argument("--tolerance", type=float, help="allowed relative regression of timings and throughput, e.g. 0.1")
+    parser.add_argument("--save-baseline", action="store_true", help="also store the results as the new baseline")
+    arguments: argparse.Namespace = parser.parse_args(argv)
+    unknown: List[str] = [name for name in arguments.benchmarks if name not in ("download", "stage2", "deploy", "delta", "fleet")]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+
+    settings: suite.Settings = suite.Settings(
+        iso_size=arguments.iso_size * suite.MiB,
+        bandwidth=int(arguments.bandwidth * suite.MiB),
+        latency=arguments.latency / 1000,
+        vbox_delay=arguments.vbox_delay / 1000,
+        api_delay=arguments.api_delay / 1000,
+    )
+    if arguments.quick:
+        settings = settings._replace(chunk_sizes=(1 * suite.MiB,), segment_sizes=(16 * suite.MiB,), fleet_sizes=(1, 2))
+    results: Dict[str, suite.Measurement] = suite.run(settings, arguments.benchmarks)
+    suite.save(arguments.output, results, settings)
+    print(f"Results written to {arguments.output}.", file=sys.stderr)
+    if arguments.save_baseline:
+        suite.save(arguments.baseline, results, settings)
+        print(f"Baseline written to {arguments.baseline}.", file=sys.stderr)
+        return 0
+    if not os.path.exists(arguments.baseline):
+        print("No baseline to compare against, store one with --save-baseline.", file=sys.stderr)
+        return 0
+
+    baseline_settings, baseline = suite.load(arguments.baseline)
+    if baseline_settings != json.loads(json.dumps(settings._asdict())):
+        print("The baseline was measured with different settings, the comparison is only a rough guide.", file=sys.stderr)
+    regressions: List[str] = suite.compare(results, baseline, arguments.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    if not regressions:
+        print("No regressions against the baseline.", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# the VMs of the fake VirtualBox, in a json file shared by the fake vboxmanage and the stub virtualbox module
+from contextlib import contextmanager
+from typing import Dict, Iterator, TextIO, Tuple
+import fcntl
+import json
+import time
+import os
+
+STATE_FILE: str = os.environ.get("ALD_BENCH_VBOX_STATE", "")
+
+
+def new_machine(name: str) -> dict:
+    return {"name": name, "memory": "128", "vram": "8", "graphicscontroller": "vboxvga", "cpus": "1", "controllers": [], "attachments": {},
+            "extradata": {}, "snapshots": []}
+
+
+def acquire() -> Tuple[TextIO, Dict[str, dict]]:
+    # VirtualBox serialises changes to its registry too, a fleet running in parallel mustn't lose updates
+    lock: TextIO = open(f"{STATE_FILE}.lock", "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        with open(STATE_FILE, "r") as state:
+            return lock, json.load(state)
+    except (OSError, ValueError):
+        return lock, {}
+
+
+def release(lock: TextIO, vms: Dict[str, dict]):
+    try:
+        with open(STATE_FILE, "w") as state:
+            json.dump(vms, state)
+    finally:
+        lock.close()
+
+
+@contextmanager
+def locked_state() -> Iterator[Dict[str, dict]]:
+    lock, vms = acquire()
+    try:
+        yield vms
+    finally:
+        release(lock, vms)
+
+
+def delay(variable: str, subcommand: str = ""):
+    delays: Dict[str, float] = json.loads(os.getenv("ALD_BENCH_VBOX_DELAYS", "{}"))
+    time.sleep(delays.get(subcommand, float(os.getenv(variable, 0))))
@@ -0,0 +1 @@
+# stands in for the VirtualBox SDK bindings, the environment probe only locates it
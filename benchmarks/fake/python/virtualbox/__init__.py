@@ -0,0 +1,21 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# a stub of pyvbox (the `virtualbox` package) backed by the fake VirtualBox's json file, covering what
+# archlinux_deploy.vbox uses. ALD_BENCH_VBOX_API_DELAY seconds are spent in every call that would reach VBoxSVC.
+from virtualbox import library
+
+VirtualBox = library.IVirtualBox
+Session = library.ISession
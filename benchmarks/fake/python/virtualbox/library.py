@@ -0,0 +1,223 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Dict, List, Optional, TextIO
+import fake_vbox
+import copy
+import os
+
+
+def _call():
+    fake_vbox.delay("ALD_BENCH_VBOX_API_DELAY")
+
+
+class VBoxError(Exception):
+    pass
+
+
+class VBoxErrorObjectNotFound(VBoxError):
+    pass
+
+
+class VBoxErrorObjectInUse(VBoxError):
+    pass
+
+
+class VBoxErrorFileError(VBoxError):
+    pass
+
+
+class VBoxErrorInvalidObjectState(VBoxError):
+    pass
+
+
+# enumerations are plain strings here, named like the fake vboxmanage's values
+class LockType:
+    shared = "shared"
+    write = "write"
+
+
+class StorageBus:
+    ide = "ide"
+    sata = "sata"
+
+
+class StorageControllerType:
+    intel_ahci = "IntelAHCI"
+    piix3 = "PIIX3"
+    piix4 = "PIIX4"
+    ich6 = "ICH6"
+
+
+class DeviceType:
+    hard_disk = "hdd"
+    dvd = "dvddrive"
+
+
+class AccessMode:
+    read_only = "read_only"
+    read_write = "read_write"
+
+
+class GraphicsControllerType:
+    v_box_vga = "vboxvga"
+    vmsvga = "vmsvga"
+    v_box_svga = "vboxsvga"
+
+
+class MediumVariant:
+    standard = "Standard"
+    fixed = "Fixed"
+
+
+class IProgress:
+    def wait_for_completion(self, timeout: int):
+        pass
+
+
+class IMedium:
+    def __init__(self, location: str):
+        self.location = location
+
+    def create_base_storage(self, logical_size: int, variant: List[str]) -> IProgress:
+        _call()
+        if os.path.exists(self.location):
+            raise VBoxErrorFileError(f"Failed to create medium: file '{self.location}' already exists")
+        os.makedirs(os.path.dirname(self.location), exist_ok=True)
+        open(self.location, "wb").close()
+        return IProgress()
+
+
+class IStorageController:
+    def __init__(self, name: str):
+        self.name = name
+        self.controller_type: Optional[str] = None
+        self.bootable: bool = False
+
+
+class IMachine:
+    def __init__(self, name: str, settings: Optional[dict] = None, session: Optional["ISession"] = None):
+        self.name = name
+        self._settings: dict = settings if settings is not None else fake_vbox.new_machine(name)
+        self._session = session
+
+    def _setting(key: str, convert=str):
+        def get(self) -> Any:
+            return convert(self._settings[key])
+
+        def set(self, value: Any):
+            if self._session is None:
+                raise VBoxErrorInvalidObjectState("The machine is not mutable (state: PoweredOff)")
+            self._settings[key] = str(value)
+        return property(get, set)
+
+    memory_size = _setting("memory", int)
+    vram_size = _setting("vram", int)
+    graphics_controller_type = _setting("graphicscontroller")
+    cpu_count = _setting("cpus", int)
+    del _setting
+
+    def lock_machine(self, session: "ISession", lock_type: str):
+        _call()
+        session._lock(self.name)
+
+    def save_settings(self):
+        _call()
+        if self._session is not None:
+            self._session._vms[self.name] = copy.deepcopy(self._settings)
+
+    def discard_settings(self):
+        if self._session is not None:
+            self._settings = copy.deepcopy(self._session._vms[self.name])
+
+    def add_storage_controller(self, name: str, connection_type: str) -> IStorageController:
+        if name in self._settings["controllers"]:
+            raise VBoxErrorObjectInUse(f"Storage controller named '{name}' already exists")
+        self._settings["controllers"].append(name)
+        return IStorageController(name)
+
+    def attach_device(self, name: str, controller_port: int, device: int, type_p: str, medium: IMedium):
+        if name not in self._settings["controllers"]:
+            raise VBoxErrorObjectNotFound(f"Could not find a storage controller named '{name}'")
+        self._settings["attachments"][f"{name}-{controller_port}-{device}"] = medium.location
+
+    def detach_device(self, name: str, controller_port: int, device: int):
+        if self._settings["attachments"].pop(f"{name}-{controller_port}-{device}", None) is None:
+            raise VBoxErrorObjectNotFound(f"No storage device attached to device slot {device} on port {controller_port} of controller '{name}'")
+
+
+class ISession:
+    def __init__(self):
+        self.machine: Optional[IMachine] = None
+        self._file: Optional[TextIO] = None
+        self._vms: Dict[str, dict] = {}
+
+    def _lock(self, name: str):
+        if self._file is not None:
+            raise VBoxErrorInvalidObjectState("The given session is busy")
+        self._file, self._vms = fake_vbox.acquire()
+        self.machine = IMachine(name, copy.deepcopy(self._vms[name]), self)
+
+    def unlock_machine(self):
+        if self._file is None:
+            raise VBoxErrorInvalidObjectState("The session is not locked")
+        fake_vbox.release(self._file, self._vms)
+        self._file, self.machine = None, None
+
+
+class IVirtualBox:
+    def __init__(self):
+        _call()
+        self._media: Dict[str, List[IMedium]] = {DeviceType.hard_disk: [], DeviceType.dvd: []}
+
+    @property
+    def hard_disks(self) -> List[IMedium]:
+        return list(self._media[DeviceType.hard_disk])
+
+    @property
+    def dvd_images(self) -> List[IMedium]:
+        return list(self._media[DeviceType.dvd])
+
+    def find_machine(self, name_or_id: str) -> IMachine:
+        _call()
+        with fake_vbox.locked_state() as vms:
+            if name_or_id not in vms:
+                raise VBoxErrorObjectNotFound(f"Could not find a registered machine named '{name_or_id}'")
+            return IMachine(name_or_id, copy.deepcopy(vms[name_or_id]))
+
+    def compose_machine_filename(self, name: str, group: str, create_flags: str, base_folder: str) -> str:
+        return os.path.join(base_folder, name, f"{name}.vbox")
+
+    def create_machine(self, settings_file: str, name: str, groups: List[str], os_type_id: str, flags: str) -> IMachine:
+        _call()
+        return IMachine(name)
+
+    def register_machine(self, machine: IMachine):
+        _call()
+        with fake_vbox.locked_state() as vms:
+            if machine.name in vms:
+                raise VBoxErrorFileError(f"Machine settings file '{machine.name}.vbox' already exists")
+            vms[machine.name] = machine._settings
+
+    def create_medium(self, format_p: str, location: str, access_mode: str, a_device_type_type: str) -> IMedium:
+        return IMedium(location)
+
+    def open_medium(self, location: str, device_type: str, access_mode: str, force_new_uuid: bool) -> IMedium:
+        _call()
+        if not os.path.exists(location):
+            raise VBoxErrorFileError(f"Could not find file for the medium '{location}'")
+        medium: IMedium = IMedium(location)
+        self._media[device_type].append(medium)
+        return medium
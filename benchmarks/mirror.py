@@ -0,0 +1,214 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from email.utils import formatdate
+from typing import NamedTuple, Optional
+import threading
+import tempfile
+import hashlib
+import json
+import shutil
+import time
+import re
+import os
+
+LATEST_PATH: str = "/iso/latest/"
+_BLOCK_SIZE: int = 64 * 1024
+
+
+class MirrorConfig(NamedTuple):
+    iso_size: int = 64 * 1024 * 1024
+    bandwidth: int = 0  # bytes per second shared by every connection, 0 is unlimited
+    latency: float = 0.0  # seconds before each response starts
+    version: str = "2020.07.01"
+    seed: str = "archlinux-deploy"
+    revision: int = 0  # later revisions share most blocks with revision 0, like consecutive releases do
+    blockmap: bool = True  # publish <iso>.blockmap.json for delta updates
+
+
+def _block(*parts: object) -> bytes:
+    return hashlib.sha256("-".join(str(part) for part in parts).encode()).digest() * (_BLOCK_SIZE // 32)
+
+
+def synthetic_iso(path: str, size: int, seed: str = "archlinux-deploy", revision: int = 0):
+    # deterministic, so every run (and the baseline) downloads and hashes the same bytes. a later revision
+    # rewrites about a tenth of the blocks and inserts three sectors in the middle, which shifts everything after them
+    with open(path, "wb") as iso:
+        for index in range(0, size, _BLOCK_SIZE):
+            if revision and index == size // 2 // _BLOCK_SIZE * _BLOCK_SIZE:
+                iso.write(_block(seed, revision, "inserted")[:3 * 2048])
+            changed: bool = revision > 0 and _block(seed, revision, index)[0] < 26
+            block: bytes = _block(seed, revision, index, "changed") if changed else _block(seed, index)
+            iso.write(block[:min(_BLOCK_SIZE, size - index)])
+
+
+class _Throttle:
+    # a token bucket shared by every connection, like the one link all segments go through
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._allowance: float = 0.0
+        self._last: float = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: int):
+        if not self.rate:
+            return
+        with self._lock:
+            now: float = time.perf_counter()
+            self._allowance = min(self._allowance + (now - self._last) * self.rate, self.rate * 0.1)
+            self._last = now
+            self._allowance -= amount
+            wait: float = -self._allowance / self.rate if self._allowance < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+class Mirror:
+    def __init__(self, config: MirrorConfig = MirrorConfig()):
+        self.config = config
+        self.iso_name: str = f"archlinux-{config.version}-x86_64.iso"
+        self.directory: str = tempfile.mkdtemp(prefix="ald-mirror-")
+        self.iso_path: str = os.path.join(self.directory, self.iso_name)
+        synthetic_iso(self.iso_path, config.iso_size, config.seed, config.revision)
+        with open(self.iso_path, "rb") as iso:
+            self.sha256: str = hashlib.sha256(iso.read()).hexdigest()
+        self.blockmap: bytes = b""
+        if config.blockmap:
+            from archlinux_deploy import delta
+            self.blockmap = json.dumps(dict(delta.build_blockmap(self.iso_path)._asdict(), version=1)).encode()
+        self.last_modified: str = formatdate(usegmt=True)
+        self.requests: int = 0
+        self.bytes_sent: int = 0
+        self._counter_lock = threading.Lock()
+        self._throttle: _Throttle = _Throttle(config.bandwidth)
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        assert self._server is not None, "the mirror isn't running"
+        return f"http://127.0.0.1:{self._server.server_address[1]}/"
+
+    def index(self) -> bytes:
+        older: str = "archlinux-2020.06.01-x86_64.iso"
+        return (
+            f'<html><body><pre><a href="../">../</a>\n'
+            f'<a href="{older}">{older}</a>\n'
+            f'<a href="{self.iso_name}">{self.iso_name}</a>\n'
+            f'<a href="archlinux-x86_64.iso">archlinux-x86_64.iso</a>\n'
+            f'<a href="sha256sums.txt">sha256sums.txt</a>\n'
+            f'</pre></body></html>\n'
+        ).encode()
+
+    def checksums(self) -> bytes:
+        return f"{self.sha256}  {self.iso_name}\n{self.sha256}  archlinux-x86_64.iso\n".encode()
+
+    def start(self) -> "Mirror":
+        mirror: Mirror = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *arguments):
+                pass
+
+            def do_HEAD(self):
+                self.respond(head=True)
+
+            def do_GET(self):
+                self.respond(head=False)
+
+            def respond(self, head: bool):
+                with mirror._counter_lock:
+                    mirror.requests += 1
+                if mirror.config.latency:
+                    time.sleep(mirror.config.latency)
+                if self.path == LATEST_PATH:
+                    self.send_static(mirror.index(), "text/html", head)
+                elif self.path == LATEST_PATH + "sha256sums.txt":
+                    self.send_static(mirror.checksums(), "text/plain", head)
+                elif self.path == LATEST_PATH + mirror.iso_name + ".blockmap.json" and mirror.blockmap:
+                    self.send_static(mirror.blockmap, "application/json", head)
+                elif self.path in (LATEST_PATH + mirror.iso_name, LATEST_PATH + "archlinux-x86_64.iso"):
+                    self.send_iso(head)
+                else:
+                    self.send_error(404)
+
+            def send_static(self, body: bytes, content_type: str, head: bool):
+                etag: str = f'"{hashlib.md5(body).hexdigest()}"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", mirror.last_modified)
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+
+            def send_iso(self, head: bool):
+                size: int = os.path.getsize(mirror.iso_path)
+                start, end = 0, size - 1
+                match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+                if match:
+                    start, end = int(match.group(1)), min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+                    if start > end:
+                        self.send_error(416)
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                else:
+                    self.send_response(200)
+                self.send_header("Accept-Ranges", "bytes")
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                if head:
+                    return
+                with open(mirror.iso_path, "rb") as iso:
+                    iso.seek(start)
+                    remaining: int = end - start + 1
+                    while remaining:
+                        data: bytes = iso.read(min(_BLOCK_SIZE, remaining))
+                        mirror._throttle.consume(len(data))
+                        try:
+                            self.wfile.write(data)
+                        except (BrokenPipeError, ConnectionResetError):
+                            return
+                        with mirror._counter_lock:
+                            mirror.bytes_sent += len(data)
+                        remaining -= len(data)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self) -> "Mirror":
+        return self.start()
+
+    def __exit__(self, *exception):
+        self.stop()
@@ -0,0 +1,230 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from benchmarks.mirror import Mirror, MirrorConfig
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import subprocess
+import tempfile
+import shutil
+import json
+import time
+import sys
+import os
+
+ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_DIR: str = os.path.join(ROOT, "benchmarks", "fake")
+KiB: int = 1024
+MiB: int = 1024 * KiB
+
+
+class Measurement(NamedTuple):
+    value: float
+    unit: str
+    better: str  # "lower" or "higher"
+    tolerance: float  # how far off the baseline it may be, relative, before it counts as a regression
+
+
+def seconds(value: float) -> Measurement:
+    return Measurement(value, "s", "lower", 0.25)
+
+
+def throughput(value: float) -> Measurement:
+    return Measurement(value, "MiB/s", "higher", 0.2)
+
+
+def processes(value: int) -> Measurement:
+    # deterministic, any extra vboxmanage call is a regression
+    return Measurement(value, "processes", "lower", 0.0)
+
+
+class Sandbox:
+    # a cache directory, a VM folder and a fake VirtualBox of its own, so every cold run is really cold
+    def __init__(self, mirror: Mirror, vbox_delay: float, api_delay: float = 0.0, **environment: str):
+        self.directory: str = tempfile.mkdtemp(prefix="ald-bench-")
+        self.mirror = mirror
+        self.environment: Dict[str, str] = dict(
+            os.environ,
+            PATH=os.path.join(FAKE_DIR, "bin") + os.pathsep + os.environ.get("PATH", ""),
+            PYTHONPATH=os.pathsep.join([os.path.join(FAKE_DIR, "python"), ROOT] + ([os.environ["PYTHONPATH"]] if "PYTHONPATH" in os.environ else [])),
+            ALD_CACHE_DIR=os.path.join(self.directory, "cache"),
+            ALD_VBOX_VMS_LOCATION=os.path.join(self.directory, "VirtualBox VMs"),
+            ALD_MIRRORS=mirror.url,
+            ALD_VM_IGNORE_DUPLICATES="1",
+            ALD_ADMISSION="off",  # the fake VMs never run, and the results shouldn't depend on the size of the machine
+            ALD_BENCH_VBOX_STATE=os.path.join(self.directory, "vbox.json"),
+            ALD_BENCH_VBOX_DELAY=str(vbox_delay),
+            ALD_BENCH_VBOX_API_DELAY=str(api_delay),
+        )
+        self.environment.update(environment)
+
+    def run(self, *arguments: str, **environment: str) -> Tuple[float, dict]:
+        # a whole cli invocation, interpreter startup included, that's what a user waits for
+        report_path: str = os.path.join(self.directory, "report.json")
+        started: float = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, "-m", "archlinux_deploy", "--report", report_path] + list(arguments),
+            env=dict(self.environment, **environment), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True
+        )
+        elapsed: float = time.perf_counter() - started
+        if completed.returncode != 0:
+            raise RuntimeError(f"'archlinux-deploy {' '.join(arguments)}' failed:\n{completed.stdout}")
+        with open(report_path, "r") as report:
+            return elapsed, json.load(report)
+
+    def __enter__(self) -> "Sandbox":
+        return self
+
+    def __exit__(self, *exception):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def bench_download(mirror: Mirror, vbox_delay: float, chunk_sizes: List[int], segment_sizes: List[int]) -> Dict[str, Measurement]:
+    results: Dict[str, Measurement] = {}
+    for chunk_size in chunk_sizes:
+        for segment_size in segment_sizes:
+            with Sandbox(mirror, vbox_delay, ALD_DOWNLOAD_CHUNK_SIZE=str(chunk_size), ALD_DOWNLOAD_SEGMENT_SIZE=str(segment_size)) as sandbox:
+                _, report = sandbox.run("prepare")
+            download: dict = report["downloads"][0]
+            results[f"download.chunk_{chunk_size // KiB}k.segment_{segment_size // MiB}m.throughput"] = throughput(download["throughput"] / MiB)
+    return results
+
+
+def bench_stage2(mirror: Mirror, vbox_delay: float, api_delay: float) -> Dict[str, Measurement]:
+    # once through the (stub) VirtualBox API and once with vboxmanage only
+    results: Dict[str, Measurement] = {}
+    for mode, enabled in (("api", "1"), ("vboxmanage", "0")):
+        with Sandbox(mirror, vbox_delay, api_delay, ALD_VBOX_API=enabled) as sandbox:
+            sandbox.run("prepare")
+            cold_seconds, cold = sandbox.run("adapt")
+            warm_seconds, warm = sandbox.run("adapt")
+            # the sandbox turns admission off, a rerun of an existing VM shouldn't cost more with it on
+            admitted_seconds, admitted = sandbox.run("adapt", ALD_ADMISSION="refuse")
+        results.update({
+            f"stage2.{mode}.cold.seconds": seconds(cold_seconds),
+            f"stage2.{mode}.cold.processes": processes(len(cold["commands"])),
+            f"stage2.{mode}.warm.seconds": seconds(warm_seconds),
+            f"stage2.{mode}.warm.processes": processes(len(warm["commands"])),
+            f"stage2.{mode}.warm_admission.seconds": seconds(admitted_seconds),
+            f"stage2.{mode}.warm_admission.processes": processes(len(admitted["commands"])),
+        })
+    return results
+
+
+def bench_deploy(mirror: Mirror, vbox_delay: float) -> Dict[str, Measurement]:
+    with Sandbox(mirror, vbox_delay) as sandbox:
+        cold_seconds, _ = sandbox.run("deploy")
+        warm_seconds, warm = sandbox.run("deploy")
+    hits: int = sum(counts["hits"] for counts in warm["caches"].values())
+    misses: int = sum(counts["misses"] for counts in warm["caches"].values())
+    return {
+        "deploy.cold.seconds": seconds(cold_seconds),
+        "deploy.warm.seconds": seconds(warm_seconds),
+        "deploy.warm.cache_misses": Measurement(misses, "misses", "lower", 0.0),
+        "deploy.warm.cache_hits": Measurement(hits, "hits", "higher", 0.0),
+    }
+
+
+def bench_fleet(mirror: Mirror, vbox_delay: float, sizes: List[int]) -> Dict[str, Measurement]:
+    results: Dict[str, Measurement] = {}
+    for size in sizes:
+        with Sandbox(mirror, vbox_delay, ALD_FLEET_COUNT=str(size)) as sandbox:
+            sandbox.run("prepare")
+            elapsed, _ = sandbox.run("fleet", "--workers", str(size))
+        results[f"fleet.vms_{size}.seconds"] = seconds(elapsed)
+        results[f"fleet.vms_{size}.seconds_per_vm"] = seconds(elapsed / size)
+    return results
+
+
+def bench_delta(mirror: Mirror, vbox_delay: float) -> Dict[str, Measurement]:
+    # the next month's release on another mirror, updated from the ISO `mirror` serves, then downloaded in full
+    config: MirrorConfig = mirror.config._replace(version="2020.08.01", revision=mirror.config.revision + 1)
+    results: Dict[str, Measurement] = {}
+    with Mirror(config) as next_release:
+        for mode, enabled in (("delta", "1"), ("full", "0")):
+            with Sandbox(mirror, vbox_delay, ALD_DELTA_UPDATES=enabled) as sandbox:
+                sandbox.run("prepare")
+                elapsed, report = sandbox.run("prepare", ALD_MIRRORS=next_release.url)
+            results[f"update.{mode}.seconds"] = seconds(elapsed)
+            results[f"update.{mode}.downloaded"] = Measurement(
+                sum(download["bytes"] for download in report["downloads"]) / MiB, "MiB", "lower", 0.05
+            )
+    return results
+
+
+class Settings(NamedTuple):
+    iso_size: int = 64 * MiB
+    bandwidth: int = 0
+    latency: float = 0.0
+    vbox_delay: float = 0.02
+    api_delay: float = 0.002
+    chunk_sizes: Tuple[int, ...] = (64 * KiB, 1 * MiB)
+    segment_sizes: Tuple[int, ...] = (4 * MiB, 16 * MiB)
+    fleet_sizes: Tuple[int, ...] = (1, 2, 4)
+
+
+def run(settings: Settings = Settings(), only: Optional[List[str]] = None) -> Dict[str, Measurement]:
+    benchmarks = {
+        "download": lambda mirror: bench_download(mirror, settings.vbox_delay, list(settings.chunk_sizes), list(settings.segment_sizes)),
+        "stage2": lambda mirror: bench_stage2(mirror, settings.vbox_delay, settings.api_delay),
+        "deploy": lambda mirror: bench_deploy(mirror, settings.vbox_delay),
+        "delta": lambda mirror: bench_delta(mirror, settings.vbox_delay),
+        "fleet": lambda mirror: bench_fleet(mirror, settings.vbox_delay, list(settings.fleet_sizes)),
+    }
+    results: Dict[str, Measurement] = {}
+    with Mirror(MirrorConfig(settings.iso_size, settings.bandwidth, settings.latency)) as mirror:
+        for name, benchmark in benchmarks.items():
+            if only and name not in only:
+                continue
+            print(f"Running the {name} benchmark...", file=sys.stderr)
+            for metric, measurement in benchmark(mirror).items():
+                print(f"{metric:>50}: {measurement.value:10.3f} {measurement.unit}", file=sys.stderr)
+                results[metric] = measurement
+    return results
+
+
+def save(path: str, results: Dict[str, Measurement], settings: Settings):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump({
+            "settings": settings._asdict(),
+            "python": sys.version.split()[0],
+            "results": {metric: measurement._asdict() for metric, measurement in results.items()},
+        }, file, indent=2)
+
+
+def load(path: str) -> Tuple[dict, Dict[str, Measurement]]:
+    with open(path, "r") as file:
+        data: dict = json.load(file)
+    return data["settings"], {metric: Measurement(**measurement) for metric, measurement in data["results"].items()}
+
+
+def compare(results: Dict[str, Measurement], baseline: Dict[str, Measurement], tolerance: Optional[float] = None) -> List[str]:
+    # `tolerance` overrides the per metric one for timings and throughput, counts always have to match exactly
+    regressions: List[str] = []
+    for metric, measurement in sorted(results.items()):
+        expected: Optional[Measurement] = baseline.get(metric)
+        if expected is None:
+            continue
+        allowed: float = tolerance if tolerance is not None and expected.tolerance else expected.tolerance
+        if expected.better == "lower":
+            regressed: bool = measurement.value > expected.value * (1 + allowed)
+        else:
+            regressed = measurement.value < expected.value * (1 - allowed)
+        if regressed:
+            regressions.append(
+                f"{metric}: {measurement.value:.3f} {measurement.unit}, baseline {expected.value:.3f} {expected.unit} "
+                f"({expected.better} is better, {allowed:.0%} allowed)"
+            )
+    return regressions
@@ -29,10 +29,13 @@ setup(
     long_description_content_type='text/markdown',
     author="ALinuxPerson",
     author_email="micheal02052007@gmail.com",
-    python_requires=">=3.6.0",
+    python_requires=">=3.8.0",
     url="https://github.com/ALinuxPerson/archlinux-deploy",
-    packages=find_packages(exclude=["tests", "*.tests", "*.tests.*", "tests.*"]),
+    packages=find_packages(exclude=["tests", "*.tests", "*.tests.*", "tests.*", "benchmarks", "benchmarks.*"]),
     install_requires=requirements,
+    entry_points={
+        "console_scripts": ["archlinux-deploy=archlinux_deploy.cli:main"]
+    },
     include_package_data=True,
     license='GNU GPLv3',
     classifiers=[
@@ -46,8 +49,6 @@ setup(
         "Operating System :: POSIX :: Linux",
         "Operating System :: MacOS :: MacOS X",
         "Operating System :: POSIX :: BSD :: FreeBSD",
-        "Programming Language :: Python :: 3.6",
-        "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: Implementation :: CPython",
         "Topic :: Software Development :: Libraries :: Python Modules",
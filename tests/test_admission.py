@@ -0,0 +1,188 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy import admission, disks, utils
+from archlinux_deploy.spec import VMSpec
+from archlinux_deploy.state import parse_vm_list
+from typing import List
+import os
+
+import pytest
+
+FIXTURES: str = os.path.join(os.path.dirname(__file__), "fixtures")
+PROC: str = os.path.join(FIXTURES, "proc")
+GiB: int = 1024 * 1024 * 1024
+
+
+def fixture(*path: str) -> str:
+    with open(os.path.join(FIXTURES, *path), "r") as fixture_file:
+        return fixture_file.read()
+
+
+@pytest.fixture
+def host() -> admission.Host:
+    return admission.Host(memory=16000, available_memory=12000, cpus=8, free_disk=100 * 1024)
+
+
+@pytest.fixture
+def allocations() -> List[admission.Allocation]:
+    return [
+        admission.parse_allocation("build-1", fixture("showvminfo", "running.txt")),
+        admission.parse_allocation("build-2", fixture("showvminfo", "poweroff.txt")),
+        admission.Allocation("arch-linux-base-0123456789ab", 8192, 8, "poweroff"),
+    ]
+
+
+@pytest.fixture
+def messages(monkeypatch) -> List[str]:
+    printed: List[str] = []
+    monkeypatch.setattr(utils, "colored_output", lambda message, level: printed.append(f"{level}: {message}"))
+    return printed
+
+
+def test_parse_meminfo():
+    meminfo = admission.parse_meminfo(fixture("proc", "meminfo"))
+    assert meminfo["MemTotal"] == 16303260
+    assert meminfo["MemAvailable"] == 9871044
+    assert meminfo["HugePages_Total"] == 0
+
+
+def test_parse_cpuinfo():
+    assert admission.parse_cpuinfo(fixture("proc", "cpuinfo")) == 8
+    assert admission.parse_cpuinfo("") == 0
+
+
+def test_read_host(tmp_path):
+    assert admission.read_host(PROC, str(tmp_path)) == admission.Host(15921, 9639, 8, disks.free_space(str(tmp_path)) // admission.MB)
+
+
+def test_read_host_falls_back_to_memfree_and_cached(tmp_path):
+    (tmp_path / "meminfo").write_text("MemTotal: 2048000 kB\nMemFree: 512000 kB\nCached: 512000 kB\n")
+    (tmp_path / "cpuinfo").write_text("processor : 0\n")
+    host = admission.read_host(str(tmp_path), str(tmp_path))
+    assert (host.memory, host.available_memory, host.cpus) == (2000, 1000, 1)
+
+
+def test_read_host_without_proc(tmp_path):
+    assert admission.read_host(str(tmp_path / "proc"), str(tmp_path)) is None
+
+
+def test_parse_allocation():
+    assert admission.parse_allocation("build-1", fixture("showvminfo", "running.txt")) == admission.Allocation("build-1", 4096, 4, "running")
+    assert parse_vm_list(fixture("list-vms.txt")) == ["build-1", "build-2", "arch-linux-base-0123456789ab"]
+
+
+def test_decide_counts_other_vms_but_not_bases(host, allocations):
+    decision = admission.decide(VMSpec(name="new", memory=2048, cpus=2), host, allocations, admission.Policy(), 16)
+    assert decision.admitted
+    assert "other VMs: 6144 MB memory, 6 vCPU(s) in 2 VM(s)" in "\n".join(decision.report)
+
+
+def test_decide_ignores_the_vm_itself(host, allocations):
+    decision = admission.decide(VMSpec(name="build-1", memory=4096, cpus=4), host, allocations, admission.Policy(), 16)
+    assert "in 1 VM(s)" in "\n".join(decision.report)
+
+
+def test_decide_refuses_memory_over_the_ratio(host, allocations):
+    # 80% of 16000 MB is 12800 MB, 6144 MB of it are taken
+    decision = admission.decide(VMSpec(name="new", memory=8192), host, allocations, admission.Policy(memory_ratio=0.8), 16)
+    assert not decision.admitted
+    assert any("over the 6656 MB left for VMs" in line for line in decision.report)
+
+
+def test_decide_refuses_memory_the_host_doesnt_have(host):
+    decision = admission.decide(VMSpec(name="new", memory=12288), host._replace(memory=64000), [], admission.Policy(), 16)
+    assert not decision.admitted
+    assert any("12000 MB the host has available" in line for line in decision.report)
+
+
+def test_decide_refuses_cpus(host, allocations):
+    assert admission.decide(VMSpec(name="new", cpus=10), host, allocations, admission.Policy(cpu_ratio=2), 16).admitted is False
+    assert admission.decide(VMSpec(name="new", cpus=6), host, [], admission.Policy(cpu_ratio=0.5), 16).admitted is False
+
+
+def test_decide_refuses_disk(host):
+    decision = admission.decide(VMSpec(name="new"), host._replace(free_disk=2048), [], admission.Policy(), 20480)
+    assert not decision.admitted
+    assert any("MB of disk space" in line for line in decision.report)
+
+
+def test_decide_can_leave_stopped_vms_out(host, allocations):
+    policy = admission.Policy(count_stopped=False)
+    assert "other VMs: 4096 MB memory, 4 vCPU(s) in 1 VM(s)" in "\n".join(admission.decide(VMSpec(name="new"), host, allocations, policy, 16).report)
+
+
+def test_decide_sizes_from_fractions(host, allocations):
+    # 12800 - 6144 MB left, half of it rounded down to 64 MB; 16 - 6 vCPUs left, a quarter of it
+    policy = admission.Policy(memory_fraction=0.5, cpu_fraction=0.25, min_memory=512)
+    decision = admission.decide(VMSpec(name="new"), host, allocations, policy, 16)
+    assert decision.admitted
+    assert (decision.spec.memory, decision.spec.cpus) == (3328, 2)
+
+
+def test_decide_sizes_at_least_the_minimum(host):
+    policy = admission.Policy(memory_fraction=0.01, cpu_fraction=0.01, min_memory=512)
+    decision = admission.decide(VMSpec(name="new"), host, [], policy, 16)
+    assert (decision.spec.memory, decision.spec.cpus) == (512, 1)
+
+
+def test_reconciled():
+    info = {"memory": "2048", "cpus": "2"}
+    policy = admission.Policy(memory_fraction=0, cpu_fraction=0)
+    assert admission.reconciled(VMSpec(memory=2048, cpus=2), info, policy) == VMSpec(memory=2048, cpus=2)
+    assert admission.reconciled(VMSpec(memory=1024, cpus=1), info, policy) is not None
+    assert admission.reconciled(VMSpec(memory=4096, cpus=2), info, policy) is None
+    assert admission.reconciled(VMSpec(memory=2048, cpus=4), info, policy) is None
+    assert admission.reconciled(VMSpec(), None, policy) is None
+    # sized by the fractions when it was created, and it keeps that size
+    assert admission.reconciled(VMSpec(memory=1024, cpus=1), info, policy._replace(memory_fraction=0.5, cpu_fraction=0.5)) == VMSpec(memory=2048, cpus=2)
+
+
+def test_admit_all_counts_each_admitted_vm_against_the_next(monkeypatch, messages, allocations):
+    monkeypatch.setattr(admission, "read_allocations", lambda vboxmanage: allocations)
+    monkeypatch.setattr(disks, "free_space", lambda path=None: 100 * GiB)
+    specs = [VMSpec(name=f"ci-{index}", memory=2048, cpus=2) for index in range(1, 5)]
+    # 12736 MB may be used, 6144 are taken, so three more 2048 MB VMs fit
+    admitted, refused = admission.admit_all("vboxmanage", specs, admission.Policy(mode="refuse", memory_ratio=0.8, cpu_ratio=4), proc_root=PROC)
+    assert [spec.name for spec in admitted] == ["ci-1", "ci-2", "ci-3"]
+    assert [decision.spec.name for decision in refused] == ["ci-4"]
+    assert any(message.startswith("error: ci-4") for message in messages)
+
+
+def test_admit_refuses(monkeypatch, messages):
+    monkeypatch.setattr(admission, "read_allocations", lambda vboxmanage: [])
+    with pytest.raises(BaseStageException, match="can't take huge without overcommitting"):
+        admission.admit("vboxmanage", VMSpec(name="huge", memory=10 ** 9), admission.Policy(mode="refuse"))
+
+
+def test_admit_only_warns_for_a_dry_run(monkeypatch, messages):
+    monkeypatch.setattr(admission, "read_allocations", lambda vboxmanage: [])
+    spec = VMSpec(name="huge", memory=10 ** 9)
+    assert admission.admit("vboxmanage", spec, admission.Policy(mode="warn")) == spec
+    assert any(message.startswith("warn: huge") for message in messages)
+
+
+def test_admit_all_without_proc(monkeypatch, messages, tmp_path):
+    monkeypatch.setattr(admission, "read_allocations", lambda vboxmanage: pytest.fail("shouldn't ask VirtualBox"))
+    specs = [VMSpec(name="new")]
+    assert admission.admit_all("vboxmanage", specs, admission.Policy(mode="refuse"), proc_root=str(tmp_path / "proc")) == (specs, [])
+    assert messages and messages[0].startswith("warn:")
+
+
+def test_admit_all_off(monkeypatch):
+    monkeypatch.setattr(admission, "read_allocations", lambda vboxmanage: pytest.fail("shouldn't ask VirtualBox"))
+    specs = [VMSpec(name="new", memory=10 ** 9)]
+    assert admission.admit_all("vboxmanage", specs, admission.Policy(mode="off")) == (specs, [])
@@ -0,0 +1,78 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# delta updates between two synthetic releases served by local mirrors
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from benchmarks.mirror import LATEST_PATH, Mirror, MirrorConfig
+from archlinux_deploy import delta, download, iso_cache
+from typing import Iterator, Tuple
+import time
+import os
+
+import pytest
+
+MiB: int = 1024 * 1024
+CONFIG: MirrorConfig = MirrorConfig(iso_size=8 * MiB)
+
+
+@pytest.fixture
+def releases() -> Iterator[Tuple[Mirror, Mirror]]:
+    with Mirror(CONFIG) as previous, Mirror(CONFIG._replace(version="2020.08.01", revision=1)) as following:
+        yield previous, following
+
+
+def iso_url(mirror: Mirror) -> str:
+    return mirror.url.rstrip("/") + LATEST_PATH + mirror.iso_name
+
+
+def test_update_fetches_only_what_changed(releases, tmp_path):
+    previous, following = releases
+    destination: str = str(tmp_path / following.iso_name)
+    assert delta.update(previous.iso_path, iso_url(following), destination, following.sha256, segment_size=MiB)
+    assert following.bytes_sent < CONFIG.iso_size // 2
+    assert os.listdir(tmp_path) == [following.iso_name]
+
+
+def test_interrupted_update_resumes(releases, tmp_path, monkeypatch):
+    previous, following = releases
+    destination: str = str(tmp_path / following.iso_name)
+    fetch_segment = download._fetch_segment
+    failed: list = []
+
+    def failing_one_segment(session, url, segment, *arguments):
+        if not failed:
+            failed.append(segment)
+            time.sleep(0.5)  # after every other segment is in
+            raise BaseStageException("the connection dropped")
+        fetch_segment(session, url, segment, *arguments)
+
+    monkeypatch.setattr(download, "_fetch_segment", failing_one_segment)
+    with pytest.raises(BaseStageException, match="the connection dropped"):
+        delta.update(previous.iso_path, iso_url(following), destination, following.sha256, workers=32, segment_size=MiB)
+    fetched: int = following.bytes_sent
+    assert fetched > 0
+
+    assert delta.update(previous.iso_path, iso_url(following), destination, following.sha256, segment_size=MiB)
+    assert following.bytes_sent - fetched == failed[0].size
+    assert os.listdir(tmp_path) == [following.iso_name]
+
+
+def test_unreadable_previous_iso_falls_back(releases, tmp_path, monkeypatch):
+    _, following = releases
+    missing: iso_cache.CachedIso = iso_cache.CachedIso("2020.07.01", "0" * 64, str(tmp_path / "gone.iso"))
+    monkeypatch.setattr(iso_cache, "DELTA_UPDATES", True)
+    monkeypatch.setattr(iso_cache, "current", lambda: missing)
+    wanted: iso_cache.CachedIso = iso_cache.CachedIso("2020.08.01", following.sha256, str(tmp_path / following.iso_name))
+    assert iso_cache._update_from_previous(iso_url(following), wanted) is False
@@ -0,0 +1,86 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# the segmented download against local mirrors
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from benchmarks.mirror import LATEST_PATH, Mirror, MirrorConfig
+from archlinux_deploy import download
+from typing import Iterator, Tuple
+import hashlib
+import time
+import os
+
+import pytest
+
+MiB: int = 1024 * 1024
+
+
+@pytest.fixture
+def two_mirrors() -> Iterator[Tuple[Mirror, Mirror]]:
+    # the same release on two mirrors
+    with Mirror(MirrorConfig(iso_size=8 * MiB)) as first, Mirror(MirrorConfig(iso_size=8 * MiB)) as second:
+        yield first, second
+
+
+def iso_url(mirror: Mirror) -> str:
+    return mirror.url.rstrip("/") + LATEST_PATH + mirror.iso_name
+
+
+def sha256(path: str) -> str:
+    with open(path, "rb") as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def test_download(two_mirrors, tmp_path):
+    mirror, _ = two_mirrors
+    destination: str = str(tmp_path / mirror.iso_name)
+    hasher: download.StreamingHasher = download.StreamingHasher("sha256", buffer_limit=MiB)
+    download.download(iso_url(mirror), destination, workers=4, segment_size=MiB, on_data=hasher.feed)
+    assert hasher.finish(destination) == sha256(destination) == mirror.sha256
+    assert os.listdir(tmp_path) == [mirror.iso_name]
+
+
+def test_interrupted_download_resumes_on_another_mirror(two_mirrors, tmp_path, monkeypatch):
+    first, second = two_mirrors
+    destination: str = str(tmp_path / first.iso_name)
+    fetch_segment = download._fetch_segment
+
+    def failing_last_segment(session, url, segment, *arguments):
+        if segment.end == 8 * MiB - 1:
+            time.sleep(0.5)  # after every other segment is in
+            raise BaseStageException("the connection dropped")
+        fetch_segment(session, url, segment, *arguments)
+
+    monkeypatch.setattr(download, "_fetch_segment", failing_last_segment)
+    with pytest.raises(BaseStageException, match="the connection dropped"):
+        download.download(iso_url(first), destination, workers=8, segment_size=MiB)
+    assert not os.path.exists(destination)
+    monkeypatch.setattr(download, "_fetch_segment", fetch_segment)
+
+    # segments from the first run aren't fed again, finish() hashes them from disk
+    hasher: download.StreamingHasher = download.StreamingHasher("sha256")
+    download.download(iso_url(second), destination, workers=8, segment_size=MiB, on_data=hasher.feed)
+    assert second.bytes_sent == MiB
+    assert hasher.finish(destination) == second.sha256
+    assert os.listdir(tmp_path) == [first.iso_name]
+
+
+def test_journal_of_another_segmentation_starts_over(two_mirrors, tmp_path):
+    mirror, _ = two_mirrors
+    journal: download.Journal = download.Journal(str(tmp_path / "journal.json"), mirror.iso_name, 8 * MiB, MiB)
+    journal.mark(download.Segment(0, MiB - 1))
+    assert download.Journal(journal.path, mirror.iso_name, 8 * MiB, MiB).load().completed == {0}
+    assert download.Journal(journal.path, mirror.iso_name, 8 * MiB, 2 * MiB).load().completed == set()
+    assert download.Journal(journal.path, "archlinux-2020.08.01-x86_64.iso", 8 * MiB, MiB).load().completed == set()
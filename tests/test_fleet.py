@@ -0,0 +1,63 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# whole fleet runs through the cli, in the benchmarks' sandbox with its fake VirtualBox and a local mirror
+from benchmarks.mirror import Mirror, MirrorConfig
+from benchmarks.suite import Sandbox
+from typing import Iterator
+import json
+import os
+
+import pytest
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="the fake vboxmanage needs fcntl")
+
+
+@pytest.fixture(scope="module")
+def mirror() -> Iterator[Mirror]:
+    with Mirror(MirrorConfig(iso_size=4 * 1024 * 1024)) as running:
+        yield running
+
+
+def vms(sandbox: Sandbox) -> dict:
+    with open(sandbox.environment["ALD_BENCH_VBOX_STATE"], "r") as state:
+        return json.load(state)
+
+
+@pytest.mark.parametrize("golden", [False, True])
+def test_vms_of_a_dead_worker_are_retried(mirror, golden):
+    # the worker dies right after registering vm-1, which the retry finds half made
+    subcommand: str = "clonevm" if golden else "createvm"
+    with Sandbox(mirror, 0.0, ALD_VBOX_API="0", ALD_VM_IGNORE_DUPLICATES="0", ALD_FLEET_COUNT="2", ALD_FLEET_TEMPLATE="vm-{index}") as sandbox:
+        sandbox.run("prepare")
+        sandbox.run("fleet", *(["--golden"] if golden else []), ALD_BENCH_VBOX_CRASH=f"{subcommand}:vm-1")
+        assert os.path.exists(f"{sandbox.environment['ALD_BENCH_VBOX_STATE']}.crashed-vm-1")
+        for name in ("vm-1", "vm-2"):
+            vm: dict = vms(sandbox)[name]
+            if golden:
+                assert "archlinux-deploy/base" in vm["extradata"]
+            else:
+                assert len(vm["attachments"]) == 2
+
+
+def test_retries_dont_take_over_a_vm_that_was_there_before(mirror):
+    # vm-1 kills the only worker before vm-2, which the user made themselves, was even started
+    with Sandbox(mirror, 0.0, ALD_VBOX_API="0", ALD_VM_IGNORE_DUPLICATES="0", ALD_FLEET_COUNT="2", ALD_FLEET_TEMPLATE="vm-{index}") as sandbox:
+        sandbox.run("prepare")
+        sandbox.run("adapt", "--name", "vm-2", "--memory", "512")
+        with pytest.raises(RuntimeError, match="vm-2: FAILED"):
+            sandbox.run("fleet", "--workers", "1", ALD_BENCH_VBOX_CRASH="createvm:vm-1")
+        assert len(vms(sandbox)["vm-1"]["attachments"]) == 2
+        assert vms(sandbox)["vm-2"]["memory"] == "512"
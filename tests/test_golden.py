@@ -0,0 +1,74 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# golden bases and linked clones against the benchmarks' fake vboxmanage
+from archlinux_deploy.stages import vm_adapt
+from archlinux_deploy.spec import VMSpec
+from archlinux_deploy import golden, iso_cache
+import os
+
+import pytest
+
+VBOXMANAGE: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fake", "bin", "vboxmanage")
+ISO: iso_cache.CachedIso = iso_cache.CachedIso("2020.07.01", "d801a2d3" * 8, "archlinux-2020.07.01-x86_64.iso")
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="the fake vboxmanage needs fcntl")
+
+
+@pytest.fixture(autouse=True)
+def fake_vbox(tmp_path, monkeypatch):
+    monkeypatch.setenv("ALD_BENCH_VBOX_STATE", str(tmp_path / "vbox.json"))
+    monkeypatch.delenv("ALD_BENCH_VBOX_DELAY", raising=False)
+    monkeypatch.delenv("ALD_BENCH_VBOX_DELAYS", raising=False)
+    monkeypatch.setattr(golden, "GOLDEN_STATE_FILE", str(tmp_path / "golden.json"))
+    monkeypatch.setattr(iso_cache, "current", lambda: ISO)
+    monkeypatch.setattr(vm_adapt, "vbox_manage_command", lambda: VBOXMANAGE)
+    # stage 2 itself is covered by the benchmarks, a registered VM is all a base needs here
+    monkeypatch.setattr(vm_adapt, "run", lambda spec, dry_run, admit: bool(golden._vboxmanage("createvm", "--name", spec.name, "--register")))
+
+
+def fleet(*specs: VMSpec):
+    for spec, base in zip(specs, golden.rebuild_all(list(specs))):
+        golden.clone(spec, base)
+
+
+def test_clones_of_every_layout_are_current():
+    fleet(VMSpec("a", hdd_size=1024), VMSpec("b", hdd_size=2048), VMSpec("c", hdd_size=2048, hdd_variant="Fixed"))
+    assert len(golden.current_bases(ISO.sha256)) == 3
+    for hdd_size in (1024, 2048):
+        assert golden.stale_clones(VMSpec(hdd_size=hdd_size)) == []
+
+
+def test_a_new_iso_makes_every_clone_stale(monkeypatch):
+    fleet(VMSpec("a", hdd_size=1024), VMSpec("b", hdd_size=2048))
+    monkeypatch.setattr(iso_cache, "current", lambda: ISO._replace(sha256="0" * 64))
+    assert golden.stale_clones() == ["a", "b"]
+
+
+def test_forced_rebuild_keeps_the_base_of_existing_clones():
+    fleet(VMSpec("a", hdd_size=1024), VMSpec("b", hdd_size=2048))
+    old: golden.Base = golden.current_bases(ISO.sha256)[golden.fingerprint(VMSpec(hdd_size=1024), ISO)]
+    new: golden.Base = golden.rebuild(VMSpec(hdd_size=1024), force=True)
+    assert new.name == f"{old.name}-2"
+    assert old.name in golden.registered_vms()
+    assert golden.stale_clones() == ["a"]
+    golden.clone(VMSpec("c", hdd_size=1024))
+    assert golden.clones()["c"].name == new.name
+
+
+def test_forced_rebuild_without_clones_reuses_the_name():
+    base: golden.Base = golden.rebuild(VMSpec(hdd_size=1024))
+    assert golden.rebuild(VMSpec(hdd_size=1024), force=True).name == base.name
+    assert golden.registered_vms() == [base.name]
@@ -0,0 +1,42 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import metrics
+import collections
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def empty():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+
+def series(text: str) -> collections.Counter:
+    return collections.Counter(line.rsplit(" ", 1)[0] for line in text.splitlines() if not line.startswith("#"))
+
+
+def test_every_series_appears_once():
+    # node_exporter's textfile collector rejects the whole file over a single duplicate
+    for vm in ("base-a", "base-b", "base-a"):
+        metrics.record_substage("create_vm", 2, 1.5, True, vm)
+    metrics.merge({"substages": [{"name": "create_vm", "stage": 2, "seconds": 1.0, "succeeded": True}]}, vm="ci-1")
+    metrics.merge({"substages": [{"name": "create_vm", "stage": 2, "seconds": 1.0, "succeeded": True}]}, vm="ci-1")
+    text: str = metrics.prometheus(metrics.report("fleet"))
+    assert max(series(text).values()) == 1
+    assert 'archlinux_deploy_substage_seconds{stage="2",substage="create_vm",vm="base-a"} 3.0' in text
+    assert 'archlinux_deploy_substage_seconds{stage="2",substage="create_vm",vm="ci-1"} 2.0' in text
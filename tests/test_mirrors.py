@@ -0,0 +1,93 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# mirror selection against local mirrors with artificial latency and bandwidth limits
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from benchmarks.mirror import Mirror, MirrorConfig
+from archlinux_deploy import mirrors, releases
+from typing import Iterator, Tuple
+
+import pytest
+
+MiB: int = 1024 * 1024
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(mirrors, "MIRROR_CACHE_FILE", str(tmp_path / "mirrors.json"))
+    monkeypatch.setattr(releases, "RELEASE_CACHE_FILE", str(tmp_path / "releases.json"))
+    monkeypatch.setattr(mirrors, "_ranked", None)
+
+
+@pytest.fixture
+def slow_and_fast() -> Iterator[Tuple[Mirror, Mirror]]:
+    with Mirror(MirrorConfig(iso_size=2 * MiB, latency=0.1, bandwidth=2 * MiB)) as slow:
+        with Mirror(MirrorConfig(iso_size=2 * MiB)) as fast:
+            yield slow, fast
+
+
+def test_fastest_mirror_wins(slow_and_fast):
+    slow, fast = slow_and_fast
+    ranking = mirrors.probe_all([slow.url, fast.url])
+    assert [result.mirror for result in ranking] == [fast.url, slow.url]
+    assert all(result.healthy for result in ranking)
+    assert ranking[0].time_to_first_byte < ranking[1].time_to_first_byte
+
+
+def test_unhealthy_mirrors_rank_last(slow_and_fast):
+    slow, _ = slow_and_fast
+    ranking = mirrors.probe_all(["http://127.0.0.1:9/", slow.url])
+    assert [result.healthy for result in ranking] == [True, False]
+
+
+def test_ranking_is_cached(slow_and_fast, monkeypatch):
+    slow, fast = slow_and_fast
+    assert mirrors.select([slow.url, fast.url]) == fast.url
+    probed: Tuple[int, int] = (slow.requests, fast.requests)
+    monkeypatch.setattr(mirrors, "_ranked", None)  # as in the next run
+    assert mirrors.select([slow.url, fast.url]) == fast.url
+    assert (slow.requests, fast.requests) == probed
+
+
+def test_ranking_expires(slow_and_fast, monkeypatch):
+    slow, fast = slow_and_fast
+    mirrors.select([slow.url, fast.url])
+    probed: int = fast.requests
+    monkeypatch.setattr(mirrors, "_ranked", None)
+    monkeypatch.setattr(mirrors, "MIRROR_TTL", -1)
+    mirrors.select([slow.url, fast.url])
+    assert fast.requests > probed
+
+
+def test_falls_back_when_the_selected_mirror_goes_down(slow_and_fast, monkeypatch):
+    slow, fast = slow_and_fast
+    urls = [slow.url, fast.url]
+    assert mirrors.select(urls) == fast.url
+    fast.stop()
+    release: releases.Release = mirrors.use(lambda mirror: releases.latest(mirror + "iso/latest/"), urls)
+    assert release.iso_url.startswith(slow.url)
+    # the next run starts with the mirror that worked, without probing again
+    monkeypatch.setattr(mirrors, "_ranked", None)
+    assert mirrors.ranked(urls) == [slow.url]
+
+
+def test_the_last_mirror_failing_fails(slow_and_fast):
+    slow, fast = slow_and_fast
+    urls = [slow.url, fast.url]
+    mirrors.select(urls)
+    slow.stop()
+    fast.stop()
+    with pytest.raises(BaseStageException, match="Couldn't read the mirror index"):
+        mirrors.use(lambda mirror: releases.latest(mirror + "iso/latest/"), urls)
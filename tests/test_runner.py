@@ -0,0 +1,99 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+# runs the benchmarks' fake vboxmanage, which can flood its pipes or hang on request
+from archlinux_deploy.stages.exceptions import BaseStageException  # type: ignore
+from archlinux_deploy import COMMAND_CONCURRENCY, runner
+import time
+import os
+import re
+
+import pytest
+
+VBOXMANAGE: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks", "fake", "bin", "vboxmanage")
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="the fake vboxmanage needs fcntl")
+
+
+@pytest.fixture(autouse=True)
+def fake_state(tmp_path, monkeypatch):
+    monkeypatch.setenv("ALD_BENCH_VBOX_STATE", str(tmp_path / "vbox.json"))
+    monkeypatch.delenv("ALD_BENCH_VBOX_DELAY", raising=False)
+    monkeypatch.delenv("ALD_BENCH_VBOX_DELAYS", raising=False)
+
+
+def free_slots() -> int:
+    return runner._slots._value  # type: ignore
+
+
+def alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_flooded_pipes_dont_stall(monkeypatch):
+    # far more than a pipe buffer on both pipes at once, which deadlocks anything that reads them one after the other
+    monkeypatch.setenv("ALD_BENCH_VBOX_FLOOD", str(8 * 1024 * 1024))
+    return_code, stdout, stderr = runner.sp_run([VBOXMANAGE, "list", "vms"], timeout=60)
+    assert return_code == 0
+    assert len(stdout) >= 8 * 1024 * 1024 - 64
+    assert len(stderr) >= 8 * 1024 * 1024 - 64
+
+
+def test_flooded_failure_report_is_cut(monkeypatch):
+    monkeypatch.setenv("ALD_BENCH_VBOX_FLOOD", str(1024 * 1024))
+    with pytest.raises(BaseStageException) as error:
+        runner.sp_run([VBOXMANAGE, "showvminfo", "missing", "--machinereadable"], timeout=60)
+    report: str = error.value.args[0]
+    assert "Could not find a registered machine named 'missing'" in report
+    assert len(report) < 3 * runner.REPORT_LIMIT
+
+
+def test_hanging_command_is_killed_with_its_children(monkeypatch):
+    monkeypatch.setenv("ALD_BENCH_VBOX_HANG", "showvminfo")
+    started: float = time.perf_counter()
+    with pytest.raises(BaseStageException, match="timed out after 1 seconds") as error:
+        runner.sp_run([VBOXMANAGE, "showvminfo", "hung"], timeout=1)
+    assert time.perf_counter() - started < 30
+    child: int = int(re.search(r"child pid (\d+)", error.value.args[0]).group(1))
+    for _ in range(50):
+        if not alive(child):
+            break
+        time.sleep(0.1)
+    assert not alive(child)
+    assert free_slots() == COMMAND_CONCURRENCY
+
+
+def test_run_many_waits_for_every_command_before_raising():
+    started: float = time.perf_counter()
+    with pytest.raises(BaseStageException, match="Return code of command is 1"):
+        runner.run_many([["sleep", "1"], ["false"]])
+    assert time.perf_counter() - started >= 1
+    assert free_slots() == COMMAND_CONCURRENCY
+
+
+def test_run_many_timeout_releases_every_slot(monkeypatch):
+    monkeypatch.setenv("ALD_BENCH_VBOX_HANG", "showvminfo")
+    with pytest.raises(BaseStageException, match="timed out"):
+        runner.run_many([[VBOXMANAGE, "list", "vms"], [VBOXMANAGE, "showvminfo", "hung"], ["sleep", "0.5"]], timeout=1)
+    assert free_slots() == COMMAND_CONCURRENCY
+
+
+def test_run_many_results_keep_their_order():
+    results = runner.run_many([["sh", "-c", "sleep 0.3; echo first"], ["echo", "second"]])
+    assert [result.stdout.strip() for result in results] == ["first", "second"]
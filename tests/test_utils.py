@@ -0,0 +1,49 @@
+#  archlinux-deploy - Deploys a VirtualBox Arch Linux VM automatically.
+#  Copyright (C) 2020  ALinuxPerson
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from archlinux_deploy import utils
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
+import pytest
+
+
+def test_write_atomically_creates_the_directory(tmp_path):
+    path: str = str(tmp_path / "cache" / "state.json")
+    utils.write_json(path, {"version": 1})
+    with open(path, "r") as file:
+        assert json.load(file) == {"version": 1}
+    assert os.listdir(tmp_path / "cache") == ["state.json"]
+
+
+def test_concurrent_writers_never_interleave(tmp_path):
+    path: str = str(tmp_path / "state.json")
+    contents = ["".join(str(writer) for _ in range(100_000)) for writer in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda content: utils.write_atomically(path, content), contents * 4))
+    with open(path, "r") as file:
+        assert file.read() in contents
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+def test_a_failed_write_leaves_the_old_file(tmp_path):
+    path: str = str(tmp_path / "state.json")
+    utils.write_json(path, {"version": 1})
+    with pytest.raises(TypeError):
+        utils.write_atomically(path, 1)  # type: ignore  # fails once the temporary file exists
+    with open(path, "r") as file:
+        assert json.load(file) == {"version": 1}
+    assert os.listdir(tmp_path) == ["state.json"]